@@ -0,0 +1,113 @@
+import threading
+from time import sleep, monotonic
+
+import metrics
+
+
+# An adaptive polling schedule for an agency's routes.
+#
+# Each route is polled every `min_interval` seconds while its responses
+# have vehicles in them. After each poll that finds none, its interval
+# doubles, up to `max_interval`; as soon as a poll finds vehicles again,
+# it is back to `min_interval`.
+#
+# The recent vehicle count and report rate (rows per second) of each
+# route are tracked as exponentially weighted moving averages, with
+# weight `alpha` on the latest poll.
+class AdaptiveSchedule(object):
+    def __init__(self, min_interval, max_interval, alpha=0.3):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.alpha = alpha
+        # From (key) route UUID -> (value) dict with the route's current
+        # interval, the monotonic time of its next poll and of its last
+        # poll, and its average vehicle count and report rate.
+        self.routes = dict()
+        self.lock = threading.Lock()
+
+    # Get the routes due for a poll, out of `routes` (as selected from
+    # nextbus.route). Routes never polled before are due right away.
+    #
+    # A route due within half of `min_interval` is polled now rather
+    # than a whole tick late.
+    def due(self, routes, now=None):
+        if now is None:
+            now = monotonic()
+        horizon = now + self.min_interval / 2
+        with self.lock:
+            return [
+                r for r in routes
+                if r[0] not in self.routes
+                or self.routes[r[0]]['next_poll'] <= horizon
+            ]
+
+    # Record the outcome of a poll of a route that returned `n_rows`
+    # vehicle rows, and schedule its next poll.
+    def record(self, route_id, n_rows, now=None):
+        if now is None:
+            now = monotonic()
+        with self.lock:
+            state = self.routes.get(route_id)
+            if state is None:
+                state = self.routes[route_id] = {
+                    'interval': self.min_interval,
+                    'last_poll': None,
+                    'vehicles': float(n_rows),
+                    'rate': 0.0
+                }
+            else:
+                state['vehicles'] += self.alpha * (n_rows - state['vehicles'])
+            if state['last_poll'] is not None:
+                rate = n_rows / max(now - state['last_poll'], 1e-9)
+                state['rate'] += self.alpha * (rate - state['rate'])
+            if n_rows > 0:
+                state['interval'] = self.min_interval
+            else:
+                state['interval'] = min(
+                    self.max_interval, state['interval'] * 2
+                )
+            state['last_poll'] = now
+            state['next_poll'] = now + state['interval']
+
+    # Count the routes polled at the fastest interval, and those backed
+    # off to a slower one.
+    def tiers(self):
+        with self.lock:
+            fast = sum(
+                1 for s in self.routes.values()
+                if s['interval'] <= self.min_interval
+            )
+            return {'fast': fast, 'slow': len(self.routes) - fast}
+
+    # Report the gauges of an agency's schedule.
+    def report(self, agency_id):
+        for [tier, n_routes] in self.tiers().items():
+            metrics.set_gauge('adaptive_routes', n_routes,
+                              agency=agency_id, tier=tier)
+
+
+# A thread-safe token bucket limiting calls to `rate` per second, with
+# bursts of up to `burst` calls (defaulting to one second's worth).
+class RateLimiter(object):
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    # Wait until a call is allowed.
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
@@ -1,19 +1,25 @@
-import requests
+import datetime
+import concurrent.futures
+import hashlib
+
 import psycopg2
 import psycopg2.extras
-import uuid
 from lxml import etree
 
+import ingest
+import livestate
+import metrics
+import retry
 import route
 
 
 # Get the current "agencyList" from the nextbus API. Upsert to the
 # postgres database.
-def update_agencies(conn):
+#
+# `timeout` (in seconds) bounds the request; None waits indefinitely.
+def update_agencies(conn, timeout=None):
     # Hit the agencyList endpoint.
-    agency_xml = requests.get(
-        route.BASE_URL + 'agencyList'
-    ).content
+    agency_xml = route.fetch('agencyList', timeout)
     agency_etree = etree.fromstring(agency_xml)
     # Format the results as a list of tuples for psycopg2.
     agency_rows = [(
@@ -29,6 +35,8 @@ def update_agencies(conn):
             ON CONFLICT (agency_id)
             DO UPDATE SET
                 (name, region) = (EXCLUDED.name, EXCLUDED.region)
+                WHERE (agency.name, agency.region)
+                    IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.region)
     """
     # Execute the UPSERT command.
     with conn.cursor() as cur:
@@ -37,32 +45,42 @@ def update_agencies(conn):
         )
 
 
-# Get an agency's current "routeList" from the nextbus API. Upsert to
-# the postgres database.
-def update_routes(conn, agency_id):
+# Get an agency's current "routeList" from the nextbus API.
+#
+# Return its routes as a list of tuples, in the column order of
+# nextbus.route. `timeout` bounds the request, as for update_agencies.
+#
+# The route UUIDs are only used for routes new to the database: a route
+# created before UUIDs were derived from natural keys keeps its own, so
+# the database, not these rows, is the source of route UUIDs (see
+# bind_route_configs).
+def get_routes(agency_id, timeout=None):
     # Hit the routeList endpoint.
-    route_xml = requests.get(
-        route.BASE_URL + 'routeList&a={0}'.format(
-            agency_id
-        )
-    ).content
+    route_xml = route.fetch('routeList&a={0}'.format(agency_id), timeout)
     route_etree = etree.fromstring(route_xml)
     # Format the results as a list of tuples for psycopg2.
-    route_rows = [(
-        uuid.uuid4(),
+    return [(
+        route.route_uuid(agency_id, i.get('tag')),
         agency_id,
         i.get('tag'),
         i.get('title')
     ) for i in route_etree.iter('route')]
+
+
+# Upsert an agency's routes, as returned by get_routes, to the postgres
+# database.
+def update_routes(conn, route_rows):
     # Create the UPSERT command.
     #
-    # If route is already in database, update its name.
+    # If route is already in database, update its name, unless it
+    # hasn't changed.
     upsert_sql = """
         INSERT INTO nextbus.route (route_id, agency_id, tag, name)
             VALUES %s
             ON CONFLICT (agency_id, tag)
             DO UPDATE SET
                 (name) = (EXCLUDED.name)
+                WHERE route.name IS DISTINCT FROM EXCLUDED.name
     """
     # Execute the UPSERT command.
     with conn.cursor() as cur:
@@ -71,28 +89,133 @@ def update_routes(conn, agency_id):
         )
 
 
-# Get an agency's current route "services", found in each route's
-# "routeConfig" from the nextbus API.
+# Get the current "routeConfig" of each of an agency's routes (as
+# returned by get_routes) from the nextbus API. Each route's payload is
+# fetched and parsed exactly once per refresh, and the parsed etree is
+# then shared by update_services, update_stops and
+# update_service_stop_orders. No DB connection is needed, so the
+# requests are made before the refresh's transaction is opened, and
+# the routeConfigs are keyed by route tag until bind_route_configs
+# matches them to their routes in the database.
 #
-# Upsert to the postgres database.
-def update_services(conn, agency_id):
-    # Get all of the agency's routes with their UUIDs.
+# previous_snapshots is the dict returned by the previous call, from
+# (key) route tag -> (value) (payload digest, parsed etree). Routes
+# whose payload is byte-identical to the previous one are not re-parsed
+# and are flagged as unchanged, so that their rows need not be written
+# again.
+#
+# A route whose routeConfig can't be fetched or parsed (once its
+# requests have been retried) doesn't fail the others: its previous
+# snapshot, if any, is kept and flagged as unchanged, and otherwise the
+# route is left out until the next refresh. Each request is bounded by
+# `timeout` seconds.
+#
+# Return a list with (1) the list of (route tag, etree, changed) tuples,
+# (2) the new snapshots dict, to be passed to the next call once the
+# refresh has succeeded, and (3) the list of routes whose routeConfig
+# failed, to be fetched again with merge_route_configs.
+def get_route_configs(agency_id, routes, previous_snapshots=None,
+                      timeout=None):
+    if previous_snapshots is None:
+        previous_snapshots = dict()
+    # Initiate the list of parsed routeConfigs and the new snapshots dict.
+    route_configs = []
+    snapshots = dict()
+    failed_routes = []
+    for r in routes:
+        try:
+            [previous_digest, previous_etree] = previous_snapshots[r[2]]
+        except KeyError:
+            [previous_digest, previous_etree] = [None, None]
+        try:
+            route_config_xml = route.get_route_config(route=r, timeout=timeout)
+            digest = hashlib.sha1(route_config_xml).hexdigest()
+            # Reuse the previous parsed etree if the payload hasn't
+            # changed.
+            if digest == previous_digest:
+                route_config_etree = previous_etree
+                changed = False
+            else:
+                route_config_etree = etree.fromstring(route_config_xml)
+                changed = True
+        except Exception as e:
+            metrics.inc('failures_total', agency=agency_id,
+                        stage='get_route_config')
+            print("Getting routeConfig of route " + r[2] + " of agency "
+                  + agency_id + " failed: " + repr(e))
+            failed_routes.append(r)
+            if previous_digest is None:
+                continue
+            [digest, route_config_etree, changed] = [
+                previous_digest, previous_etree, False
+            ]
+        snapshots[r[2]] = [digest, route_config_etree]
+        route_configs.append((r[2], route_config_etree, changed))
+    return [route_configs, snapshots, failed_routes]
+
+
+# Fetch the routeConfigs of `failed_routes`, as returned by
+# get_route_configs, again, and merge them into `route_configs` and
+# `snapshots`, also as returned by get_route_configs.
+#
+# Return a list with the merged (1) routeConfigs and (2) snapshots, and
+# (3) the routes that failed again.
+def merge_route_configs(agency_id, route_configs, snapshots, failed_routes,
+                        previous_snapshots=None, timeout=None):
+    [retried_configs, retried_snapshots, failed_routes] = get_route_configs(
+        agency_id, failed_routes, previous_snapshots, timeout
+    )
+    retried_tags = set(rc[0] for rc in retried_configs)
+    route_configs = [
+        rc for rc in route_configs if rc[0] not in retried_tags
+    ] + retried_configs
+    snapshots = dict(snapshots)
+    snapshots.update(retried_snapshots)
+    return [route_configs, snapshots, failed_routes]
+
+
+# Match an agency's routeConfigs, as returned by get_route_configs, to
+# the agency's routes as stored in the database, once update_routes has
+# upserted them.
+#
+# Return the list of (route, etree, changed) tuples used by
+# update_services, update_stops and update_service_stop_orders, with
+# each route as a nextbus.route row.
+def bind_route_configs(conn, agency_id, route_configs):
     with conn.cursor() as cur:
         cur.execute(
             "SELECT * FROM nextbus.route WHERE agency_id = %s",
             (agency_id,)
         )
-        routes = cur.fetchall()
+        routes = dict((r[2], r) for r in cur.fetchall())
+    return [
+        (routes[route_tag], route_config_etree, changed)
+        for [route_tag, route_config_etree, changed] in route_configs
+        if route_tag in routes
+    ]
+
+
+# Get an agency's current route "services", found in each route's
+# "routeConfig" (as returned by get_route_configs).
+#
+# Upsert to the postgres database.
+def update_services(conn, route_configs):
     # Initiate the list that will contain all of the service rows.
     service_rows = []
-    # For each route, hit the routeConfig API endpoint and get all the
-    # service info contained within.
-    for r in routes:
-        service_rows.extend(route.get_services(route=r))
+    # For each changed route, get all the service info contained within
+    # its routeConfig.
+    for [r, route_config_etree, changed] in route_configs:
+        if changed:
+            service_rows.extend(route.get_services(
+                route=r, route_config_etree=route_config_etree
+            ))
+    # If no route has changed, there is nothing to upsert.
+    if not service_rows:
+        return
     # Create the UPSERT command.
     #
     # If service is already in database, update its name, direction, and
-    # use_for_ui boolean.
+    # use_for_ui boolean, unless none of them has changed.
     upsert_sql = """
         INSERT INTO nextbus.service (service_id, route_id, tag,
                                      name, direction, use_for_ui)
@@ -101,6 +224,9 @@ def update_services(conn, agency_id):
             DO UPDATE SET
                 (name, direction, use_for_ui)
                 = (EXCLUDED.name, EXCLUDED.direction, EXCLUDED.use_for_ui)
+                WHERE (service.name, service.direction, service.use_for_ui)
+                    IS DISTINCT FROM
+                    (EXCLUDED.name, EXCLUDED.direction, EXCLUDED.use_for_ui)
     """
     # Execute the UPSERT command.
     with conn.cursor() as cur:
@@ -109,70 +235,97 @@ def update_services(conn, agency_id):
         )
 
 
-# Get an agency's current stops, found in each route's "routeConfig"
-# from the nextbus API.
+# Resolve the "missing" stops of an agency's routes (as returned by
+# route.get_stops): for each missing stop, first see if any other stops
+# in `stop_rows` exist with the same tag under a different route; if so,
+# use that stop's name and location; and if not, create a stop row with
+# NULL name and location.
 #
-# Upsert to the postgres database.
-def update_stops(conn, agency_id):
-    # Get all of the agency's routes with their UUIDs.
-    with conn.cursor() as cur:
-        cur.execute(
-            "SELECT * FROM nextbus.route WHERE agency_id = %s",
-            (agency_id,)
-        )
-        routes = cur.fetchall()
-    # Initiate the list that will contain all of the stop tuples.
-    #
-    # These will be passed to the mogrify function so that postgis
-    # commands can be wrapped around them.
-    stop_rows = []
-    # Initiate the set that will contain all missing stops.
-    missing_stops = set()
-    # For each route, hit the routeConfig API endpoint and get all the
-    # stop info contained within.
-    for r in routes:
-        [r_stop_rows, r_missing_stops] = route.get_stops(route=r)
-        stop_rows.extend(r_stop_rows)
-        missing_stops.update(r_missing_stops)
-    # For each missing stop, first see if any other stops exist with the
-    # same tag under a different route; if so, use that stop's name and
-    # location; and if not, create a stop row with NULL name and
-    # location.
+# Among the stops matching a tag, the one that sorts first by (tag, lon,
+# lat, name, route_id) is used, so that the choice of stop is
+# deterministic.
+#
+# Return the list of stop rows to upsert for the missing stops.
+def resolve_missing_stops(stop_rows, missing_stops):
+    # Index the stops by tag, keeping for each tag only the stop that
+    # sorts first. This takes a single pass over the stops.
+    first_stop_by_tag = dict()
+    for sr in stop_rows:
+        sort_key = (sr[2], sr[4], sr[5], sr[3], sr[1])
+        try:
+            if sort_key < first_stop_by_tag[sr[2]][0]:
+                first_stop_by_tag[sr[2]] = (sort_key, sr)
+        except KeyError:
+            first_stop_by_tag[sr[2]] = (sort_key, sr)
+    new_stop_rows = []
     for ms in missing_stops:
-        matching_stop_rows = [sr for sr in stop_rows if sr[2] == ms[1]]
         # If at least one existing stop matches the missing stop's tag,
-        # use the name and lon/lat from one of these matching stops.
-        if matching_stop_rows:
-            # Sort so that choice of stop is deterministic. Sort by
-            # (tag, lon, lat, name, route_id).
-            matching_stop_rows.sort(
-                key=lambda sr: (sr[2], sr[4], sr[5], sr[3], sr[1])
-            )
-            matching_stop = matching_stop_rows[0]
-            new_stop_row  = [(
-                uuid.uuid4(),
+        # use the name and lon/lat from the first of these matching
+        # stops.
+        if ms[1] in first_stop_by_tag:
+            matching_stop = first_stop_by_tag[ms[1]][1]
+            new_stop_rows.append((
+                route.stop_uuid(
+                    ms[0], ms[1], matching_stop[4], matching_stop[5]
+                ),
                 ms[0],
                 ms[1],
                 matching_stop[3],
                 matching_stop[4],
                 matching_stop[5]
-            )]
+            ))
         # If no existing stop matches the missing stop's tag, set NULL
         # name and lon/lat.
         else:
-            new_stop_row = [(
-                uuid.uuid4(),
+            new_stop_rows.append((
+                route.stop_uuid(ms[0], ms[1], None, None),
                 ms[0],
                 ms[1],
                 None,
                 None,
                 None
-            )]
-        stop_rows.extend(new_stop_row)
+            ))
+    return new_stop_rows
+
+
+# Get an agency's current stops, found in each route's "routeConfig"
+# (as returned by get_route_configs).
+#
+# Upsert to the postgres database.
+def update_stops(conn, route_configs):
+    # If no route has changed, there is nothing to upsert.
+    if not any(rc[2] for rc in route_configs):
+        return
+    # Initiate the list that will contain all of the stop tuples.
+    #
+    # These will be passed to the mogrify function so that postgis
+    # commands can be wrapped around them.
+    stop_rows = []
+    # Initiate the set that will contain all missing stops.
+    missing_stops = set()
+    # For each route, get all the stop info contained within its
+    # routeConfig.
+    #
+    # Unchanged routes' stops are still needed to resolve other routes'
+    # missing stops, so they're kept aside rather than upserted again.
+    unchanged_stop_rows = []
+    for [r, route_config_etree, changed] in route_configs:
+        [r_stop_rows, r_missing_stops] = route.get_stops(
+            route=r, route_config_etree=route_config_etree
+        )
+        if changed:
+            stop_rows.extend(r_stop_rows)
+        else:
+            unchanged_stop_rows.extend(r_stop_rows)
+        missing_stops.update(r_missing_stops)
+    # Resolve the missing stops against every route's stops.
+    stop_rows.extend(resolve_missing_stops(
+        stop_rows + unchanged_stop_rows, missing_stops
+    ))
     # Execute an UPSERT command.
     #
     # If stop with same route, tag, and location is already in database,
-    # update its name.
+    # update its name, unless it hasn't changed.
     with conn.cursor() as cur:
         # Wrap postgis command around the lon and lat of each stop.
         stop_rows_str = b','.join(cur.mogrify(
@@ -186,61 +339,142 @@ def update_stops(conn, agency_id):
             + stop_rows_str
             + ") v(stop_id, route_id, tag, name, location) "
             + "ON CONFLICT (route_id, tag, COALESCE(TEXT(location), '')) "
-            + "DO UPDATE SET (name) = (EXCLUDED.name)"
+            + "DO UPDATE SET (name) = (EXCLUDED.name) "
+            + "WHERE stop.name IS DISTINCT FROM EXCLUDED.name"
         )
 
 
-# Get an agency's current service stop orders, found in each route's
-# "routeConfig" from the nextbus API.
+# Process-level cache of the stop ordering currently in effect for each
+# service, from (key) agency_id -> (value) dict from service UUID ->
+# tuple of stop UUIDs, in order.
+STOP_ORDERS = dict()
+
+
+# Get the stop ordering currently in effect for each of an agency's
+# services: the service_stop_order rows whose validity hasn't ended.
 #
-# Upsert to the postgres database.
-def update_service_stop_orders(conn, agency_id):
-    # Get all of the agency's routes and services with their UUIDs.
+# Return them as a dict from service UUID -> tuple of stop UUIDs, in
+# order.
+def load_stop_orders(conn, agency_id):
     with conn.cursor() as cur:
         cur.execute(
-            "SELECT * FROM nextbus.route WHERE agency_id = %s",
-            (agency_id,)
-        )
-        routes = cur.fetchall()
-        cur.execute(
-            "SELECT service_id, route_id, service.tag, service.name, "
-            + "direction, use_for_ui "
-            + "FROM nextbus.service INNER JOIN nextbus.route "
-            + "USING (route_id) "
-            + "WHERE agency_id = %s",
+            "SELECT service_id, stop_id "
+            + "FROM nextbus.service_stop_order "
+            + "INNER JOIN nextbus.service USING (service_id) "
+            + "INNER JOIN nextbus.route USING (route_id) "
+            + "WHERE agency_id = %s AND valid_until IS NULL "
+            + "ORDER BY service_id, stop_order",
             (agency_id,)
         )
-        services = cur.fetchall()
+        stop_orders = dict()
+        for [service_id, stop_id] in cur.fetchall():
+            stop_orders.setdefault(service_id, []).append(stop_id)
+    return dict((k, tuple(v)) for [k, v] in stop_orders.items())
+
+
+# Get an agency's current service stop orders, found in each route's
+# "routeConfig" (as returned by get_route_configs).
+#
+# Each service's ordering is compared against the one currently in
+# effect, and only services whose ordering changed are written: their
+# current version's validity is ended, and the new ordering is inserted
+# as a new version valid from now on. Services that are no longer in a
+# changed route's routeConfig have their current version's validity
+# ended too. Every version ended or started by one refresh shares the
+# same timestamp, so that there is no gap between them.
+def update_service_stop_orders(conn, route_configs):
+    now = datetime.datetime.utcnow()
     # Initiate the list that will contain all of the service stop order
     # rows.
     order_rows = []
-    # For each route, find the order of stops for each service.
-    for r in routes:
-        order_rows.extend(route.get_service_stop_orders(conn=conn, route=r))
-    # Create the UPSERT command.
-    upsert_sql = """
-        INSERT INTO nextbus.service_stop_order
-                (service_id, stop_id, stop_order, update_timestamp)
-            VALUES %s
-            ON CONFLICT (service_id, stop_order, update_timestamp)
-            DO NOTHING
-    """
-    # Execute the UPSERT command.
+    # For each changed route, find the order of stops for each service.
+    changed_routes = []
+    for [r, route_config_etree, changed] in route_configs:
+        if changed:
+            changed_routes.append(r[0])
+            order_rows.extend(route.get_service_stop_orders(
+                conn=conn, route=r, route_config_etree=route_config_etree,
+                now=now
+            ))
+    # If no route has changed, there is nothing to upsert.
+    if not changed_routes:
+        return
+    # Get the orderings currently in effect, loading them on first use.
+    agency_id = route_configs[0][0][1]
+    try:
+        current_orders = STOP_ORDERS[agency_id]
+    except KeyError:
+        current_orders = load_stop_orders(conn, agency_id)
+    # Group the new rows by service, and keep only the services whose
+    # ordering changed.
+    new_orders = dict()
+    for row in sorted(order_rows, key=lambda orw: (orw[0], orw[2])):
+        new_orders.setdefault(row[0], []).append(row)
+    changed_rows = []
+    for [service_id, rows] in new_orders.items():
+        if tuple(orw[1] for orw in rows) != current_orders.get(service_id):
+            changed_rows.extend(rows)
+    changed_services = list(set(orw[0] for orw in changed_rows))
     with conn.cursor() as cur:
-        psycopg2.extras.execute_values(
-            cur, upsert_sql, order_rows
+        # End the validity of the current orderings of the changed
+        # routes' services that are no longer in their routeConfig.
+        cur.execute(
+            "UPDATE nextbus.service_stop_order "
+            + "SET valid_until = %s "
+            + "WHERE valid_until IS NULL "
+            + "AND service_id IN (SELECT service_id FROM nextbus.service "
+            + "WHERE route_id = ANY(%s)) "
+            + "AND NOT service_id = ANY(%s) "
+            + "RETURNING service_id",
+            (now, changed_routes, list(new_orders))
+        )
+        for [service_id] in cur.fetchall():
+            current_orders.pop(service_id, None)
+        if changed_rows:
+            # End the validity of the changed services' current
+            # orderings.
+            cur.execute(
+                "UPDATE nextbus.service_stop_order "
+                + "SET valid_until = %s "
+                + "WHERE service_id = ANY(%s) AND valid_until IS NULL",
+                (now, changed_services)
+            )
+            # Insert their new orderings.
+            psycopg2.extras.execute_values(
+                cur,
+                """
+                INSERT INTO nextbus.service_stop_order
+                        (service_id, stop_id, stop_order, update_timestamp)
+                    VALUES %s
+                    ON CONFLICT (service_id, stop_order, update_timestamp)
+                    DO NOTHING
+                """,
+                changed_rows
+            )
+    for service_id in changed_services:
+        current_orders[service_id] = tuple(
+            orw[1] for orw in new_orders[service_id]
         )
+    STOP_ORDERS[agency_id] = current_orders
 
 
-# Get and update an agency's vehicle locations by hitting the
-# "vehicleLocations" API endpoint.
+# Process-level cache of each agency's route and service dimensions,
+# from (key) agency_id -> (value) dict as returned by load_dimensions.
 #
-# Insert to the postgres database.
-def update_vehicle_locations(conn, agency_id, previous_requests):
-    # Get all of the agency's routes and services with their UUIDs.
+# These only change on the daily update, so the polling loop reads them
+# from here rather than from the database.
+DIMENSIONS = dict()
+
+
+# Get all of an agency's routes and services with their UUIDs, and
+# build the indexes used to match vehicles to services.
+#
+# Return them as a dict.
+def load_dimensions(conn, agency_id):
     with conn.cursor() as cur:
         cur.execute(
-            "SELECT * FROM nextbus.route WHERE agency_id = %s",
+            "SELECT * FROM nextbus.route WHERE agency_id = %s "
+            + "ORDER BY route_id",
             (agency_id,)
         )
         routes = cur.fetchall()
@@ -249,7 +483,8 @@ def update_vehicle_locations(conn, agency_id, previous_requests):
             + "direction, use_for_ui "
             + "FROM nextbus.service INNER JOIN nextbus.route "
             + "USING (route_id) "
-            + "WHERE agency_id = %s",
+            + "WHERE agency_id = %s "
+            + "ORDER BY service_id",
             (agency_id,)
         )
         services = cur.fetchall()
@@ -262,63 +497,201 @@ def update_vehicle_locations(conn, agency_id, previous_requests):
     # logic that selects the first agency-wide service UUID for each
     # service tag, after some detrministic sorting.
     service_dict = dict([(serv[2], serv[0]) for serv in services])
-    # Initiate the list of tuples that will contain all routes' vehicle
-    # locations.
-    #
-    # These will be passed to the mogrify function so that postgis
-    # commands can be wrapped around them.
-    vehicle_rows = []
-    # Initiate the dict that will store the API request time for each
-    # route.
-    these_requests = dict()
-    for r in routes:
-        # Create a route-specific dict from (key) service tag -> (value)
+    # Create an index from (key) route tag -> (value) route-specific
+    # dict from service tag -> service UUID, in one pass over the
+    # services.
+    route_tags = dict([(r[0], r[2]) for r in routes])
+    route_service_dicts = dict([(r[2], dict()) for r in routes])
+    for serv in services:
+        route_service_dicts[route_tags[serv[1]]][serv[2]] = serv[0]
+    return {
+        'routes': routes,
+        'services': services,
+        'service_dict': service_dict,
+        'route_service_dicts': route_service_dicts
+    }
+
+
+# Get an agency's dimensions from the cache, loading them on first use.
+def get_dimensions(conn, agency_id):
+    try:
+        return DIMENSIONS[agency_id]
+    except KeyError:
+        DIMENSIONS[agency_id] = load_dimensions(conn, agency_id)
+        return DIMENSIONS[agency_id]
+
+
+# Reload an agency's dimensions after the daily update, replacing the
+# cached ones only if its routes or services actually changed.
+#
+# Return True if the cache was invalidated.
+def refresh_dimensions(conn, agency_id):
+    dimensions = load_dimensions(conn, agency_id)
+    cached = DIMENSIONS.get(agency_id)
+    if (cached is not None
+            and cached['routes'] == dimensions['routes']
+            and cached['services'] == dimensions['services']):
+        return False
+    DIMENSIONS[agency_id] = dimensions
+    return True
+
+
+# The circuit breaker of per-route "vehicleLocations" requests, keyed
+# by route UUID. Routes that keep failing are skipped for a while
+# rather than retried on every poll.
+ROUTE_BREAKER = retry.CircuitBreaker()
+
+
+# Get an agency's updated vehicle locations by hitting the
+# "vehicleLocations" API endpoint.
+#
+# Routes are polled by a pool of up to `max_workers` threads sharing
+# route.SESSION, with each request bounded by `timeout` seconds. With
+# the default of 1 worker, routes are polled one at a time.
+#
+# A failing route doesn't fail the cycle: its rows are left out and its
+# request time is kept, so the next poll picks up where it left off.
+# Routes whose circuit is open in ROUTE_BREAKER are skipped the same
+# way.
+#
+# If `agency_wide` is True, the whole agency is instead polled with a
+# single request per cycle, and its request time is stored in
+# previous_requests under the agency_id rather than per route.
+#
+# If `schedule` is an adaptive.AdaptiveSchedule, only the routes it has
+# due are polled, and the number of rows each returns is recorded in it.
+# The request times of the other routes are carried over.
+#
+# Return a list with (1) the list of vehicle rows and (2) the dict of
+# updated API request times, to be passed back in as previous_requests.
+def get_vehicle_locations(conn, agency_id, previous_requests,
+                          max_workers=1, timeout=None,
+                          agency_wide=False, schedule=None):
+    # Get all of the agency's routes and services, and the indexes
+    # matching tags to their UUIDs, from the dimension cache.
+    dimensions = get_dimensions(conn, agency_id)
+    routes = dimensions['routes']
+    service_dict = dimensions['service_dict']
+    route_service_dicts = dimensions['route_service_dicts']
+
+    # Find one route's updated vehicle locations. Return them along with
+    # the route's UUID and updated API request time.
+    def poll_route(r):
+        # Get the route-specific dict from (key) service tag -> (value)
         # service UUID.
         route_id = r[0]
-        route_service_dict = dict(
-            [(serv[2], serv[0]) for serv in services if serv[1] == route_id]
-        )
+        route_service_dict = route_service_dicts[r[2]]
         # Get the time of the previous request for this route. If none
         # can be found, set to 0.
         try:
             route_previous_request = previous_requests[route_id]
         except:
             route_previous_request = '0'
-        # For each route, find the updated vehicle locations. Get also
-        # the updated API request times.
-        [route_vehicle_rows, request_time] = route.get_vehicle_locations(
-            conn=conn,
-            route=r,
-            service_dict=service_dict,
-            route_service_dict=route_service_dict,
-            previous_request=route_previous_request
+        if not ROUTE_BREAKER.allow(route_id):
+            return [route_id, [], route_previous_request]
+        try:
+            [route_vehicle_rows, request_time] = route.get_vehicle_locations(
+                conn=conn,
+                route=r,
+                service_dict=service_dict,
+                route_service_dict=route_service_dict,
+                previous_request=route_previous_request,
+                timeout=timeout
+            )
+        except Exception as e:
+            metrics.inc('failures_total', agency=agency_id,
+                        stage='get_vehicle_locations')
+            if ROUTE_BREAKER.record_failure(route_id):
+                print("Polling route " + r[2] + " of agency " + agency_id
+                      + " keeps failing, skipping it for a while: "
+                      + repr(e))
+            return [route_id, [], route_previous_request]
+        ROUTE_BREAKER.record_success(route_id)
+        if schedule is not None:
+            schedule.record(route_id, len(route_vehicle_rows))
+        return [route_id, route_vehicle_rows, request_time]
+
+    # Find one request's worth of vehicle locations for the whole agency.
+    # Return them along with the agency's id and updated API request
+    # time.
+    def poll_agency():
+        # Get the time of the previous request for this agency. If none
+        # can be found, set to 0.
+        try:
+            agency_previous_request = previous_requests[agency_id]
+        except:
+            agency_previous_request = '0'
+        [agency_vehicle_rows, request_time] = (
+            route.get_agency_vehicle_locations(
+                agency_id=agency_id,
+                service_dict=service_dict,
+                route_service_dicts=route_service_dicts,
+                previous_request=agency_previous_request,
+                timeout=timeout
+            )
         )
+        return [agency_id, agency_vehicle_rows, request_time]
+
+    # For each route (or for the whole agency at once), find the updated
+    # vehicle locations. Get also the updated API request times.
+    if not agency_wide and schedule is not None:
+        routes = schedule.due(routes)
+        metrics.set_gauge('polled_routes', len(routes), agency=agency_id)
+    if agency_wide:
+        results = [poll_agency()]
+    elif max_workers > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            results = list(pool.map(poll_route, routes))
+    else:
+        results = [poll_route(r) for r in routes]
+    # Initiate the list of tuples that will contain all routes' vehicle
+    # locations.
+    #
+    # These will be streamed to the database through COPY.
+    vehicle_rows = []
+    # Initiate the dict that will store the API request time for each
+    # route (or for the agency).
+    #
+    # Each result carries its own route UUID, so the request times stay
+    # matched to their routes whatever order the requests finish in.
+    # Routes that weren't polled keep their previous request time.
+    these_requests = dict(previous_requests)
+    for [request_key, result_vehicle_rows, request_time] in results:
         # Add these new vehicle rows to the agency-wide list.
-        vehicle_rows.extend(route_vehicle_rows)
+        vehicle_rows.extend(result_vehicle_rows)
         # Update the previous_requests dict with this latest request
         # time.
-        these_requests[route_id] = request_time
+        these_requests[request_key] = request_time
+    # Keep the live state store, if any, up to date. It's optional, so
+    # failing to update it never fails the poll.
+    if livestate.STATE is not None:
+        try:
+            livestate.STATE.update(agency_id, vehicle_rows)
+        except Exception as e:
+            metrics.inc('failures_total', agency=agency_id,
+                        stage='update_livestate')
+            print("Updating the live state of agency " + agency_id
+                  + " failed: " + repr(e))
+    # Return the vehicle rows and the updated API request epoch times.
+    return [vehicle_rows, these_requests]
+
+
+# Get and update an agency's vehicle locations by hitting the
+# "vehicleLocations" API endpoint. Takes the same arguments as
+# get_vehicle_locations.
+#
+# Insert to the postgres database.
+def update_vehicle_locations(conn, agency_id, previous_requests, **kwargs):
+    [vehicle_rows, these_requests] = get_vehicle_locations(
+        conn, agency_id, previous_requests, **kwargs
+    )
     # If at least 1 vehicle location has been updated since the last
-    # request, insert to the db.
+    # request, insert to the db, checkpointing the request times with
+    # them. If none has, the previous checkpoint would fetch nothing
+    # more after a restart, so it is left as is.
     if vehicle_rows:
-        with conn.cursor() as cur:
-            # Wrap postgis command around the lon and lat of each
-            # vehicle.
-            vehicle_rows_str = b','.join(cur.mogrify(
-                "(%s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326), %s, %s)",
-                i
-            ) for i in vehicle_rows).decode(conn.encoding)
-            # Execute the INSERT command.
-            cur.execute(
-                "INSERT INTO nextbus.vehicle_location "
-                + "(service_id, vehicle_tag, vehicle_location, "
-                + "location_timestamp, is_predictable) "
-                + "SELECT DISTINCT ON "
-                + "(service_id, vehicle_tag, location_timestamp) * "
-                + "FROM (VALUES "
-                + vehicle_rows_str
-                + ") v(service_id, vehicle_tag, vehicle_location, "
-                + "location_timestamp, is_predictable)"
-            )
+        ingest.write_vehicle_rows(
+            conn, agency_id, vehicle_rows, these_requests
+        )
     # Return the updated API request epoch times.
     return these_requests
@@ -0,0 +1,104 @@
+import os
+import glob
+import gzip
+import json
+import time
+import threading
+
+
+# An append-only archive of raw NextBus responses, written to rotating,
+# gzip-compressed segment files in `directory`.
+#
+# Each record is a JSON header line holding the request URL, the fetch
+# time (in epoch seconds) and the payload length, followed by the
+# payload itself. Records are flushed as they are written, so a crash
+# loses at most the record being written. A segment is written as
+# `<name>.gz.part` and renamed to `<name>.gz` once it is closed, after
+# reaching `max_bytes` of payload or `max_age` seconds.
+class FeedArchive(object):
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, max_age=3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment = None
+        self.segment_count = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    # Open a new segment file.
+    def open_segment(self):
+        self.segment_count += 1
+        self.path = os.path.join(
+            self.directory,
+            'feed-{0}-{1}-{2:06d}.gz.part'.format(
+                time.strftime('%Y%m%dT%H%M%S', time.gmtime()),
+                os.getpid(),
+                self.segment_count
+            )
+        )
+        self.segment = gzip.open(self.path, 'ab')
+        self.segment_bytes = 0
+        self.segment_opened = time.time()
+
+    # Close the current segment file, if any, and mark it complete.
+    def close(self):
+        with self.lock:
+            self.close_segment()
+
+    # Same as close, for callers already holding the lock.
+    def close_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+            os.rename(self.path, self.path[:-len('.part')])
+            self.segment = None
+
+    # Append a response to the archive.
+    def append(self, url, fetched_at, payload):
+        header = json.dumps({
+            'url': url,
+            'fetched_at': fetched_at,
+            'length': len(payload)
+        }).encode('utf-8')
+        with self.lock:
+            if self.segment is not None and (
+                    self.segment_bytes >= self.max_bytes
+                    or time.time() - self.segment_opened >= self.max_age):
+                self.close_segment()
+            if self.segment is None:
+                self.open_segment()
+            self.segment.write(header + b'\n' + payload + b'\n')
+            self.segment.flush()
+            self.segment_bytes += len(payload)
+
+
+# Read the records of archive segment files, in the order given.
+#
+# Segments cut short by a crash are read up to their last complete
+# record.
+#
+# Yield each record as a (url, fetched_at, payload) tuple.
+def iter_records(paths):
+    for path in paths:
+        with gzip.open(path, 'rb') as segment:
+            while True:
+                try:
+                    header = segment.readline()
+                    if not header:
+                        break
+                    header = json.loads(header.decode('utf-8'))
+                    payload = segment.read(header['length'] + 1)[:-1]
+                except (EOFError, OSError, ValueError):
+                    break
+                if len(payload) < header['length']:
+                    break
+                yield (header['url'], header['fetched_at'], payload)
+
+
+# Find an archive directory's segment files, oldest first, including the
+# one still being written.
+def segment_paths(directory):
+    return sorted(
+        glob.glob(os.path.join(directory, 'feed-*.gz'))
+        + glob.glob(os.path.join(directory, 'feed-*.gz.part'))
+    )
@@ -0,0 +1,355 @@
+"""Infer stop arrival times from the vehicle locations in the DB:
+  1. Load each service's ordered stops (the ordering in effect at the
+     end of the window) and the window's vehicle locations on it, into
+     NumPy arrays.
+  2. Project every location onto the service's line of stops, giving
+     its distance along the line.
+  3. Split each vehicle's locations into trips, and interpolate the time
+     at which each trip passed each stop.
+  4. Write the arrivals to nextbus.stop_arrival.
+
+Without a window, the agency is processed incrementally: from its
+watermark in nextbus.arrival_watermark (or the start of the day before)
+up to `-S` seconds ago, after which the watermark is moved forward.
+
+Usage:
+  python arrivals.py -h HOST -d DB -U USER -a AGENCY [-S SETTLE_SECONDS]
+  python arrivals.py -h HOST -d DB -U USER -a AGENCY -s START -e END
+
+START and END are UTC times in ISO format, e.g. 2020-01-01T00:00:00.
+"""
+
+import sys
+import datetime
+
+import numpy as np
+
+import cli
+import connect
+import ingest
+
+
+# The mean radius of the earth, in meters.
+EARTH_RADIUS = 6371008.8
+
+# Locations more than MAX_OFFSET meters away from a service's line of
+# stops are left out. A vehicle's trip ends after a gap of more than
+# MAX_GAP seconds between its locations, or if it goes back more than
+# BACKTRACK meters along the line (e.g. when it starts a new run).
+MAX_OFFSET = 200.0
+MAX_GAP = 600.0
+BACKTRACK = 500.0
+
+
+# Project lon/lat arrays to planar x/y arrays in meters, around the
+# latitude `lat0`. This is accurate enough over the extent of a route.
+def project(lon, lat, lat0):
+    scale = np.radians(1.0) * EARTH_RADIUS
+    return [lon * scale * np.cos(np.radians(lat0)), lat * scale]
+
+
+# Find the distance of each point along a line of stops.
+#
+# stop_xy is an (S, 2) array of the stops' x/y in meters, in order;
+# point_x and point_y are the points' x/y arrays. Each point is matched
+# to the nearest segment between consecutive stops, all at once.
+#
+# Return a list with (1) the array of the stops' distances along the
+# line, (2) the array of the points' distances along the line and (3)
+# the array of the points' distances from the line.
+def locate(stop_xy, point_x, point_y):
+    a = stop_xy[:-1]
+    segment = stop_xy[1:] - a
+    segment_length = np.hypot(segment[:, 0], segment[:, 1])
+    stop_along = np.concatenate([[0.0], np.cumsum(segment_length)])
+    # From (points, segments) arrays, the fraction of each segment at
+    # which each point's projection lies.
+    dx = point_x[:, None] - a[None, :, 0]
+    dy = point_y[:, None] - a[None, :, 1]
+    fraction = np.clip(
+        (dx * segment[None, :, 0] + dy * segment[None, :, 1])
+        / np.maximum(segment_length ** 2, 1e-9)[None, :],
+        0.0, 1.0
+    )
+    offset = np.hypot(
+        dx - fraction * segment[None, :, 0],
+        dy - fraction * segment[None, :, 1]
+    )
+    nearest = np.argmin(offset, axis=1)
+    rows = np.arange(len(point_x))
+    point_along = (
+        stop_along[nearest] + fraction[rows, nearest] * segment_length[nearest]
+    )
+    return [stop_along, point_along, offset[rows, nearest]]
+
+
+# Infer the times at which vehicles passed each stop of one service.
+#
+# stop_lonlat is an (S, 2) array of the stops' lon/lat, in order. The
+# vehicle locations are given as arrays of lon, lat, epoch time in
+# seconds and integer vehicle code, sorted by vehicle, then time.
+#
+# Return a list of arrays with, for each arrival, (1) the stop's index,
+# (2) the vehicle's code and (3) the epoch time.
+def infer_arrivals(stop_lonlat, lon, lat, t, vehicle,
+                   max_offset=MAX_OFFSET, max_gap=MAX_GAP,
+                   backtrack=BACKTRACK, chunk=20000):
+    empty = [np.empty(0, int), np.empty(0, int), np.empty(0)]
+    if len(stop_lonlat) < 2 or len(t) < 2:
+        return empty
+    lat0 = stop_lonlat[:, 1].mean()
+    stop_xy = np.column_stack(project(stop_lonlat[:, 0], stop_lonlat[:, 1],
+                                      lat0))
+    [x, y] = project(lon, lat, lat0)
+    # Locate the points in chunks, bounding the (points, segments)
+    # arrays' size.
+    along = np.empty(len(t))
+    offset = np.empty(len(t))
+    for i in range(0, len(t), chunk):
+        [stop_along, along[i:i + chunk], offset[i:i + chunk]] = locate(
+            stop_xy, x[i:i + chunk], y[i:i + chunk]
+        )
+    on_line = offset <= max_offset
+    [along, t, vehicle] = [along[on_line], t[on_line], vehicle[on_line]]
+    if len(t) < 2:
+        return empty
+    # Start a new trip at each new vehicle, long gap, or backtrack.
+    new_trip = np.ones(len(t), bool)
+    new_trip[1:] = (
+        (vehicle[1:] != vehicle[:-1])
+        | (t[1:] - t[:-1] > max_gap)
+        | (along[1:] < along[:-1] - backtrack)
+    )
+    trip = np.cumsum(new_trip) - 1
+    # Lay the trips end to end on one increasing axis, and keep each
+    # trip's progress from going backwards.
+    span = stop_along[-1] + backtrack + 1.0
+    progress = np.maximum.accumulate(along + trip * span)
+    # Keep the first time each distance is reached, so that a vehicle's
+    # dwell at a stop counts from its arrival.
+    first = np.ones(len(t), bool)
+    first[1:] = progress[1:] > progress[:-1]
+    [progress, t, vehicle, trip] = [
+        progress[first], t[first], vehicle[first], trip[first]
+    ]
+    starts = np.flatnonzero(np.r_[True, trip[1:] != trip[:-1]])
+    ends = np.r_[starts[1:], len(t)] - 1
+    # For each trip, the stops passed strictly after its first location
+    # and up to its last.
+    stop_progress = stop_along[None, :] + (trip[starts] * span)[:, None]
+    passed = (
+        (stop_progress > progress[starts][:, None])
+        & (stop_progress <= progress[ends][:, None])
+    )
+    [trip_index, stop_index] = np.nonzero(passed)
+    arrival_t = np.interp(stop_progress[passed], progress, t)
+    return [stop_index, vehicle[starts][trip_index], arrival_t]
+
+
+# Get the ordered stops of each of an agency's services, in the ordering
+# in effect at `end`. Stops without a location are left out.
+#
+# Return a dict from (key) service UUID -> (value) list with (1) the
+# list of stop UUIDs and (2) the (S, 2) array of their lon/lat.
+def load_stop_sequences(conn, agency_id, end):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT service_id, stop_id, ST_X(location), ST_Y(location) "
+            + "FROM nextbus.service_stop_order "
+            + "INNER JOIN nextbus.stop USING (stop_id) "
+            + "INNER JOIN nextbus.service USING (service_id) "
+            + "INNER JOIN nextbus.route ON route.route_id = service.route_id "
+            + "WHERE route.agency_id = %s "
+            + "AND update_timestamp <= %s "
+            + "AND (valid_until IS NULL OR valid_until > %s) "
+            + "AND location IS NOT NULL "
+            + "ORDER BY service_id, stop_order",
+            (agency_id, end, end)
+        )
+        rows = cur.fetchall()
+    sequences = dict()
+    for [service_id, stop_id, lon, lat] in rows:
+        sequences.setdefault(service_id, [[], []])
+        sequences[service_id][0].append(stop_id)
+        sequences[service_id][1].append((lon, lat))
+    return dict(
+        (k, [v[0], np.array(v[1])]) for [k, v] in sequences.items()
+    )
+
+
+# Get an agency's vehicle locations between `start` (exclusive) and
+# `end` (inclusive).
+#
+# Return a dict from (key) service UUID -> (value) list with (1) the
+# array of vehicle tags, and the arrays of (2) each location's vehicle
+# code (its index in the tags array), (3) lon, (4) lat and (5) epoch
+# time, sorted by vehicle, then time.
+def load_positions(conn, agency_id, start, end):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT service_id, vehicle_tag, ST_X(vehicle_location), "
+            + "ST_Y(vehicle_location), "
+            + "EXTRACT(EPOCH FROM location_timestamp) "
+            + "FROM nextbus.vehicle_location "
+            + "INNER JOIN nextbus.service USING (service_id) "
+            + "INNER JOIN nextbus.route USING (route_id) "
+            + "WHERE agency_id = %s "
+            + "AND location_timestamp > %s AND location_timestamp <= %s "
+            + "ORDER BY service_id, vehicle_tag, location_timestamp",
+            (agency_id, start, end)
+        )
+        rows = cur.fetchall()
+    positions = dict()
+    if not rows:
+        return positions
+    services = [r[0] for r in rows]
+    tags = np.array([r[1] for r in rows], dtype=object)
+    coords = np.array([r[2:] for r in rows], dtype=float)
+    # Split the columns at each change of service.
+    bounds = [0] + [
+        i for i in range(1, len(rows)) if services[i] != services[i - 1]
+    ] + [len(rows)]
+    for [i, j] in zip(bounds[:-1], bounds[1:]):
+        [vehicle_tags, vehicle] = np.unique(tags[i:j], return_inverse=True)
+        positions[services[i]] = [
+            vehicle_tags, vehicle, coords[i:j, 0], coords[i:j, 1],
+            coords[i:j, 2]
+        ]
+    return positions
+
+
+# Infer an agency's stop arrivals from its vehicle locations between
+# `start` and `end`, keeping the arrivals after `after` (defaulting to
+# `start`).
+#
+# Return them as a list of (service UUID, stop UUID, vehicle tag,
+# arrival timestamp) tuples.
+def compute_arrivals(conn, agency_id, start, end, after=None):
+    if after is None:
+        after = start
+    after_t = (after - datetime.datetime(1970, 1, 1)).total_seconds()
+    sequences = load_stop_sequences(conn, agency_id, end)
+    positions = load_positions(conn, agency_id, start, end)
+    arrival_rows = []
+    for [service_id, [vehicle_tags, vehicle, lon, lat, t]] in (
+            positions.items()):
+        if service_id not in sequences:
+            continue
+        [stop_ids, stop_lonlat] = sequences[service_id]
+        [stop_index, vehicle_index, arrival_t] = infer_arrivals(
+            stop_lonlat, lon, lat, t, vehicle
+        )
+        keep = arrival_t > after_t
+        for [s, v, a] in zip(stop_index[keep], vehicle_index[keep],
+                             arrival_t[keep]):
+            arrival_rows.append((
+                service_id,
+                stop_ids[s],
+                vehicle_tags[v],
+                datetime.datetime.utcfromtimestamp(round(a, 3))
+            ))
+    return arrival_rows
+
+
+# Insert arrival rows, as returned by compute_arrivals, to
+# nextbus.stop_arrival, through COPY into a temp staging table. Arrivals
+# already in the table are skipped.
+#
+# Return the number of rows actually inserted.
+def insert_arrivals(conn, arrival_rows):
+    with conn.cursor() as cur:
+        cur.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS stop_arrival_stage ("
+            + "service_id UUID, stop_id UUID, vehicle_tag TEXT, "
+            + "arrival_timestamp TIMESTAMP)"
+        )
+        cur.execute("TRUNCATE stop_arrival_stage")
+        cur.copy_expert(
+            "COPY stop_arrival_stage FROM STDIN",
+            ingest.RowReader(arrival_rows)
+        )
+        cur.execute(
+            "INSERT INTO nextbus.stop_arrival "
+            + "(service_id, stop_id, vehicle_tag, arrival_timestamp) "
+            + "SELECT * FROM stop_arrival_stage "
+            + "ON CONFLICT DO NOTHING"
+        )
+        return cur.rowcount
+
+
+# Get an agency's arrivals watermark: the time up to which its arrivals
+# have been inferred. Return None if it has none yet.
+def get_watermark(conn, agency_id):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT watermark FROM nextbus.arrival_watermark "
+            + "WHERE agency_id = %s",
+            (agency_id,)
+        )
+        row = cur.fetchone()
+    return None if row is None else row[0]
+
+
+def set_watermark(conn, agency_id, watermark):
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO nextbus.arrival_watermark (agency_id, watermark) "
+            + "VALUES (%s, %s) "
+            + "ON CONFLICT (agency_id) "
+            + "DO UPDATE SET (watermark) = (EXCLUDED.watermark)",
+            (agency_id, watermark)
+        )
+
+
+# Infer an agency's new arrivals, since its watermark, from the vehicle
+# locations up to `settle` seconds ago (to let late rows arrive), then
+# move its watermark forward. Both are written in one transaction.
+#
+# An arrival needs a location on either side of it, no more than
+# MAX_GAP seconds apart, so locations are loaded from 2 * MAX_GAP
+# before the watermark, and the new watermark stops MAX_GAP short of
+# the last location loaded.
+#
+# Return the number of arrivals inserted.
+def update_arrivals(conn, agency_id, settle=300):
+    end = datetime.datetime.utcnow() - datetime.timedelta(seconds=settle)
+    watermark = get_watermark(conn, agency_id)
+    if watermark is None:
+        watermark = datetime.datetime.combine(
+            end.date() - datetime.timedelta(days=1), datetime.time()
+        )
+    new_watermark = end - datetime.timedelta(seconds=MAX_GAP)
+    if new_watermark <= watermark:
+        return 0
+    arrival_rows = [
+        ar for ar in compute_arrivals(
+            conn, agency_id,
+            watermark - datetime.timedelta(seconds=2 * MAX_GAP), end,
+            after=watermark
+        ) if ar[3] <= new_watermark
+    ]
+    with connect.transaction(conn):
+        inserted = insert_arrivals(conn, arrival_rows) if arrival_rows else 0
+        set_watermark(conn, agency_id, new_watermark)
+    return inserted
+
+
+if __name__ == '__main__':
+    sysargs = cli.getopts(sys.argv)
+    conn = connect.pgconnect(
+        pghost = sysargs['-h'],
+        pgdb   = sysargs['-d'],
+        pguser = sysargs['-U']
+    )
+    agency_id = sysargs['-a']
+    if '-s' in sysargs:
+        start = datetime.datetime.strptime(sysargs['-s'], '%Y-%m-%dT%H:%M:%S')
+        end = datetime.datetime.strptime(sysargs['-e'], '%Y-%m-%dT%H:%M:%S')
+        inserted = insert_arrivals(
+            conn, compute_arrivals(conn, agency_id, start, end)
+        )
+    else:
+        inserted = update_arrivals(
+            conn, agency_id, settle = float(sysargs.get('-S', '300'))
+        )
+    print('Inserted {0} arrivals for agency {1}'.format(inserted, agency_id))
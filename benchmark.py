@@ -0,0 +1,425 @@
+"""Benchmark parts of the nextbus2pg pipeline.
+
+Usage:
+  python benchmark.py -h HOST -d DB -U USER -b insert [-n SIZES]
+  python benchmark.py -b parse [-f FILE] [-n VEHICLES]
+  python benchmark.py -b arrivals [-R SERVICES] [-S STOPS] [-V VEHICLES]
+                      [-i REPORT_INTERVAL]
+  python benchmark.py -h HOST -d DB -U USER -b e2e [-R ROUTES] [-S STOPS]
+                      [-V VEHICLES] [-l LATENCY_MS] [-C CYCLES] [-r REST]
+                      [-w WORKERS] [-m MODE]
+
+Benchmarks:
+  insert  Compare the COPY-based vehicle_location write path against
+          the original mogrified VALUES statement, at batch sizes given
+          as a comma-separated list by -n (default 1000,10000,100000).
+
+  parse   Compare the streaming vehicleLocations parser against a full
+          etree parse, in time and peak memory, on the agency-wide
+          payload recorded in -f, or on a synthetic one with -n
+          vehicles (default 50000).
+
+  arrivals
+          Infer stop arrivals (see arrivals.py) from a synthetic day of
+          vehicle locations: -R services of -S stops, each run by -V
+          vehicles reporting every -i seconds (defaults 80, 40, 10 and
+          30), driving the line in an hour and laying over for 15
+          minutes at its end.
+
+  e2e     Run the whole pipeline, from update_agencies through
+          update_vehicle_locations, against a local NextBus simulator
+          (see simulator.py) with -R routes of -S stops and -V vehicles
+          per route, each response delayed by about -l ms. Poll -C
+          cycles, -r seconds apart, with the -w/-m polling options of
+          run.py. Report the time spent in each stage, the cycle latency
+          percentiles, and the vehicle rows written per second.
+
+Every benchmark that writes to the DB runs inside a transaction that is
+rolled back at the end, so nothing is left behind.
+"""
+
+import io
+import sys
+import time
+import uuid
+import datetime
+import timeit
+import resource
+import collections
+import multiprocessing
+
+import numpy as np
+from lxml import etree
+
+import arrivals
+import cli
+import connect
+import agency
+import ingest
+import partition
+import route
+import simulator
+
+
+# Create a throwaway agency, route and service to hang synthetic rows
+# on. Return the service's UUID.
+def create_fixture(conn):
+    route_id   = uuid.uuid4()
+    service_id = uuid.uuid4()
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO nextbus.agency (agency_id, name, region) "
+            + "VALUES ('benchmark', 'benchmark', 'benchmark')"
+        )
+        cur.execute(
+            "INSERT INTO nextbus.route (route_id, agency_id, tag, name) "
+            + "VALUES (%s, 'benchmark', 'benchmark', 'benchmark')",
+            (route_id,)
+        )
+        cur.execute(
+            "INSERT INTO nextbus.service (service_id, route_id, tag, "
+            + "name, direction, use_for_ui) "
+            + "VALUES (%s, %s, 'benchmark', 'benchmark', 'benchmark', TRUE)",
+            (service_id, route_id)
+        )
+    return service_id
+
+
+# Create `n` synthetic vehicle rows, shaped like the ones returned by
+# route.get_vehicle_locations.
+def synthetic_vehicle_rows(service_id, n):
+    start = datetime.datetime(2020, 1, 1)
+    return [(
+        service_id,
+        str(i % 1000),
+        '{0:.6f}'.format(-122.5 + (i % 997) * 0.0001),
+        '{0:.6f}'.format(37.7 + (i % 991) * 0.0001),
+        start + datetime.timedelta(seconds=i // 1000),
+        i % 2 == 0
+    ) for i in range(n)]
+
+
+# Time each vehicle_location write path at each batch size.
+def benchmark_insert(conn, sizes):
+    service_id = create_fixture(conn)
+    methods = [
+        ('values', ingest.insert_vehicle_rows_values),
+        ('copy', ingest.insert_vehicle_rows)
+    ]
+    print('{0:>8} {1:>8} {2:>10} {3:>12}'.format(
+        'rows', 'method', 'seconds', 'rows/s'
+    ))
+    for n in sizes:
+        vehicle_rows = synthetic_vehicle_rows(service_id, n)
+        # Create the partitions the rows fall in, inside the transaction
+        # to be rolled back.
+        partition.create_partitions(
+            conn, vehicle_rows[0][4].date(), vehicle_rows[-1][4].date()
+        )
+        for [name, insert] in methods:
+            with conn.cursor() as cur:
+                cur.execute("SAVEPOINT benchmark")
+            start = timeit.default_timer()
+            insert(conn, vehicle_rows)
+            elapsed = timeit.default_timer() - start
+            with conn.cursor() as cur:
+                cur.execute("ROLLBACK TO SAVEPOINT benchmark")
+            print('{0:>8} {1:>8} {2:>10.3f} {3:>12.0f}'.format(
+                n, name, elapsed, n / elapsed
+            ))
+
+
+# Create a synthetic agency-wide "vehicleLocations" payload with
+# `n_vehicles` vehicles spread over `n_routes` routes.
+def synthetic_vehicle_xml(n_vehicles, n_routes=100):
+    lines = ['<?xml version="1.0" encoding="utf-8" ?>', '<body copyright="">']
+    for i in range(n_vehicles):
+        lines.append(
+            '<vehicle id="{0}" routeTag="{1}" dirTag="{1}_{2}" '
+            'lat="{3:.6f}" lon="{4:.6f}" secsSinceReport="{5}" '
+            'predictable="true" heading="90" speedKmHr="0"/>'.format(
+                i, i % n_routes, i % 2,
+                37.7 + (i % 991) * 0.0001, -122.5 + (i % 997) * 0.0001,
+                i % 60
+            )
+        )
+    lines.append('<lastTime time="1577836800000"/>')
+    lines.append('</body>')
+    return '\n'.join(lines).encode('utf-8')
+
+
+# Parse a "vehicleLocations" payload the way route.py did before it
+# streamed: build the whole tree, then walk it, converting each
+# vehicle's timestamp separately.
+def parse_vehicle_locations_tree(vehicle_xml, route_service_dicts):
+    vehicle_etree = etree.fromstring(vehicle_xml)
+    request_datetime = datetime.datetime.utcfromtimestamp(
+        round(float(vehicle_etree.find('lastTime').get('time')) / 1000)
+    )
+    vehicle_rows = []
+    for i in vehicle_etree.iter('vehicle'):
+        try:
+            service_id = route_service_dicts[i.get('routeTag')][i.get('dirTag')]
+        except KeyError:
+            continue
+        vehicle_rows.append((
+            service_id,
+            i.get('id'),
+            i.get('lon'),
+            i.get('lat'),
+            request_datetime - datetime.timedelta(
+                seconds=float(i.get('secsSinceReport'))
+            ),
+            i.get('predictable') == 'true'
+        ))
+    return vehicle_rows
+
+
+# Build a route tag -> service tag -> UUID index covering every route
+# and direction in a "vehicleLocations" payload.
+def payload_route_service_dicts(vehicle_xml):
+    route_service_dicts = dict()
+    for i in etree.fromstring(vehicle_xml).iter('vehicle'):
+        route_service_dicts.setdefault(i.get('routeTag'), dict()).setdefault(
+            i.get('dirTag'), uuid.uuid4()
+        )
+    return route_service_dicts
+
+
+# Parse a payload with one of the parsers, in a child process so that
+# its peak memory can be measured on its own. Send back the number of
+# rows, the elapsed time and the peak RSS (in KiB on Linux).
+def run_parser(name, vehicle_xml, route_service_dicts, results):
+    start = timeit.default_timer()
+    if name == 'tree':
+        vehicle_rows = parse_vehicle_locations_tree(
+            vehicle_xml, route_service_dicts
+        )
+    else:
+        [vehicle_rows, this_request] = route.parse_vehicle_locations(
+            vehicle_source=io.BytesIO(vehicle_xml),
+            agency_id='benchmark',
+            service_dict=dict(),
+            route_service_dicts=route_service_dicts
+        )
+    elapsed = timeit.default_timer() - start
+    results.put((
+        len(vehicle_rows),
+        elapsed,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ))
+
+
+# Time each vehicleLocations parser on the same payload, and measure
+# its peak memory.
+def benchmark_parse(vehicle_xml):
+    route_service_dicts = payload_route_service_dicts(vehicle_xml)
+    context = multiprocessing.get_context('fork')
+    print('{0:>10} {1:>8} {2:>10} {3:>12} {4:>14}'.format(
+        'bytes', 'parser', 'rows', 'seconds', 'peak RSS KiB'
+    ))
+    for name in ['tree', 'stream']:
+        results = context.Queue()
+        child = context.Process(
+            target=run_parser,
+            args=(name, vehicle_xml, route_service_dicts, results)
+        )
+        child.start()
+        [n_rows, elapsed, max_rss] = results.get()
+        child.join()
+        print('{0:>10} {1:>8} {2:>10} {3:>12.3f} {4:>14}'.format(
+            len(vehicle_xml), name, n_rows, elapsed, max_rss
+        ))
+
+
+# Create a synthetic day of one service's vehicle locations: a straight
+# line of `n_stops` stops about 400 m apart, driven end to end in an
+# hour by each of `n_vehicles` vehicles, with a 15 minute layover at
+# its end. Each location has about 10 m of GPS noise.
+#
+# Return a list with the (S, 2) array of the stops' lon/lat, and the
+# arrays of the locations' lon, lat, epoch time and vehicle code, sorted
+# by vehicle, then time.
+def synthetic_service_day(rng, n_stops, n_vehicles, report_interval):
+    [lon0, lat0] = [-122.5 + rng.uniform(0, 0.1), 37.7 + rng.uniform(0, 0.1)]
+    angle = rng.uniform(0, 2 * np.pi)
+    step = 0.0036 * np.array([np.cos(angle), np.sin(angle)])
+    stop_lonlat = np.array([lon0, lat0]) + np.arange(n_stops)[:, None] * step
+    [drive, layover] = [3600.0, 900.0]
+    t = np.arange(0, 86400, report_interval, dtype=float)
+    [lon, lat, times, vehicle] = [[], [], [], []]
+    for v in range(n_vehicles):
+        phase = (t + v * (drive + layover) / n_vehicles) % (drive + layover)
+        progress = np.minimum(phase / drive, 1.0) * (n_stops - 1)
+        lonlat = stop_lonlat[0] + progress[:, None] * step
+        lonlat += rng.normal(0, 0.0001, lonlat.shape)
+        lon.append(lonlat[:, 0])
+        lat.append(lonlat[:, 1])
+        times.append(t + rng.uniform(0, report_interval))
+        vehicle.append(np.full(len(t), v))
+    return [stop_lonlat] + [np.concatenate(c) for c in [lon, lat, times,
+                                                        vehicle]]
+
+
+# Time the inference of stop arrivals on a synthetic day of vehicle
+# locations of `n_services` services.
+def benchmark_arrivals(n_services, n_stops, n_vehicles, report_interval):
+    rng = np.random.RandomState(0)
+    days = [
+        synthetic_service_day(rng, n_stops, n_vehicles, report_interval)
+        for s in range(n_services)
+    ]
+    n_points = sum(len(d[3]) for d in days)
+    start = timeit.default_timer()
+    n_arrivals = 0
+    for [stop_lonlat, lon, lat, t, vehicle] in days:
+        [stop_index, vehicle_index, arrival_t] = arrivals.infer_arrivals(
+            stop_lonlat, lon, lat, t, vehicle
+        )
+        n_arrivals += len(arrival_t)
+    elapsed = timeit.default_timer() - start
+    # Each vehicle passes every stop but the first on each trip.
+    trips = 86400 / 4500.0 * n_vehicles * n_services
+    print('{0} locations -> {1} arrivals (about {2:.0f} expected) in '
+          '{3:.3f}s: {4:.0f} locations/s'.format(
+              n_points, n_arrivals, trips * (n_stops - 1), elapsed,
+              n_points / elapsed
+          ))
+
+
+# Get the `p`th percentile of a list of numbers, by nearest rank.
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+
+# Run the pipeline against a local simulator of `sim_agency`, timing
+# each stage.
+def benchmark_e2e(conn, sim_agency, latency, cycles, rest, poll_options):
+    [server, base_url] = simulator.start_simulator(
+        sim_agency, latency=latency, jitter=latency / 2
+    )
+    route.BASE_URL = base_url
+    agency_id = sim_agency.agency_id
+    # From (key) stage -> (value) list of durations in seconds.
+    timings = collections.OrderedDict()
+
+    def timed(stage, func, *args, **kwargs):
+        start = timeit.default_timer()
+        result = func(*args, **kwargs)
+        timings.setdefault(stage, []).append(timeit.default_timer() - start)
+        return result
+
+    try:
+        # The daily update.
+        timeout = poll_options['timeout']
+        timed('update_agencies', agency.update_agencies, conn, timeout)
+        partition.maintain_partitions(conn, datetime.datetime.utcnow().date())
+        routes = timed('get_routes', agency.get_routes, agency_id, timeout)
+        timed('update_routes', agency.update_routes, conn, routes)
+        [route_configs, snapshots, failed_routes] = timed(
+            'get_route_configs', agency.get_route_configs, agency_id, routes,
+            timeout=timeout
+        )
+        route_configs = agency.bind_route_configs(
+            conn, agency_id, route_configs
+        )
+        timed('update_services', agency.update_services, conn, route_configs)
+        timed('update_stops', agency.update_stops, conn, route_configs)
+        timed(
+            'update_service_stop_orders',
+            agency.update_service_stop_orders, conn, route_configs
+        )
+        agency.refresh_dimensions(conn, agency_id)
+        # The polling loop.
+        request_times = dict()
+        cycle_times = []
+        n_rows = 0
+        for c in range(cycles):
+            start = timeit.default_timer()
+            [vehicle_rows, request_times] = timed(
+                'get_vehicle_locations', agency.get_vehicle_locations,
+                conn, agency_id, request_times,
+                max_workers=poll_options['workers'],
+                timeout=timeout,
+                agency_wide=poll_options['agency_wide']
+            )
+            timed(
+                'write_vehicle_rows', ingest.write_vehicle_rows,
+                conn, agency_id, vehicle_rows
+            )
+            cycle_times.append(timeit.default_timer() - start)
+            n_rows += len(vehicle_rows)
+            time.sleep(rest)
+    finally:
+        server.shutdown()
+    print('{0:>28} {1:>6} {2:>10} {3:>10}'.format(
+        'stage', 'calls', 'total s', 'mean s'
+    ))
+    for [stage, durations] in timings.items():
+        print('{0:>28} {1:>6} {2:>10.3f} {3:>10.3f}'.format(
+            stage, len(durations), sum(durations),
+            sum(durations) / len(durations)
+        ))
+    print('cycle latency p50/p95/p99: {0:.3f}s / {1:.3f}s / {2:.3f}s'.format(
+        percentile(cycle_times, 50),
+        percentile(cycle_times, 95),
+        percentile(cycle_times, 99)
+    ))
+    print('{0} vehicle rows in {1} cycles: {2:.0f} rows/s'.format(
+        n_rows, cycles, n_rows / sum(cycle_times)
+    ))
+
+
+if __name__ == '__main__':
+    sysargs = cli.getopts(sys.argv)
+    # Benchmarks that don't need the DB.
+    if sysargs['-b'] == 'parse':
+        if '-f' in sysargs:
+            with open(sysargs['-f'], 'rb') as f:
+                vehicle_xml = f.read()
+        else:
+            vehicle_xml = synthetic_vehicle_xml(int(sysargs.get('-n', '50000')))
+        benchmark_parse(vehicle_xml)
+        sys.exit()
+    if sysargs['-b'] == 'arrivals':
+        benchmark_arrivals(
+            n_services = int(sysargs.get('-R', '80')),
+            n_stops = int(sysargs.get('-S', '40')),
+            n_vehicles = int(sysargs.get('-V', '10')),
+            report_interval = float(sysargs.get('-i', '30'))
+        )
+        sys.exit()
+    conn = connect.pgconnect(
+        pghost = sysargs['-h'],
+        pgdb   = sysargs['-d'],
+        pguser = sysargs['-U']
+    )
+    # Run everything in one transaction, to be rolled back at the end.
+    conn.autocommit = False
+    try:
+        if sysargs['-b'] == 'insert':
+            sizes = [
+                int(n) for n in sysargs.get('-n', '1000,10000,100000').split(',')
+            ]
+            benchmark_insert(conn, sizes)
+        elif sysargs['-b'] == 'e2e':
+            sim_agency = simulator.SyntheticAgency(
+                n_routes = int(sysargs.get('-R', '80')),
+                n_stops = int(sysargs.get('-S', '40')),
+                n_vehicles = int(sysargs.get('-V', '10')),
+                report_interval = 5
+            )
+            benchmark_e2e(
+                conn,
+                sim_agency,
+                latency = float(sysargs.get('-l', '50')) / 1000,
+                cycles = int(sysargs.get('-C', '20')),
+                rest = float(sysargs.get('-r', '1')),
+                poll_options = cli.poll_options(sysargs)
+            )
+        else:
+            sys.exit('Unknown benchmark: ' + sysargs['-b'])
+    finally:
+        conn.rollback()
+        conn.close()
@@ -0,0 +1,151 @@
+import adaptive
+import agency
+import archive
+import ingest
+import livestate
+import metrics
+import route
+
+
+# Create a dict from the sys args.
+# Credit goes entirely to https://gist.github.com/dideler/2395703.
+def getopts(argv):
+    # Empty dictionary to store key-value pairs.
+    opts = {}
+    # While there are arguments left to parse...
+    while argv:
+        # Found a "-name value" pair.
+        if argv[0][0] == '-':
+            # Add key and value to the dictionary.
+            opts[argv[0]] = argv[1]
+        # Reduce the argument list by copying it starting from index 1.
+        argv = argv[1:]
+    return opts
+
+
+# Extract the options shared by every agency's polling loop from the
+# sysargs. Return them as keyword arguments for pipeline.poll_agency.
+#   -w: poll routes concurrently with up to this many workers.
+#   -t: time out each NextBus request after this many seconds.
+#   -m: `agency` polls the whole agency with one request per cycle;
+#       the default, `route`, polls each route.
+#   -X: poll routes adaptively, backing routes without vehicles off to
+#       as slow as once every this many seconds.
+# Also cap the rate of NextBus requests of the whole process.
+#   -Q: make at most this many requests per second.
+def poll_options(sysargs):
+    if '-Q' in sysargs:
+        route.LIMITER = adaptive.RateLimiter(float(sysargs['-Q']))
+    timeout = sysargs.get('-t')
+    max_interval = sysargs.get('-X')
+    return {
+        'workers': int(sysargs.get('-w', '1')),
+        'timeout': float(timeout) if timeout is not None else None,
+        'agency_wide': sysargs.get('-m', 'route') == 'agency',
+        'max_interval': (
+            float(max_interval) if max_interval is not None else None
+        )
+    }
+
+
+# Extract the ingest queue options from the sysargs. Return a list with
+# (1) an ingest.IngestQueue, or None if vehicle rows should be written
+# inline, and (2) keyword arguments for ingest.start_writer.
+#   -q: queue up to this many rows between fetchers and the writer.
+#   -b: the backpressure policy for a full queue: `block` (default),
+#       `drop-oldest`, or `spill`.
+#   -s: the directory to spill batches to, with `-b spill`. Batches
+#       left there by a previous run are written first.
+#   -n: write batches of up to this many rows (default 10000)...
+#   -g: ...or of rows queued for up to this many seconds (default 5).
+# Each batch is written in a single transaction, so -n and -g also
+# bound how many poll cycles share one commit.
+#   -x: the directory to set aside batches that still fail to be
+#       written after 5 tries (default `dead-letter`).
+# Also resize the cache of last written vehicle reports, and set how
+# vehicle rows are committed.
+#   -c: remember up to this many vehicles' reports (default 100000).
+#   -y: `off` commits vehicle rows with synchronous_commit off.
+def ingest_options(sysargs):
+    ingest.REPORT_CACHE.max_size = int(sysargs.get('-c', '100000'))
+    ingest.SYNCHRONOUS_COMMIT = sysargs.get('-y', 'on') != 'off'
+    if '-q' not in sysargs:
+        return [None, {}]
+    ingest_queue = ingest.IngestQueue(
+        int(sysargs['-q']),
+        policy = sysargs.get('-b', 'block'),
+        spill_dir = sysargs.get('-s')
+    )
+    return [ingest_queue, {
+        'max_rows': int(sysargs.get('-n', '10000')),
+        'max_age': float(sysargs.get('-g', '5')),
+        'dead_letter_dir': sysargs.get('-x', 'dead-letter')
+    }]
+
+
+# Extract the vehicle_location partition maintenance options from the
+# sysargs. Return them as keyword arguments for
+# partition.maintain_partitions.
+#   -P: create partitions this many days ahead (default 3).
+#   -R: retire partitions older than this many days (default: never).
+#   -D: `detach` retired partitions instead of dropping them.
+#   -I: partition by `day` (default) or by `month`.
+#   -K: `exported` keeps partitions holding days not yet exported by
+#       export.py, whatever their age.
+def partition_options(sysargs):
+    retention_days = sysargs.get('-R')
+    return {
+        'days_ahead': int(sysargs.get('-P', '3')),
+        'retention_days': (
+            int(retention_days) if retention_days is not None else None
+        ),
+        'detach': sysargs.get('-D') == 'detach',
+        'interval': sysargs.get('-I', 'day'),
+        'keep_unexported': sysargs.get('-K') == 'exported'
+    }
+
+
+# Set how failing NextBus requests are retried.
+#   -e: retry each failed request up to this many times (default 2),
+#       with exponential backoff and jitter.
+#   -o: skip a route whose vehicleLocations requests keep failing for
+#       this many seconds (default 60), doubling on each repeat.
+def configure_retries(sysargs):
+    route.RETRIES = int(sysargs.get('-e', '2'))
+    agency.ROUTE_BREAKER.cooldown = float(sysargs.get('-o', '60'))
+
+
+# Keep the latest report of every vehicle, if asked to.
+#   -H: keep them in memory, and serve them as JSON on this port of
+#       127.0.0.1 (see livestate.start_http_server).
+#   -E: expire vehicles that haven't reported for this many seconds
+#       (default 300).
+#   -W: `on` also upserts them to nextbus.vehicle_latest.
+def configure_livestate(sysargs):
+    if '-H' in sysargs:
+        livestate.STATE = livestate.LiveState(
+            max_age = float(sysargs.get('-E', '300'))
+        )
+        livestate.start_http_server(livestate.STATE, int(sysargs['-H']))
+    ingest.WRITE_LATEST = sysargs.get('-W') == 'on'
+
+
+# Start archiving every raw NextBus response, if asked to.
+#   -A: append the responses to rotating segment files in this
+#       directory. Replay them with replay.py.
+def configure_archive(sysargs):
+    if '-A' in sysargs:
+        route.ARCHIVE = archive.FeedArchive(sysargs['-A'])
+
+
+# Start recording metrics, if asked to.
+#   -M: serve them in the Prometheus text format on this port, at
+#       /metrics.
+#   -L: print them as a JSON log line every this many seconds.
+def configure_metrics(sysargs):
+    if '-M' in sysargs or '-L' in sysargs:
+        metrics.ENABLED = True
+    if '-M' in sysargs:
+        metrics.start_http_server(int(sysargs['-M']))
+    if '-L' in sysargs:
+        metrics.start_log_reporter(float(sysargs['-L']))
@@ -1,14 +1,106 @@
 import urllib
+import contextlib
 
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
+import psycopg2.pool
+
+
+# A postgres connection that keeps track of the statements prepared on
+# it (see prepare).
+class Connection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super(Connection, self).__init__(*args, **kwargs)
+        self.prepared = set()
 
 
 # Connect to a postgres database. Tweak some things.
 def pgconnect(pghost, pgdb, pguser):
-    connection = psycopg2.connect(host = pghost, dbname = pgdb, user = pguser)
+    connection = psycopg2.connect(
+        host = pghost, dbname = pgdb, user = pguser,
+        connection_factory = Connection
+    )
     # Set autocommit to avoid repetitive connection.commit() statements.
     connection.autocommit = True
     # Register the UUID adapter globally.
     psycopg2.extras.register_uuid()
     return connection
+
+
+# Create a thread-safe pool of up to `maxconn` connections to a postgres
+# database, to be shared by several pollers in one process.
+def pgpool(pghost, pgdb, pguser, maxconn):
+    pool = psycopg2.pool.ThreadedConnectionPool(
+        1, maxconn, host = pghost, dbname = pgdb, user = pguser,
+        connection_factory = Connection
+    )
+    # Register the UUID adapter globally.
+    psycopg2.extras.register_uuid()
+    return pool
+
+
+# Borrow a connection from a pool for the duration of a `with` block,
+# tweaked the same way as pgconnect's.
+#
+# If the block fails and leaves the connection broken, it is discarded
+# rather than returned to the pool.
+@contextlib.contextmanager
+def pooled(pool):
+    connection = pool.getconn()
+    try:
+        connection.autocommit = True
+        yield connection
+    finally:
+        pool.putconn(connection, close = bool(connection.closed))
+
+
+# Run a `with` block in a single transaction on a connection set to
+# autocommit: commit if the block succeeds, and roll back if it fails.
+#
+# If the connection is already in a transaction managed by the caller
+# (autocommit off), the block simply runs as part of it.
+@contextlib.contextmanager
+def transaction(connection):
+    if not connection.autocommit:
+        yield connection
+        return
+    connection.autocommit = False
+    try:
+        yield connection
+        connection.commit()
+    except:
+        if not connection.closed:
+            connection.rollback()
+            forget_prepared(connection)
+        raise
+    finally:
+        if not connection.closed:
+            connection.autocommit = True
+
+
+# Prepare `statement` as `name` on a connection, unless it already has
+# been. Run it with "EXECUTE name (...)".
+#
+# Statements that run on every poll are prepared once per connection,
+# so they're only parsed and planned once.
+def prepare(connection, name, statement):
+    if name in connection.prepared:
+        return
+    with connection.cursor() as cur:
+        cur.execute('PREPARE ' + name + ' AS ' + statement)
+    connection.prepared.add(name)
+
+
+# Drop the statements prepared on a connection, e.g. after a rollback
+# may have dropped a temp table they refer to.
+def forget_prepared(connection):
+    if not connection.prepared:
+        return
+    connection.prepared.clear()
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cur:
+            cur.execute('DEALLOCATE ALL')
+    except psycopg2.Error:
+        pass
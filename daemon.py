@@ -0,0 +1,107 @@
+"""Run the nextbus2pg pipeline for several agencies from one process:
+  1. Create a pool of DB connections.
+  2. Update the nextbus agency list.
+  3. For each agency passed as a sysarg, in its own thread, run the
+     same loop as run.py, with the agency's own poll interval and
+     timezone.
+
+Agencies are passed with the `-a` flag as a comma-separated list of
+`agency:timezone:resttime` entries, e.g.
+
+  -a sf-muni:America/Los_Angeles:5,lametro:America/Los_Angeles:10
+
+All agencies share one HTTP session and one DB connection pool, but
+each keeps its own vehicleLocations request times. If an agency's loop
+fails, it is restarted after a short rest without affecting the others.
+With `-q`, all agencies' rows go through one bounded queue to a single
+writer thread (see cli.py for the queue options).
+"""
+
+# PLEASE TAKE NOTE
+#
+# Since this script loops infinitely, it's up to the user to kill the
+# process. PLEASE REMEMBER TO KILL THE SCRIPT before you exhaust your
+# storage or rack up crazy $$$ on a DB instance.
+
+import sys
+import pytz
+import threading
+import traceback
+from time import sleep
+
+import cli
+import connect
+import agency
+import ingest
+import pipeline
+import route
+
+
+# Parse the `-a` sysarg into a list of (agency_id, timezone, resttime)
+# tuples.
+def parse_agencies(agencies_arg):
+    agencies = []
+    for entry in agencies_arg.split(','):
+        [agency_id, tzone, resttime] = entry.split(':')
+        agencies.append((agency_id, pytz.timezone(tzone), float(resttime)))
+    return agencies
+
+
+# Run an agency's polling loop, restarting it after `restart_rest`
+# seconds whenever it fails, so that one failing agency never brings
+# down the others.
+def supervise(pool, agency_id, user_tz, resttime, restart_rest=60,
+              **kwargs):
+    while True:
+        try:
+            pipeline.poll_agency(pool, agency_id, user_tz, resttime, **kwargs)
+        except Exception:
+            print("Polling failed for agency " + agency_id + ":")
+            traceback.print_exc()
+            sleep(restart_rest)
+
+
+if __name__ == '__main__':
+    # Process the sysargs.
+    sysargs = cli.getopts(sys.argv)
+    agencies = parse_agencies(sysargs['-a'])
+    # Extract the polling, partitioning and ingest queue options. See cli.py.
+    poll_options = cli.poll_options(sysargs)
+    poll_options['partition_options'] = cli.partition_options(sysargs)
+    [ingest_queue, writer_options] = cli.ingest_options(sysargs)
+    cli.configure_retries(sysargs)
+    cli.configure_livestate(sysargs)
+    cli.configure_archive(sysargs)
+    cli.configure_metrics(sysargs)
+
+    # Create the DB connection pool. Each agency holds at most one
+    #   connection at a time, as does the writer if rows are queued.
+    pool = connect.pgpool(
+        pghost  = sysargs['-h'],
+        pgdb    = sysargs['-d'],
+        pguser  = sysargs['-U'],
+        maxconn = len(agencies) + (0 if ingest_queue is None else 1)
+    )
+    # Make sure the shared HTTP session can keep a connection alive for
+    #   every worker of every agency.
+    route.resize_session(max(poll_options['workers'] * len(agencies), 10))
+    # If rows are queued, start the single writer that drains every
+    #   agency's rows into the DB.
+    if ingest_queue is not None:
+        ingest.start_writer(ingest_queue, pool, **writer_options)
+
+    # Update the nextbus agency list.
+    with connect.pooled(pool) as conn:
+        agency.update_agencies(conn, timeout = poll_options['timeout'])
+    # Start one polling thread per agency.
+    threads = [threading.Thread(
+        target = supervise,
+        args = (pool, agency_id, user_tz, resttime),
+        kwargs = dict(poll_options, ingest_queue = ingest_queue),
+        name = agency_id,
+        daemon = True
+    ) for [agency_id, user_tz, resttime] in agencies]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
@@ -0,0 +1,258 @@
+"""Export closed days of vehicle locations to columnar files:
+  1. Connect to the DB.
+  2. For each agency passed as a sysarg, find the days not exported yet:
+     from the day after its watermark in nextbus.export_watermark (or
+     from `-s`, or from its first vehicle location) through the last
+     closed day, i.e. the last one that ended `-S` hours ago (default 1).
+  3. Write each day's vehicle locations, with their route, service and
+     vehicle tags and plain lon/lat columns, to
+     OUTPUT_DIR/agency=AGENCY/date=YYYY-MM-DD/vehicle_location.parquet
+     (or .arrow), then move the agency's watermark to that day.
+
+Each file is written under a temporary name and renamed once complete,
+so readers never see a partial file, and a day is only marked exported
+once its file is in place. Days already exported can then be dropped
+from Postgres: run the pollers with `-R DAYS -K exported` to retire
+only the partitions whose days have all been exported.
+
+Parquet files are compressed with zstd (or `-c`), one row group per
+batch of rows. Arrow IPC files are uncompressed by default, so that they
+can be memory-mapped without copying; see read_export.
+
+Needs pyarrow.
+
+Usage:
+  python export.py -h HOST -d DB -U USER -a AGENCY[,AGENCY...]
+                   -o OUTPUT_DIR [-f parquet|arrow] [-c COMPRESSION]
+                   [-s START_DATE] [-S SETTLE_HOURS] [-n BATCH_ROWS]
+"""
+
+import os
+import sys
+import datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+import cli
+import connect
+
+
+# The columns of an exported file, in order.
+#
+# Tags are plain strings: Parquet dictionary-encodes them on its own,
+# and an Arrow IPC file can't change a dictionary between batches.
+def export_schema():
+    return pa.schema([
+        ('route_tag', pa.string()),
+        ('service_tag', pa.string()),
+        ('vehicle_tag', pa.string()),
+        ('lon', pa.float64()),
+        ('lat', pa.float64()),
+        ('location_timestamp', pa.timestamp('us')),
+        ('is_predictable', pa.bool_())
+    ])
+
+
+# The file formats an export can be written in, from (key) format ->
+# (value) file name, and their default compression.
+FORMATS = {
+    'parquet': 'vehicle_location.parquet',
+    'arrow': 'vehicle_location.arrow'
+}
+DEFAULT_COMPRESSION = {
+    'parquet': 'zstd',
+    'arrow': None
+}
+
+
+# Get the path of the file holding an agency's vehicle locations of the
+# date `d`.
+def export_path(output_dir, agency_id, d, fmt='parquet'):
+    return os.path.join(
+        output_dir,
+        'agency=' + agency_id,
+        'date=' + d.isoformat(),
+        FORMATS[fmt]
+    )
+
+
+# Build a record batch from a list of exported rows.
+def rows_to_batch(rows, schema):
+    columns = list(zip(*rows))
+    return pa.RecordBatch.from_arrays([
+        pa.array(columns[0], pa.string()),
+        pa.array(columns[1], pa.string()),
+        pa.array(columns[2], pa.string()),
+        pa.array(columns[3], pa.float64()),
+        pa.array(columns[4], pa.float64()),
+        pa.array(columns[5], pa.timestamp('us')),
+        pa.array(columns[6], pa.bool_())
+    ], schema=schema)
+
+
+# Export an agency's vehicle locations of the UTC date `d` to a file.
+#
+# Rows are read through a server-side cursor and written `batch_rows`
+# at a time, so memory use doesn't grow with the size of the day.
+#
+# Return the number of rows exported. If there are none, no file is
+# written.
+def export_day(conn, agency_id, d, output_dir, fmt='parquet',
+               compression=None, batch_rows=100000):
+    if compression is None:
+        compression = DEFAULT_COMPRESSION[fmt]
+    path = export_path(output_dir, agency_id, d, fmt)
+    partial_path = path + '.part'
+    schema = export_schema()
+    writer = None
+    n_rows = 0
+    with connect.transaction(conn):
+        with conn.cursor(name='export_vehicle_location') as cur:
+            cur.itersize = batch_rows
+            cur.execute(
+                "SELECT route.tag, service.tag, vehicle_tag, "
+                + "ST_X(vehicle_location), ST_Y(vehicle_location), "
+                + "location_timestamp, is_predictable "
+                + "FROM nextbus.vehicle_location "
+                + "INNER JOIN nextbus.service USING (service_id) "
+                + "INNER JOIN nextbus.route USING (route_id) "
+                + "WHERE agency_id = %s "
+                + "AND location_timestamp >= %s AND location_timestamp < %s "
+                + "ORDER BY location_timestamp",
+                (agency_id, d, d + datetime.timedelta(days=1))
+            )
+            try:
+                while True:
+                    rows = cur.fetchmany(batch_rows)
+                    if not rows:
+                        break
+                    if writer is None:
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        if fmt == 'parquet':
+                            writer = pa.parquet.ParquetWriter(
+                                partial_path, schema,
+                                compression=compression or 'none'
+                            )
+                        else:
+                            writer = pa.ipc.new_file(
+                                partial_path, schema,
+                                options=pa.ipc.IpcWriteOptions(
+                                    compression=compression
+                                )
+                            )
+                    batch = rows_to_batch(rows, schema)
+                    if fmt == 'parquet':
+                        writer.write_table(pa.Table.from_batches([batch]))
+                    else:
+                        writer.write_batch(batch)
+                    n_rows += len(rows)
+            finally:
+                if writer is not None:
+                    writer.close()
+    if writer is not None:
+        os.replace(partial_path, path)
+    return n_rows
+
+
+# Read an exported file back as a pyarrow Table, memory-mapping it.
+def read_export(path):
+    if path.endswith('.arrow'):
+        return pa.ipc.open_file(pa.memory_map(path)).read_all()
+    return pa.parquet.read_table(path, memory_map=True)
+
+
+# Get the last date through which an agency's vehicle locations have
+# been exported. Return None if none have.
+def get_watermark(conn, agency_id):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT exported_through FROM nextbus.export_watermark "
+            + "WHERE agency_id = %s",
+            (agency_id,)
+        )
+        row = cur.fetchone()
+    return None if row is None else row[0]
+
+
+def set_watermark(conn, agency_id, d):
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO nextbus.export_watermark "
+            + "(agency_id, exported_through) VALUES (%s, %s) "
+            + "ON CONFLICT (agency_id) "
+            + "DO UPDATE SET (exported_through) = (EXCLUDED.exported_through)",
+            (agency_id, d)
+        )
+
+
+# Get the date of an agency's first vehicle location. Return None if it
+# has none.
+def first_date(conn, agency_id):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT min(location_timestamp) "
+            + "FROM nextbus.vehicle_location "
+            + "INNER JOIN nextbus.service USING (service_id) "
+            + "INNER JOIN nextbus.route USING (route_id) "
+            + "WHERE agency_id = %s",
+            (agency_id,)
+        )
+        first = cur.fetchone()[0]
+    return None if first is None else first.date()
+
+
+# Export each of an agency's closed days not exported yet (see the
+# docstring above), moving its watermark after each day.
+#
+# Return a list of (date, number of rows) tuples, one per day exported.
+def export_agency(conn, agency_id, output_dir, fmt='parquet',
+                  compression=None, start=None, settle_hours=1,
+                  batch_rows=100000):
+    if pa is None:
+        raise RuntimeError('Exporting vehicle locations needs pyarrow')
+    watermark = get_watermark(conn, agency_id)
+    if watermark is not None:
+        d = watermark + datetime.timedelta(days=1)
+    else:
+        d = start or first_date(conn, agency_id)
+    if d is None:
+        return []
+    last_closed = (
+        datetime.datetime.utcnow() - datetime.timedelta(hours=settle_hours)
+    ).date() - datetime.timedelta(days=1)
+    exported = []
+    while d <= last_closed:
+        n_rows = export_day(conn, agency_id, d, output_dir, fmt,
+                            compression, batch_rows)
+        set_watermark(conn, agency_id, d)
+        exported.append((d, n_rows))
+        d += datetime.timedelta(days=1)
+    return exported
+
+
+if __name__ == '__main__':
+    sysargs = cli.getopts(sys.argv)
+    conn = connect.pgconnect(
+        pghost = sysargs['-h'],
+        pgdb   = sysargs['-d'],
+        pguser = sysargs['-U']
+    )
+    fmt = sysargs.get('-f', 'parquet')
+    start = sysargs.get('-s')
+    if start is not None:
+        start = datetime.datetime.strptime(start, '%Y-%m-%d').date()
+    for agency_id in sysargs['-a'].split(','):
+        for [d, n_rows] in export_agency(
+                conn, agency_id, sysargs['-o'], fmt,
+                compression = sysargs.get('-c'),
+                start = start,
+                settle_hours = float(sysargs.get('-S', '1')),
+                batch_rows = int(sysargs.get('-n', '100000'))):
+            print('Exported {0} rows of agency {1} on {2}'.format(
+                n_rows, agency_id, d.isoformat()
+            ))
@@ -0,0 +1,579 @@
+import os
+import glob
+import pickle
+import datetime
+import itertools
+import threading
+import traceback
+import collections
+from time import sleep, monotonic
+
+import psycopg2
+
+import connect
+import livestate
+import metrics
+
+
+# Create the session-local staging table that vehicle rows are COPYed
+# into before being deduplicated into nextbus.vehicle_location.
+#
+# Location is staged as plain lon/lat columns; the postgis point is
+# built set-wise on the way out.
+STAGE_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS vehicle_location_stage (
+        service_id         UUID,
+        vehicle_tag        TEXT,
+        lon                DOUBLE PRECISION,
+        lat                DOUBLE PRECISION,
+        location_timestamp TIMESTAMP,
+        is_predictable     BOOLEAN
+    )
+"""
+
+# Move the staged rows into nextbus.vehicle_location, keeping one row
+# per (service_id, vehicle_tag, location_timestamp).
+#
+# Rows already in the table are skipped by the matching unique index.
+# The statement is prepared once per connection, as vehicle_location_dedupe.
+DEDUPE_SQL = """
+    INSERT INTO nextbus.vehicle_location
+            (service_id, vehicle_tag, vehicle_location,
+             location_timestamp, is_predictable)
+        SELECT DISTINCT ON (service_id, vehicle_tag, location_timestamp)
+            service_id,
+            vehicle_tag,
+            ST_SetSRID(ST_MakePoint(lon, lat), 4326),
+            location_timestamp,
+            is_predictable
+        FROM vehicle_location_stage
+        ON CONFLICT DO NOTHING
+"""
+
+
+# Format one value for postgres' COPY text format.
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+
+# A read-only file-like object over an iterable of rows, formatted
+# lazily as COPY text lines.
+#
+# copy_expert pulls fixed-size chunks from it, so the batch is never
+# held in memory as one string.
+class RowReader(object):
+    def __init__(self, rows):
+        self.lines = (
+            '\t'.join(copy_value(v) for v in row) + '\n' for row in rows
+        )
+        self.buffer = ''
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            try:
+                line = next(self.lines)
+            except StopIteration:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = ''.join(chunks)
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+
+# Insert a batch of vehicle rows, as returned by
+# route.get_vehicle_locations, to the postgres database.
+#
+# Rows are streamed through COPY into a temp staging table, then
+# deduplicated into nextbus.vehicle_location in a single statement.
+#
+# Return the number of rows actually inserted.
+def insert_vehicle_rows(conn, vehicle_rows):
+    with conn.cursor() as cur:
+        cur.execute(STAGE_SQL)
+        cur.execute("TRUNCATE vehicle_location_stage")
+        with metrics.timer('db_statement_seconds', statement='copy_stage'):
+            cur.copy_expert(
+                "COPY vehicle_location_stage (service_id, vehicle_tag, lon, "
+                + "lat, location_timestamp, is_predictable) FROM STDIN",
+                RowReader(vehicle_rows)
+            )
+        connect.prepare(conn, 'vehicle_location_dedupe', DEDUPE_SQL)
+        with metrics.timer('db_statement_seconds',
+                           statement='insert_vehicle_location'):
+            cur.execute("EXECUTE vehicle_location_dedupe")
+        return cur.rowcount
+
+
+# A bounded, thread-safe LRU cache of the last report written for each
+# (agency_id, vehicle_tag).
+#
+# A report is dropped before it reaches the database if it is no newer
+# than the vehicle's cached report, give or take `tolerance`. This
+# catches reports written again after the `t=` cursor resets to 0, and
+# the same report seen again with its timestamp shifted by rounding of
+# the request time.
+class ReportCache(object):
+    def __init__(self, max_size=100000,
+                 tolerance=datetime.timedelta(seconds=1)):
+        self.max_size = max_size
+        self.tolerance = tolerance
+        # From (key) (agency_id, vehicle_tag) -> (value)
+        # location_timestamp, least recently used first.
+        self.reports = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    # Filter an agency's vehicle rows down to the ones not yet written.
+    #
+    # Return a list with (1) the fresh rows and (2) the dict of reports
+    # to pass to remember once they have been written.
+    def filter(self, agency_id, vehicle_rows):
+        fresh_rows = []
+        pending = dict()
+        with self.lock:
+            for row in vehicle_rows:
+                key = (agency_id, row[1])
+                last = pending.get(key, self.reports.get(key))
+                if last is not None and row[4] <= last + self.tolerance:
+                    continue
+                fresh_rows.append(row)
+                pending[key] = row[4]
+        return [fresh_rows, pending]
+
+    # Record written reports, evicting the least recently used ones if
+    # the cache is full.
+    def remember(self, pending):
+        with self.lock:
+            for [key, location_timestamp] in pending.items():
+                self.reports[key] = location_timestamp
+                self.reports.move_to_end(key)
+            while len(self.reports) > self.max_size:
+                self.reports.popitem(last=False)
+
+
+# The process-wide cache of last written reports.
+REPORT_CACHE = ReportCache()
+
+
+# Get the checkpointed "vehicleLocations" request times of an agency.
+#
+# Return them as a dict from (key) route UUID, or agency_id for a
+# request covering the whole agency -> (value) request time, the same
+# way agency.get_vehicle_locations keeps them.
+def load_cursors(conn, agency_id):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT route_id, last_time "
+            + "FROM nextbus.vehicle_request_cursor WHERE agency_id = %s",
+            (agency_id,)
+        )
+        return dict(
+            (agency_id if route_id is None else route_id, str(last_time))
+            for [route_id, last_time] in cur.fetchall()
+        )
+
+
+# Upsert the request times of an agency's routes, with a NULL route for
+# the whole agency. A request time is only moved forward, so that a
+# batch written late never rewinds a checkpoint. The statement is
+# prepared once per connection, as vehicle_request_cursor_upsert.
+CURSOR_SQL = """
+    INSERT INTO nextbus.vehicle_request_cursor
+            (agency_id, route_id, last_time, update_timestamp)
+        SELECT $1, route_id, last_time, $4
+        FROM unnest($2::UUID[], $3::BIGINT[]) c(route_id, last_time)
+        ON CONFLICT (agency_id, COALESCE(TEXT(route_id), ''))
+        DO UPDATE SET
+            (last_time, update_timestamp)
+            = (EXCLUDED.last_time, EXCLUDED.update_timestamp)
+            WHERE vehicle_request_cursor.last_time < EXCLUDED.last_time
+"""
+
+
+# Checkpoint an agency's "vehicleLocations" request times, as returned
+# by agency.get_vehicle_locations.
+#
+# Request times of '0' (no lastTime in the response) are not saved, so
+# that a failed request never rewinds a checkpoint.
+def save_cursors(conn, agency_id, cursors):
+    cursors = [(
+        None if key == agency_id else key,
+        int(request_time)
+    ) for [key, request_time] in cursors.items() if request_time != '0']
+    if not cursors:
+        return
+    connect.prepare(conn, 'vehicle_request_cursor_upsert', CURSOR_SQL)
+    with conn.cursor() as cur:
+        cur.execute(
+            "EXECUTE vehicle_request_cursor_upsert "
+            + "(%s, %s::UUID[], %s::BIGINT[], %s)",
+            (
+                agency_id,
+                [c[0] for c in cursors],
+                [c[1] for c in cursors],
+                datetime.datetime.utcnow()
+            )
+        )
+
+
+# Whether vehicle rows are committed synchronously. If False, each
+# transaction writing them sets synchronous_commit off: a commit returns
+# before its WAL is flushed, so a crash of the DB server can lose the
+# last fraction of a second of rows (which the checkpointed cursors
+# then fetch again), but never corrupts them.
+SYNCHRONOUS_COMMIT = True
+
+# Whether each vehicle's latest report is also upserted to
+# nextbus.vehicle_latest, along with the rows written.
+WRITE_LATEST = False
+
+
+# Write an agency's vehicle rows, skipping the ones REPORT_CACHE knows
+# are already written, as part of the transaction already open on
+# `conn`.
+#
+# If `cursors` is given, the request times the rows were fetched with
+# are checkpointed along with them, so that a restart resumes exactly
+# after the last rows written.
+#
+# Return a dict describing what was written, to be passed to
+# remember_written once the transaction has been committed.
+def insert_agency_rows(conn, agency_id, vehicle_rows, cursors=None):
+    if not SYNCHRONOUS_COMMIT:
+        with conn.cursor() as cur:
+            cur.execute("SET LOCAL synchronous_commit = off")
+    [fresh_rows, pending] = REPORT_CACHE.filter(agency_id, vehicle_rows)
+    inserted = insert_vehicle_rows(conn, fresh_rows) if fresh_rows else 0
+    if WRITE_LATEST:
+        livestate.upsert_latest(conn, agency_id, fresh_rows)
+    if cursors:
+        save_cursors(conn, agency_id, cursors)
+    return {
+        'agency_id': agency_id,
+        'pending': pending,
+        'rows': len(vehicle_rows),
+        'fresh': len(fresh_rows),
+        'inserted': inserted
+    }
+
+
+# Record committed vehicle rows, as described by insert_agency_rows.
+#
+# Reports are only remembered once they have been committed, so rows
+# from a failed write are not dropped when they are written again.
+def remember_written(written):
+    REPORT_CACHE.remember(written['pending'])
+    # Count the rows dropped by the cache and by the unique index
+    # separately from the ones inserted.
+    agency_id = written['agency_id']
+    metrics.inc('vehicle_rows_inserted_total', written['inserted'],
+                agency=agency_id)
+    metrics.inc('vehicle_rows_deduped_total',
+                written['rows'] - written['fresh'],
+                agency=agency_id, by='cache')
+    metrics.inc('vehicle_rows_deduped_total',
+                written['fresh'] - written['inserted'],
+                agency=agency_id, by='index')
+
+
+# Write an agency's vehicle rows to the postgres database in their own
+# transaction. Takes the same arguments as insert_agency_rows.
+def write_vehicle_rows(conn, agency_id, vehicle_rows, cursors=None):
+    with connect.transaction(conn):
+        written = insert_agency_rows(conn, agency_id, vehicle_rows, cursors)
+    remember_written(written)
+
+
+# Insert a batch of vehicle rows as a single mogrified
+# INSERT ... SELECT DISTINCT ON ... FROM (VALUES ...) statement.
+#
+# This was the original write path; it is kept for comparison in
+# benchmark.py.
+def insert_vehicle_rows_values(conn, vehicle_rows):
+    with conn.cursor() as cur:
+        # Wrap postgis command around the lon and lat of each
+        # vehicle.
+        vehicle_rows_str = b','.join(cur.mogrify(
+            "(%s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326), %s, %s)",
+            i
+        ) for i in vehicle_rows).decode(conn.encoding)
+        # Execute the INSERT command.
+        cur.execute(
+            "INSERT INTO nextbus.vehicle_location "
+            + "(service_id, vehicle_tag, vehicle_location, "
+            + "location_timestamp, is_predictable) "
+            + "SELECT DISTINCT ON "
+            + "(service_id, vehicle_tag, location_timestamp) * "
+            + "FROM (VALUES "
+            + vehicle_rows_str
+            + ") v(service_id, vehicle_tag, vehicle_location, "
+            + "location_timestamp, is_predictable)"
+        )
+
+
+# Numbers the files written by dump_batch in this process.
+BATCH_COUNTER = itertools.count(1)
+
+
+# Pickle a queued batch, as a (enqueue time, agency_id, rows, cursors)
+# tuple, to its own file in `directory`, without overwriting a file
+# already there (e.g. left by a previous run).
+#
+# Return the file's path.
+def dump_batch(directory, batch):
+    path = None
+    while path is None or os.path.exists(path):
+        path = os.path.join(directory, 'batch-{0}-{1:012d}.pickle'.format(
+            os.getpid(), next(BATCH_COUNTER)
+        ))
+    with open(path, 'wb') as f:
+        pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+# The backpressure policies an IngestQueue can apply when it is full:
+#   - 'block' makes producers wait until the writer has made room.
+#   - 'drop-oldest' discards the oldest queued batches to make room.
+#   - 'spill' writes new batches to files in a spill directory, to be
+#     read back once the writer has caught up.
+POLICIES = ('block', 'drop-oldest', 'spill')
+
+
+# A bounded, thread-safe queue of parsed vehicle rows between the
+# fetchers and the DB writer.
+#
+# Producers put whole batches (one per fetch) tagged with their agency
+# and the request times they were fetched with; the queue is bounded by
+# the total number of rows held in memory.
+class IngestQueue(object):
+    def __init__(self, max_rows, policy='block', spill_dir=None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown backpressure policy: ' + policy)
+        if policy == 'spill' and spill_dir is None:
+            raise ValueError("The 'spill' policy needs a spill_dir")
+        self.max_rows = max_rows
+        self.policy = policy
+        self.spill_dir = spill_dir
+        # Queued batches, as (enqueue time, agency_id, rows, cursors)
+        # tuples.
+        self.batches = collections.deque()
+        self.rows = 0
+        # Paths of spilled batches, oldest first, starting with any
+        # left in the spill directory by a previous run.
+        self.spilled = collections.deque()
+        if policy == 'spill':
+            self.spilled.extend(sorted(
+                glob.glob(os.path.join(spill_dir, 'batch-*.pickle')),
+                key=lambda path: (os.path.getmtime(path), path)
+            ))
+        self.dropped_rows = 0
+        self.condition = threading.Condition()
+
+    # Queue a batch of vehicle rows, applying the backpressure policy if
+    # there isn't room for them.
+    #
+    # While there are spilled batches, new batches are spilled after
+    # them, so that batches always reach the writer in the order they
+    # were queued.
+    #
+    # `cursors` are the request times the rows were fetched with, to be
+    # checkpointed along with them.
+    def put(self, agency_id, rows, cursors=None):
+        if not rows:
+            return
+        with self.condition:
+            if self.policy == 'spill' and self.spilled:
+                self.spill((monotonic(), agency_id, rows, cursors))
+                self.condition.notify_all()
+                return
+            if self.rows + len(rows) > self.max_rows and self.rows > 0:
+                if self.policy == 'block':
+                    while self.rows > 0 and \
+                            self.rows + len(rows) > self.max_rows:
+                        self.condition.wait()
+                elif self.policy == 'drop-oldest':
+                    while self.rows > 0 and \
+                            self.rows + len(rows) > self.max_rows:
+                        [t, a, dropped, c] = self.batches.popleft()
+                        self.rows -= len(dropped)
+                        self.dropped_rows += len(dropped)
+                else:
+                    self.spill((monotonic(), agency_id, rows, cursors))
+                    self.condition.notify_all()
+                    return
+            self.batches.append((monotonic(), agency_id, rows, cursors))
+            self.rows += len(rows)
+            self.condition.notify_all()
+
+    # Write a batch to its own file in the spill directory.
+    def spill(self, batch):
+        self.spilled.append(dump_batch(self.spill_dir, batch))
+
+    # Take queued batches for the writer, up to `max_rows` rows (but at
+    # least one batch).
+    #
+    # Wait until at least `max_rows` rows are queued, or the oldest
+    # batch has been queued for `max_age` seconds. Spilled batches are
+    # read back once the in-memory queue is empty.
+    #
+    # Return a list of (agency_id, rows, cursors, path) tuples. `path`
+    # is the file a spilled batch was read from (None for the others),
+    # which is left in place until the batch has been written, so that
+    # a batch being written when the process stops is read again on
+    # restart. The caller removes it with remove_spilled.
+    def get_batches(self, max_rows, max_age):
+        with self.condition:
+            while True:
+                if self.rows >= max_rows:
+                    break
+                if self.batches:
+                    wait = self.batches[0][0] + max_age - monotonic()
+                    if wait <= 0:
+                        break
+                elif self.spilled:
+                    path = self.spilled.popleft()
+                    with open(path, 'rb') as f:
+                        [t, agency_id, rows, cursors] = pickle.load(f)
+                    return [(agency_id, rows, cursors, path)]
+                else:
+                    wait = None
+                self.condition.wait(wait)
+            taken = []
+            taken_rows = 0
+            while self.batches and (
+                    not taken
+                    or taken_rows + len(self.batches[0][2]) <= max_rows):
+                [t, agency_id, rows, cursors] = self.batches.popleft()
+                taken.append((agency_id, rows, cursors, None))
+                taken_rows += len(rows)
+            self.rows -= taken_rows
+            self.condition.notify_all()
+            return taken
+
+    # Remove the files of spilled batches taken by get_batches, once
+    # they've been written (or set aside).
+    def remove_spilled(self, batches):
+        for batch in batches:
+            if batch[3] is not None:
+                os.remove(batch[3])
+
+    # Report the queue's depth: the rows and batches held in memory, the
+    # batches spilled to disk, and the rows dropped so far.
+    def depth(self):
+        with self.condition:
+            return {
+                'rows': self.rows,
+                'batches': len(self.batches),
+                'spilled_batches': len(self.spilled),
+                'dropped_rows': self.dropped_rows
+            }
+
+
+# Write the grouped rows and cursors of the batches taken by run_writer
+# in a single transaction, on a connection from `pool`.
+def write_batches(pool, agency_rows, agency_cursors):
+    with connect.pooled(pool) as conn:
+        with connect.transaction(conn):
+            written = [insert_agency_rows(
+                conn, agency_id, rows, agency_cursors[agency_id]
+            ) for [agency_id, rows] in agency_rows.items()]
+    for w in written:
+        remember_written(w)
+
+
+# Set an agency's rows that can't be written aside in `dead_letter_dir`,
+# in the same format as spilled batches, so that they can be inspected,
+# or written again by moving them to a spill directory.
+def dead_letter(dead_letter_dir, agency_id, rows, cursors):
+    os.makedirs(dead_letter_dir, exist_ok=True)
+    path = dump_batch(dead_letter_dir, (monotonic(), agency_id, rows, cursors))
+    metrics.inc('ingest_dead_letter_batches_total', agency=agency_id)
+    metrics.inc('ingest_dead_letter_rows_total', len(rows), agency=agency_id)
+    print("Set " + str(len(rows)) + " vehicle locations of agency "
+          + agency_id + " aside to " + path)
+
+
+# Drain an IngestQueue into the database indefinitely, in batches of up
+# to `max_rows` rows or `max_age` seconds, whichever comes first.
+#
+# Each batch, which may hold several poll cycles of several agencies,
+# is written in a single transaction, so its rows share one commit.
+#
+# If a write fails, it is retried after `retry_rest` seconds, letting
+# the queue's backpressure policy absorb the delay. Once it has failed
+# `max_tries` times for reasons other than the DB being unreachable,
+# each agency's rows are tried once on their own, and the ones that
+# still fail are set aside in `dead_letter_dir`, so that rows which can
+# never be written don't hold up the others.
+def run_writer(ingest_queue, pool, max_rows, max_age, retry_rest=5,
+               max_tries=5, dead_letter_dir='dead-letter'):
+    while True:
+        batches = ingest_queue.get_batches(max_rows, max_age)
+        # Group the batches' rows by agency, keeping the latest request
+        # time of each cursor.
+        agency_rows = collections.OrderedDict()
+        agency_cursors = dict()
+        for [agency_id, rows, cursors, path] in batches:
+            agency_rows.setdefault(agency_id, []).extend(rows)
+            agency_cursors.setdefault(agency_id, dict()).update(cursors or {})
+        metrics.set_gauge('ingest_queue_rows', ingest_queue.depth()['rows'])
+        failed_tries = 0
+        while failed_tries < max_tries:
+            try:
+                write_batches(pool, agency_rows, agency_cursors)
+                break
+            except Exception as e:
+                metrics.inc('failures_total', stage='write_vehicle_rows')
+                # Only failures that may be due to the rows themselves
+                # count towards max_tries: while the DB can't be
+                # reached, the write is retried indefinitely.
+                if not isinstance(e, (psycopg2.OperationalError,
+                                      psycopg2.InterfaceError)):
+                    failed_tries += 1
+                print("Writing vehicle locations failed:")
+                traceback.print_exc()
+                if failed_tries < max_tries:
+                    sleep(retry_rest)
+        else:
+            for [agency_id, rows] in agency_rows.items():
+                try:
+                    write_batches(pool, {agency_id: rows}, agency_cursors)
+                except Exception:
+                    dead_letter(dead_letter_dir, agency_id, rows,
+                                agency_cursors[agency_id])
+        # The batches' rows are now written or set aside, so their spill
+        # files can go.
+        ingest_queue.remove_spilled(batches)
+
+
+# Start run_writer in a daemon thread. Return the thread.
+def start_writer(ingest_queue, pool, max_rows, max_age,
+                 dead_letter_dir='dead-letter'):
+    writer = threading.Thread(
+        target=run_writer,
+        args=(ingest_queue, pool, max_rows, max_age),
+        kwargs={'dead_letter_dir': dead_letter_dir},
+        name='writer',
+        daemon=True
+    )
+    writer.start()
+    return writer
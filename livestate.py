@@ -0,0 +1,250 @@
+import json
+import math
+import datetime
+import threading
+import http.server
+import urllib.parse
+
+import psycopg2.extras
+
+
+# The mean radius of the earth, in meters.
+EARTH_RADIUS = 6371008.8
+
+
+# Get the great-circle distance in meters between two lon/lat points.
+def distance(lon1, lat1, lon2, lat2):
+    [lon1, lat1, lon2, lat2] = map(math.radians, [lon1, lat1, lon2, lat2])
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, a)))
+
+
+# An in-memory store of the latest report of every vehicle, as parsed by
+# route.get_vehicle_locations, with a grid index over their locations.
+#
+# The grid's cells are `cell_size` degrees wide and tall, so a radius
+# query only looks at the vehicles of the cells its bounding box covers.
+# Vehicles that haven't reported for `max_age` seconds are expired.
+class LiveState(object):
+    def __init__(self, cell_size=0.01, max_age=300):
+        self.cell_size = cell_size
+        self.max_age = datetime.timedelta(seconds=max_age)
+        # From (key) (agency_id, vehicle_tag) -> (value) the vehicle's
+        # latest report, as (agency_id, vehicle_tag, service_id, lon,
+        # lat, location_timestamp, is_predictable).
+        self.vehicles = dict()
+        # From (key) (x, y) grid cell -> (value) set of vehicle keys.
+        self.cells = dict()
+        self.lock = threading.Lock()
+
+    def cell_of(self, lon, lat):
+        return (
+            int(math.floor(lon / self.cell_size)),
+            int(math.floor(lat / self.cell_size))
+        )
+
+    # Drop a vehicle from its grid cell. Callers hold the lock.
+    def unindex(self, key, report):
+        cell = self.cell_of(report[3], report[4])
+        keys = self.cells[cell]
+        keys.discard(key)
+        if not keys:
+            del self.cells[cell]
+
+    # Record an agency's new vehicle rows, keeping each vehicle's latest
+    # report, then expire stale vehicles. Rows without a location can't
+    # be indexed, so they're skipped.
+    def update(self, agency_id, vehicle_rows):
+        with self.lock:
+            for row in vehicle_rows:
+                [service_id, vehicle_tag, lon, lat, location_timestamp,
+                 is_predictable] = row
+                if lon is None or lat is None:
+                    continue
+                key = (agency_id, vehicle_tag)
+                previous = self.vehicles.get(key)
+                if previous is not None:
+                    if location_timestamp <= previous[5]:
+                        continue
+                    self.unindex(key, previous)
+                self.vehicles[key] = (agency_id, vehicle_tag, service_id,
+                                      float(lon), float(lat),
+                                      location_timestamp, is_predictable)
+                self.cells.setdefault(
+                    self.cell_of(float(lon), float(lat)), set()
+                ).add(key)
+        self.expire()
+
+    # Drop the vehicles whose latest report is older than `max_age`, as
+    # of the UTC datetime `now` (defaulting to now).
+    #
+    # Return the number of vehicles dropped.
+    def expire(self, now=None):
+        if now is None:
+            now = datetime.datetime.utcnow()
+        oldest = now - self.max_age
+        with self.lock:
+            stale = [
+                (key, report) for [key, report] in self.vehicles.items()
+                if report[5] < oldest
+            ]
+            for [key, report] in stale:
+                self.unindex(key, report)
+                del self.vehicles[key]
+        return len(stale)
+
+    # Get the latest report of every vehicle, optionally only those of
+    # the agency `agency_id`.
+    def all(self, agency_id=None):
+        with self.lock:
+            return [
+                report for report in self.vehicles.values()
+                if agency_id is None or report[0] == agency_id
+            ]
+
+    # Get the vehicles within `radius` meters of a lon/lat point,
+    # optionally only those of the agency `agency_id`.
+    #
+    # Return them as a list of (distance in meters, report) tuples,
+    # nearest first.
+    #
+    # Only the candidate reports are gathered under the lock, so that a
+    # query never holds up update for long: if the circle's bounding box
+    # covers more grid cells than are occupied, the occupied cells are
+    # scanned instead, whatever the radius.
+    def near(self, lon, lat, radius, agency_id=None):
+        # Find the grid cells covering the circle's bounding box.
+        dlat = math.degrees(radius / EARTH_RADIUS)
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        [x0, y0] = self.cell_of(lon - dlon, lat - dlat)
+        [x1, y1] = self.cell_of(lon + dlon, lat + dlat)
+        with self.lock:
+            if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+                cells = [
+                    keys for [(x, y), keys] in self.cells.items()
+                    if x0 <= x <= x1 and y0 <= y <= y1
+                ]
+            else:
+                cells = [
+                    self.cells.get((x, y), ())
+                    for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)
+                ]
+            candidates = [
+                self.vehicles[key] for keys in cells for key in keys
+            ]
+        found = []
+        for report in candidates:
+            if agency_id is not None and report[0] != agency_id:
+                continue
+            d = distance(lon, lat, report[3], report[4])
+            if d <= radius:
+                found.append((d, report))
+        return sorted(found, key=lambda f: f[0])
+
+
+# Format a vehicle report as a JSON-serializable dict.
+def report_json(report):
+    return {
+        'agency_id': report[0],
+        'vehicle_tag': report[1],
+        'service_id': None if report[2] is None else str(report[2]),
+        'lon': report[3],
+        'lat': report[4],
+        'location_timestamp': report[5].isoformat() + 'Z',
+        'is_predictable': report[6]
+    }
+
+
+# Serve a LiveState as JSON from a background thread, at
+# http://<host>:<port>/..., on the local machine only by default.
+#   /vehicles[?agency=A]: every vehicle's latest report.
+#   /near?lon=X&lat=Y&radius=M[&agency=A]: the vehicles within M meters
+#     (default 500) of a point, nearest first, with their distance.
+#
+# Return the server.
+def start_http_server(state, port, host='127.0.0.1'):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            query = dict(
+                (k, v[0]) for [k, v] in urllib.parse.parse_qs(url.query).items()
+            )
+            agency_id = query.get('agency')
+            try:
+                if url.path == '/vehicles':
+                    body = [report_json(r) for r in state.all(agency_id)]
+                elif url.path == '/near':
+                    body = []
+                    for [d, r] in state.near(
+                            float(query['lon']), float(query['lat']),
+                            float(query.get('radius', '500')), agency_id):
+                        vehicle = report_json(r)
+                        vehicle['distance_m'] = round(d, 1)
+                        body.append(vehicle)
+                else:
+                    self.send_error(404)
+                    return
+            except (KeyError, ValueError):
+                self.send_error(400)
+                return
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Upsert the latest of an agency's vehicle rows to
+# nextbus.vehicle_latest, which holds one row per vehicle for SQL
+# consumers. A vehicle's row is only rewritten if the new report is
+# newer.
+def upsert_latest(conn, agency_id, vehicle_rows):
+    latest = dict()
+    for row in vehicle_rows:
+        if row[1] not in latest or row[4] > latest[row[1]][4]:
+            latest[row[1]] = row
+    if not latest:
+        return
+    with conn.cursor() as cur:
+        psycopg2.extras.execute_values(
+            cur,
+            """
+            INSERT INTO nextbus.vehicle_latest
+                    (agency_id, vehicle_tag, service_id, vehicle_location,
+                     location_timestamp, is_predictable)
+                VALUES %s
+                ON CONFLICT (agency_id, vehicle_tag)
+                DO UPDATE SET
+                    (service_id, vehicle_location, location_timestamp,
+                     is_predictable)
+                    = (EXCLUDED.service_id, EXCLUDED.vehicle_location,
+                       EXCLUDED.location_timestamp, EXCLUDED.is_predictable)
+                    WHERE vehicle_latest.location_timestamp
+                        < EXCLUDED.location_timestamp
+            """,
+            [(
+                agency_id, row[1], row[0], row[2], row[3], row[4], row[5]
+            ) for row in latest.values()],
+            template=(
+                "(%s, %s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326), "
+                + "%s, %s)"
+            )
+        )
+
+
+# The process-wide live state store, fed with every vehicle row fetched
+# by agency.get_vehicle_locations, if one has been started (see
+# cli.configure_livestate).
+STATE = None
@@ -0,0 +1,177 @@
+import json
+import time
+import threading
+import http.server
+from timeit import default_timer
+
+
+# Whether metrics are being recorded. Until this is set, every recording
+# function returns right away, so instrumentation costs next to nothing.
+ENABLED = False
+
+# Recorded metrics, each from (key) (name, sorted label items) ->
+# (value):
+#   - COUNTERS: a running total.
+#   - GAUGES: the latest value.
+#   - SUMMARIES: a [count, sum, max] list of observed values.
+COUNTERS = dict()
+GAUGES = dict()
+SUMMARIES = dict()
+LOCK = threading.Lock()
+
+
+# Add `value` to a counter.
+def inc(name, value=1, **labels):
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with LOCK:
+        COUNTERS[key] = COUNTERS.get(key, 0) + value
+
+
+# Set a gauge to `value`.
+def set_gauge(name, value, **labels):
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with LOCK:
+        GAUGES[key] = value
+
+
+# Record one observation of a summary, e.g. a duration or a size.
+def observe(name, value, **labels):
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with LOCK:
+        summary = SUMMARIES.get(key)
+        if summary is None:
+            SUMMARIES[key] = [1, value, value]
+        else:
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+
+# Time a `with` block, and observe its duration in seconds.
+class Timer(object):
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, default_timer() - self.start, **self.labels)
+        return False
+
+
+# A Timer stand-in for when metrics are disabled.
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+def timer(name, **labels):
+    if not ENABLED:
+        return NULL_TIMER
+    return Timer(name, labels)
+
+
+# Format a metric's labels the Prometheus way.
+def format_labels(label_items, extra=()):
+    items = list(label_items) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(
+            k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+        ) for [k, v] in items
+    ) + '}'
+
+
+# Render every recorded metric in the Prometheus text exposition format.
+def render():
+    lines = []
+    with LOCK:
+        for [[name, labels], value] in sorted(COUNTERS.items()):
+            lines.append(name + format_labels(labels) + ' ' + repr(value))
+        for [[name, labels], value] in sorted(GAUGES.items()):
+            lines.append(name + format_labels(labels) + ' ' + repr(value))
+        for [[name, labels], [count, total, peak]] in sorted(
+                SUMMARIES.items()):
+            lines.append(
+                name + '_count' + format_labels(labels) + ' ' + repr(count)
+            )
+            lines.append(
+                name + '_sum' + format_labels(labels) + ' ' + repr(total)
+            )
+            lines.append(
+                name + '_max' + format_labels(labels) + ' ' + repr(peak)
+            )
+    return '\n'.join(lines) + '\n'
+
+
+# Render every recorded metric as one JSON object, for a log line.
+def snapshot():
+    def name_of(name, labels):
+        return name + format_labels(labels)
+    with LOCK:
+        return {
+            'counters': dict(
+                (name_of(*key), value) for [key, value] in COUNTERS.items()
+            ),
+            'gauges': dict(
+                (name_of(*key), value) for [key, value] in GAUGES.items()
+            ),
+            'summaries': dict(
+                (name_of(*key), {
+                    'count': s[0], 'sum': s[1], 'max': s[2]
+                }) for [key, s] in SUMMARIES.items()
+            )
+        }
+
+
+# Serve the metrics in the Prometheus text format at
+# http://<host>:<port>/metrics, from a background thread.
+#
+# Return the server.
+def start_http_server(port, host=''):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            payload = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Print every recorded metric as a JSON log line every `interval`
+# seconds, from a background thread.
+def start_log_reporter(interval):
+    def report():
+        while True:
+            time.sleep(interval)
+            print('metrics ' + json.dumps(snapshot(), sort_keys=True))
+
+    threading.Thread(target=report, daemon=True).start()
@@ -0,0 +1,222 @@
+import re
+import datetime
+
+import psycopg2
+from psycopg2 import sql
+
+
+# The partitioning intervals supported for nextbus.vehicle_location, from
+# (key) interval -> (value) strftime format of each partition's suffix.
+INTERVALS = {
+    'day': '%Y%m%d',
+    'month': '%Y%m'
+}
+
+
+# Find the bounds of the partition holding the date `d`.
+#
+# Return a list with the partition's (1) first date and (2) first date
+# after it.
+def partition_bounds(d, interval='day'):
+    if interval == 'day':
+        return [d, d + datetime.timedelta(days=1)]
+    start = d.replace(day=1)
+    return [start, (start + datetime.timedelta(days=32)).replace(day=1)]
+
+
+# Get the name of the partition holding the date `d`.
+def partition_name(d, interval='day'):
+    return 'vehicle_location_p' + d.strftime(INTERVALS[interval])
+
+
+# Get the date ranges covered by the partitions currently attached to
+# nextbus.vehicle_location, whatever their names, e.g. the history
+# partition attached by sql/partition_vehicle_location.sql.
+#
+# Return them as a list of [first date, first date after] lists, with
+# None for an unbounded (MINVALUE or MAXVALUE) end. A DEFAULT partition
+# is left out.
+def covered_ranges(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT pg_get_expr(child.relpartbound, child.oid) "
+            + "FROM pg_inherits "
+            + "INNER JOIN pg_class parent ON parent.oid = inhparent "
+            + "INNER JOIN pg_class child ON child.oid = inhrelid "
+            + "INNER JOIN pg_namespace ON pg_namespace.oid = parent.relnamespace "
+            + "WHERE nspname = 'nextbus' AND parent.relname = 'vehicle_location'"
+        )
+        bounds = [r[0] for r in cur.fetchall()]
+    ranges = []
+    for bound in bounds:
+        match = re.match(r"FOR VALUES FROM \((.*)\) TO \((.*)\)", bound or '')
+        if match is None:
+            continue
+        ranges.append([
+            None if 'VALUE' in value else datetime.datetime.strptime(
+                value.strip("'")[:10], '%Y-%m-%d'
+            ).date()
+            for value in match.groups()
+        ])
+    return ranges
+
+
+# Clip the date range [lower, upper) to the part of it before any
+# partition in `ranges` (as returned by covered_ranges) that overlaps
+# it, starting after the partitions that already cover its start.
+#
+# Return the clipped [lower, upper], or None if the range is already
+# covered.
+def uncovered_range(lower, upper, ranges):
+    ranges = sorted(ranges, key=lambda r: r[0] or datetime.date.min)
+    for [start, end] in ranges:
+        if (start is None or start <= lower) and (end is None or end > lower):
+            if end is None:
+                return None
+            lower = end
+        elif start is not None and lower < start < upper:
+            upper = start
+    if lower >= upper:
+        return None
+    return [lower, upper]
+
+
+# Create the partitions of nextbus.vehicle_location covering the dates
+# from `start` through `end`, if they don't already exist.
+#
+# The parts of their ranges already covered by other partitions are
+# left out. Each partition is created on its own, so that one failing
+# to be created doesn't keep the others from being created.
+def create_partitions(conn, start, end, interval='day'):
+    ranges = covered_ranges(conn)
+    d = start
+    with conn.cursor() as cur:
+        while d <= end:
+            [lower, upper] = partition_bounds(d, interval)
+            d = upper
+            bounds = uncovered_range(lower, upper, ranges)
+            if bounds is None:
+                continue
+            # Outside autocommit, a failed statement would abort the
+            # whole transaction, so each one gets its own savepoint.
+            if not conn.autocommit:
+                cur.execute("SAVEPOINT create_partition")
+            try:
+                cur.execute(sql.SQL(
+                    "CREATE TABLE IF NOT EXISTS nextbus.{0} "
+                    + "PARTITION OF nextbus.vehicle_location "
+                    + "FOR VALUES FROM ({1}) TO ({2})"
+                ).format(
+                    sql.Identifier(partition_name(lower, interval)),
+                    sql.Literal(bounds[0]),
+                    sql.Literal(bounds[1])
+                ))
+            except psycopg2.Error as e:
+                if not conn.autocommit:
+                    cur.execute("ROLLBACK TO SAVEPOINT create_partition")
+                print("Creating vehicle_location partition "
+                      + partition_name(lower, interval) + " failed: " + str(e))
+                continue
+            ranges.append(bounds)
+
+
+# Get the partitions currently attached to nextbus.vehicle_location.
+#
+# Return them as a list of (name, first date) tuples, oldest first.
+# Partitions not named by partition_name are left out.
+def list_partitions(conn, interval='day'):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT child.relname "
+            + "FROM pg_inherits "
+            + "INNER JOIN pg_class parent ON parent.oid = inhparent "
+            + "INNER JOIN pg_class child ON child.oid = inhrelid "
+            + "INNER JOIN pg_namespace ON pg_namespace.oid = parent.relnamespace "
+            + "WHERE nspname = 'nextbus' AND parent.relname = 'vehicle_location'"
+        )
+        names = [r[0] for r in cur.fetchall()]
+    partitions = []
+    for name in names:
+        try:
+            lower = datetime.datetime.strptime(
+                name[len('vehicle_location_p'):], INTERVALS[interval]
+            ).date()
+        except ValueError:
+            continue
+        partitions.append((name, lower))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+# Retire the partitions of nextbus.vehicle_location that hold only
+# dates before `before`.
+#
+# If `detach` is True, they are detached and kept as standalone tables
+# (e.g. to be archived); otherwise they are dropped.
+#
+# Return the names of the retired partitions.
+def retire_partitions(conn, before, detach=False, interval='day'):
+    retired = []
+    with conn.cursor() as cur:
+        for [name, lower] in list_partitions(conn, interval):
+            if partition_bounds(lower, interval)[1] > before:
+                continue
+            cur.execute(sql.SQL(
+                "ALTER TABLE nextbus.vehicle_location DETACH PARTITION "
+                + "nextbus.{0}"
+            ).format(sql.Identifier(name)))
+            if not detach:
+                cur.execute(sql.SQL("DROP TABLE nextbus.{0}").format(
+                    sql.Identifier(name)
+                ))
+            retired.append(name)
+    return retired
+
+
+# Get the first date not yet exported by export.py for every agency.
+#
+# An agency with vehicle locations but no watermark in
+# nextbus.export_watermark has exported nothing, so None is returned if
+# there is such an agency, or if no agency has a watermark.
+def first_unexported(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT EXISTS ("
+            + "SELECT 1 FROM nextbus.route "
+            + "INNER JOIN nextbus.service USING (route_id) "
+            + "WHERE NOT EXISTS (SELECT 1 FROM nextbus.export_watermark w "
+            + "WHERE w.agency_id = route.agency_id) "
+            + "AND EXISTS (SELECT 1 FROM nextbus.vehicle_location v "
+            + "WHERE v.service_id = service.service_id)"
+            + "), (SELECT min(exported_through) "
+            + "FROM nextbus.export_watermark)"
+        )
+        [unwatermarked, exported_through] = cur.fetchone()
+    if unwatermarked or exported_through is None:
+        return None
+    return exported_through + datetime.timedelta(days=1)
+
+
+# Maintain nextbus.vehicle_location's partitions around the UTC date
+# `today`:
+#   1. Create partitions from yesterday through `days_ahead` days ahead,
+#      so that inserts never find their partition missing.
+#   2. If `retention_days` is given, retire partitions holding only
+#      dates older than that. If `keep_unexported` is True, partitions
+#      holding dates not yet exported by export.py are kept regardless.
+def maintain_partitions(conn, today, days_ahead=3, retention_days=None,
+                        detach=False, interval='day',
+                        keep_unexported=False):
+    create_partitions(
+        conn,
+        today - datetime.timedelta(days=1),
+        today + datetime.timedelta(days=days_ahead),
+        interval
+    )
+    if retention_days is not None:
+        before = today - datetime.timedelta(days=retention_days)
+        if keep_unexported:
+            unexported = first_unexported(conn)
+            if unexported is None:
+                return
+            before = min(before, unexported)
+        retire_partitions(conn, before, detach, interval)
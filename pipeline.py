@@ -0,0 +1,269 @@
+import pytz
+import datetime
+from time import sleep, monotonic
+
+import adaptive
+import connect
+import agency
+import ingest
+import metrics
+import partition
+import retry
+
+
+# Update an agency's routes, services, stops, and service-stop orders.
+# Each NextBus request is retried on its own (see route.RETRIES).
+# The routeList and each route's routeConfig are fetched and parsed
+#   once, before any DB update, and shared by the routes, services,
+#   stops, and service-stop order updates. The routeConfigs are matched
+#   to their routes by tag once the routes are upserted, so that
+#   routes keep the UUIDs they have in the DB.
+# A route whose routeConfig still can't be fetched doesn't fail the
+#   others: only the failed routes are fetched again, after a backoff,
+#   on each of the following tries, up to `n_tries` in all. A route that
+#   fails on every try is left out (or keeps its last snapshot) rather
+#   than failing the whole update.
+# The DB updates are then written in a single transaction, so no
+#   connection sits idle in a transaction while NextBus is being
+#   polled; if one of them fails (e.g. when some route's services or
+#   stops were not added), the transaction is rolled back and the DB
+#   updates are tried again, within the same `n_tries`, after a backoff.
+# Return the new routeConfig snapshots if the update succeeded, or the
+#   previous ones if it didn't, so that routes whose routeConfig hasn't
+#   changed since the last successful update can be skipped.
+# Each NextBus request is bounded by `timeout` seconds.
+def update_agency_info(conn, agency_id, snapshots, n_tries,
+                       timeout = None):
+    tag_route_configs = None
+    failed_routes = []
+    for current_try in range(1, n_tries + 1):
+        try:
+            if tag_route_configs is None:
+                with metrics.timer('stage_seconds', agency = agency_id,
+                                   stage = 'get_routes'):
+                    routes = agency.get_routes(agency_id, timeout)
+                with metrics.timer('stage_seconds', agency = agency_id,
+                                   stage = 'get_route_configs'):
+                    [tag_route_configs, new_snapshots, failed_routes] = (
+                        agency.get_route_configs(
+                            agency_id, routes, snapshots, timeout
+                        )
+                    )
+            elif failed_routes:
+                with metrics.timer('stage_seconds', agency = agency_id,
+                                   stage = 'get_route_configs'):
+                    [tag_route_configs, new_snapshots, failed_routes] = (
+                        agency.merge_route_configs(
+                            agency_id, tag_route_configs, new_snapshots,
+                            failed_routes, snapshots, timeout
+                        )
+                    )
+            # Fetch the failed routes again after a backoff, unless this
+            #   is the last try.
+            if failed_routes and current_try < n_tries:
+                print("Getting routeConfig of " + str(len(failed_routes))
+                      + " route(s) of agency " + agency_id + " failed (try "
+                      + str(current_try) + " of " + str(n_tries) + ")")
+                sleep(retry.backoff_delay(current_try - 1))
+                continue
+            # Write the whole update in one transaction, so that readers
+            #   never see new routes without their services and stops.
+            with connect.transaction(conn):
+                with metrics.timer('stage_seconds', agency = agency_id,
+                                   stage = 'update_routes'):
+                    agency.update_routes(conn, routes)
+                # Match the routeConfigs to the routes' UUIDs in the DB.
+                route_configs = agency.bind_route_configs(
+                    conn, agency_id, tag_route_configs
+                )
+                with metrics.timer('stage_seconds', agency = agency_id,
+                                   stage = 'update_services'):
+                    agency.update_services(conn, route_configs)
+                with metrics.timer('stage_seconds', agency = agency_id,
+                                   stage = 'update_stops'):
+                    agency.update_stops(conn, route_configs)
+                with metrics.timer('stage_seconds', agency = agency_id,
+                                   stage = 'update_service_stop_orders'):
+                    agency.update_service_stop_orders(conn, route_configs)
+            # Invalidate the cached routes and services if they changed.
+            agency.refresh_dimensions(conn, agency_id)
+            return new_snapshots
+        except Exception as e:
+            # The cached stop orderings may not have been committed, so
+            #   reload them from the DB on the next try.
+            agency.STOP_ORDERS.pop(agency_id, None)
+            metrics.inc('failures_total', agency = agency_id,
+                        stage = 'update_agency_info')
+            print("Updating agency " + agency_id + " info failed (try "
+                  + str(current_try) + " of " + str(n_tries) + "): "
+                  + repr(e))
+            if current_try < n_tries:
+                sleep(retry.backoff_delay(current_try - 1))
+    return snapshots
+
+
+# Per-agency scheduling stats, from (key) agency_id -> (value) dict
+# with the lag (in seconds) of the latest poll behind its deadline, the
+# largest lag seen, and the number of polls run and ticks skipped.
+SCHEDULE_STATS = dict()
+
+
+# Find the next midnight after the UTC datetime `utc_now` in the
+# timezone `user_tz`. Return it as a UTC datetime.
+def next_midnight(utc_now, user_tz):
+    local_date = utc_now.astimezone(user_tz).date()
+    midnight = user_tz.localize(datetime.datetime.combine(
+        local_date + datetime.timedelta(days = 1), datetime.time()
+    ))
+    return midnight.astimezone(pytz.utc)
+
+
+# Find the deadline of the poll after the one due at the monotonic time
+#   `next_poll`, `resttime` seconds later. If that deadline has already
+#   passed, the missed ticks are skipped rather than run back to back.
+# Return a list with (1) the next deadline and (2) the number of ticks
+#   skipped.
+def next_deadline(next_poll, resttime):
+    next_poll += resttime
+    overrun = monotonic() - next_poll
+    if overrun <= 0:
+        return [next_poll, 0]
+    skipped = int(overrun // resttime) + 1
+    return [next_poll + skipped * resttime, skipped]
+
+
+# Poll an agency indefinitely:
+#   1. Update the agency's info at the beginning of every day in the
+#      timezone `user_tz`.
+#   2. Until the next midnight, keep updating the agency's vehicle
+#      locations every `resttime` seconds.
+#
+# Polls fire on fixed-rate deadlines, so the period doesn't stretch with
+# the time each poll takes. If a poll overruns one or more deadlines,
+# the missed ticks are skipped rather than run back to back. Each poll's
+# lag behind its deadline is recorded in SCHEDULE_STATS.
+#
+# A DB connection is taken from `pool` for each step and returned right
+# after, so several agencies can share one pool. All of the agency's
+# polling state is local to this call, and its "vehicleLocations"
+# request times are resumed from their last checkpoint.
+#
+# If `ingest_queue` is given, vehicle rows are put on it for a separate
+# writer instead of being inserted inline, so a slow insert never delays
+# the next fetch.
+#
+# nextbus.vehicle_location's partitions are maintained on every daily
+# update, with `partition_options` passed to
+# partition.maintain_partitions.
+#
+# If `max_interval` is given, routes are polled on an adaptive schedule:
+# every `resttime` seconds while they have vehicles, backing off to up to
+# every `max_interval` seconds while they don't (see
+# adaptive.AdaptiveSchedule).
+def poll_agency(pool, agency_id, user_tz, resttime,
+                workers = 1, timeout = None, agency_wide = False,
+                ingest_queue = None, partition_options = None,
+                max_interval = None):
+    # Set `request_times` to the checkpointed request times, if any.
+    #   This will be updated every time the "vehicleLocations" endpoint
+    #     is hit.
+    with connect.pooled(pool) as conn:
+        request_times = ingest.load_cursors(conn, agency_id)
+    # Set `route_configs` to an empty dict.
+    #   This will hold the last successfully stored routeConfig of each
+    #     route, so that unchanged routes are skipped on the daily
+    #     update.
+    route_configs = dict()
+    schedule = None
+    if max_interval is not None:
+        schedule = adaptive.AdaptiveSchedule(resttime, max_interval)
+    stats = SCHEDULE_STATS[agency_id] = {
+        'lag': 0.0, 'max_lag': 0.0, 'polls': 0, 'skipped_ticks': 0
+    }
+    # Begin the infinite loop.
+    while True:
+        # Update the agency's info. Try up to 10 times before throwing
+        #   an error.
+        with connect.pooled(pool) as conn:
+            route_configs = update_agency_info(
+                conn, agency_id, route_configs, n_tries = 10,
+                timeout = timeout
+            )
+            # Create the coming days' vehicle_location partitions, and
+            #   retire old ones.
+            try:
+                partition.maintain_partitions(
+                    conn, datetime.datetime.utcnow().date(),
+                    **(partition_options or {})
+                )
+            except Exception as e:
+                print("Maintaining vehicle_location partitions failed: "
+                      + str(e))
+        # Compute the deadline of the next update: the next midnight in
+        #   the agency's timezone.
+        refresh_at = next_midnight(
+            datetime.datetime.utcnow().replace(tzinfo = pytz.utc), user_tz
+        )
+        # Until then, keep updating the agency's vehicle locations,
+        #   starting right away.
+        next_poll = monotonic()
+        while True:
+            # Rest until the next poll or the next update, whichever
+            #   comes first.
+            utc_now = datetime.datetime.utcnow().replace(tzinfo = pytz.utc)
+            until_refresh = (refresh_at - utc_now).total_seconds()
+            if until_refresh <= 0:
+                break
+            until_poll = next_poll - monotonic()
+            if until_poll > 0:
+                sleep(min(until_poll, until_refresh))
+                continue
+            # Record how late this poll fires.
+            stats['lag'] = -until_poll
+            stats['max_lag'] = max(stats['max_lag'], stats['lag'])
+            stats['polls'] += 1
+            metrics.set_gauge('schedule_lag_seconds', stats['lag'],
+                              agency = agency_id)
+            cycle_start = monotonic()
+            # If vehicle update fails, wait and try again.
+            #   This is to catch potential API downtime.
+            try:
+                with connect.pooled(pool) as conn:
+                    if ingest_queue is None:
+                        request_times = agency.update_vehicle_locations(
+                            conn, agency_id, request_times,
+                            max_workers = workers, timeout = timeout,
+                            agency_wide = agency_wide, schedule = schedule
+                        )
+                    else:
+                        [vehicle_rows, request_times] = (
+                            agency.get_vehicle_locations(
+                                conn, agency_id, request_times,
+                                max_workers = workers, timeout = timeout,
+                                agency_wide = agency_wide,
+                                schedule = schedule
+                            )
+                        )
+                if ingest_queue is not None:
+                    ingest_queue.put(agency_id, vehicle_rows, request_times)
+                    metrics.set_gauge('ingest_queue_rows',
+                                      ingest_queue.depth()['rows'])
+            except Exception as e:
+                metrics.inc('failures_total', agency = agency_id,
+                            stage = 'update_vehicle_locations')
+                print("Polling agency " + agency_id + " failed: " + repr(e))
+            metrics.observe('cycle_seconds', monotonic() - cycle_start,
+                            agency = agency_id)
+            if schedule is not None:
+                schedule.report(agency_id)
+            # Schedule the next poll. If this one overran any deadlines,
+            #   skip them instead of queueing them up.
+            [next_poll, skipped] = next_deadline(next_poll, resttime)
+            if skipped:
+                stats['skipped_ticks'] += skipped
+                metrics.inc('schedule_skipped_ticks_total', skipped,
+                            agency = agency_id)
+                print(
+                    "Polling agency " + agency_id + " fell behind: skipped "
+                    + str(skipped) + " tick(s)"
+                )
@@ -0,0 +1,281 @@
+"""Poll an agency's arrival predictions into the database:
+  1. Connect to the DB.
+  2. Get the agency's stops on its current service stop orders, as
+     stored by the daily update of run.py or daemon.py, optionally only
+     those of some routes (`-R`) or listed in a file (`-F`, one
+     `route|stop` pair of tags per line).
+  3. Pack the stops into as few "predictionsForMultiStops" requests as
+     the URL length limit allows.
+  4. Every `-r` seconds, make the requests, parse each response in one
+     streaming pass, and COPY the predictions into nextbus.prediction.
+
+The list of stops is reloaded every `-i` seconds (default 3600), so it
+follows the daily updates.
+
+Usage:
+  python predictions.py -h HOST -d DB -U USER -a AGENCY -r RESTTIME
+                        [-R ROUTE,ROUTE...] [-F STOPS_FILE]
+                        [-u MAX_URL_LENGTH] [-i RELOAD_SECONDS]
+                        [-w WORKERS] [-t TIMEOUT] [-Q RPS]
+"""
+
+import sys
+import datetime
+import urllib.parse
+import concurrent.futures
+from time import sleep, monotonic
+
+from lxml import etree
+
+import cli
+import connect
+import agency
+import ingest
+import metrics
+import pipeline
+import route
+
+
+# The longest URL, and the most stops, of a predictionsForMultiStops
+# request.
+MAX_URL_LENGTH = 2000
+MAX_STOPS = 150
+
+
+# Get the (route tag, stop tag) pairs of an agency's stops that lie on
+# its services' current stop orders, with their stop UUIDs.
+#
+# If `route_tags` is given, only those routes' stops are kept. If
+# `stop_pairs` is given, only the stops among those (route tag, stop
+# tag) pairs are kept.
+#
+# Return them as a dict from (key) (route tag, stop tag) -> (value) stop
+# UUID, sorted by route and stop tag.
+def load_stops(conn, agency_id, route_tags=None, stop_pairs=None):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT DISTINCT ON (route.tag, stop.tag) "
+            + "route.tag, stop.tag, stop_id "
+            + "FROM nextbus.service_stop_order "
+            + "INNER JOIN nextbus.stop USING (stop_id) "
+            + "INNER JOIN nextbus.route ON route.route_id = stop.route_id "
+            + "WHERE route.agency_id = %s AND valid_until IS NULL "
+            + "ORDER BY route.tag, stop.tag, stop_id",
+            (agency_id,)
+        )
+        rows = cur.fetchall()
+    if route_tags is not None:
+        route_tags = set(route_tags)
+        rows = [r for r in rows if r[0] in route_tags]
+    if stop_pairs is not None:
+        stop_pairs = set(stop_pairs)
+        rows = [r for r in rows if (r[0], r[1]) in stop_pairs]
+    return dict(((r[0], r[1]), r[2]) for r in rows)
+
+
+# Pack (route tag, stop tag) pairs into "predictionsForMultiStops"
+# commands, each with as many `stops=route|stop` parameters as fit in
+# `max_url_length` characters of URL (and at most `max_stops`).
+#
+# Return the list of commands.
+def pack_commands(agency_id, pairs, max_url_length=MAX_URL_LENGTH,
+                  max_stops=MAX_STOPS):
+    prefix = 'predictionsForMultiStops&a=' + urllib.parse.quote(agency_id)
+    room = max_url_length - len(route.BASE_URL) - len(prefix)
+    commands = []
+    params = []
+    length = 0
+    for [route_tag, stop_tag] in pairs:
+        param = '&stops=' + urllib.parse.quote(
+            route_tag + '|' + stop_tag, safe=''
+        )
+        if params and (length + len(param) > room
+                       or len(params) >= max_stops):
+            commands.append(prefix + ''.join(params))
+            params = []
+            length = 0
+        params.append(param)
+        length += len(param)
+    if params:
+        commands.append(prefix + ''.join(params))
+    return commands
+
+
+# Parse a "predictionsForMultiStops" response, read from the file-like
+# `predictions_source`, into prediction rows.
+#
+# The XML is parsed incrementally as it arrives: each stop's
+# 'predictions' element gives the route and stop of the 'prediction'
+# elements within it, which are cleared as soon as they have been read.
+#
+# Return a list of (service UUID, stop UUID, vehicle tag, predicted
+# timestamp, is departure, trip tag, block, affected by layover,
+# request timestamp) tuples.
+def parse_predictions(predictions_source, agency_id, stops,
+                      route_service_dicts, requested_at):
+    prediction_rows = []
+    [route_tag, stop_tag] = [None, None]
+    for [event, i] in etree.iterparse(
+        predictions_source, events=('start', 'end'),
+        tag=('predictions', 'prediction')
+    ):
+        if i.tag == 'predictions':
+            if event == 'start':
+                [route_tag, stop_tag] = [i.get('routeTag'), i.get('stopTag')]
+            else:
+                # Free the stop's element, and any already-read siblings.
+                i.clear()
+                while i.getprevious() is not None:
+                    del i.getparent()[0]
+            continue
+        if event == 'start':
+            continue
+        try:
+            service_id = route_service_dicts[route_tag][i.get('dirTag')]
+            stop_id = stops[(route_tag, stop_tag)]
+        except KeyError:
+            metrics.inc('nextbus_unknown_service_tags_total',
+                        agency=agency_id)
+            i.clear()
+            continue
+        prediction_rows.append((
+            service_id,
+            stop_id,
+            i.get('vehicle'),
+            datetime.datetime.utcfromtimestamp(
+                float(i.get('epochTime')) / 1000
+            ),
+            i.get('isDeparture') == 'true',
+            i.get('tripTag'),
+            i.get('block'),
+            i.get('affectedByLayover') == 'true',
+            requested_at
+        ))
+        i.clear()
+    return prediction_rows
+
+
+# Get the predictions of one packed command.
+def get_predictions(command, agency_id, stops, route_service_dicts,
+                    timeout=None):
+    requested_at = datetime.datetime.utcnow()
+    with route.open_feed(command, timeout=timeout) as predictions_source:
+        return parse_predictions(
+            predictions_source, agency_id, stops, route_service_dicts,
+            requested_at
+        )
+
+
+# Insert prediction rows, as returned by parse_predictions, to
+# nextbus.prediction through COPY.
+def insert_predictions(conn, prediction_rows):
+    with conn.cursor() as cur:
+        with metrics.timer('db_statement_seconds',
+                           statement='copy_prediction'):
+            cur.copy_expert(
+                "COPY nextbus.prediction (service_id, stop_id, vehicle_tag, "
+                + "predicted_timestamp, is_departure, trip_tag, block, "
+                + "affected_by_layover, request_timestamp) FROM STDIN",
+                ingest.RowReader(prediction_rows)
+            )
+
+
+# Poll an agency's predictions indefinitely, every `resttime` seconds,
+# reloading its stops every `reload_interval` seconds. Takes the stop
+# subset arguments of load_stops.
+#
+# The packed requests are made by up to `workers` threads. A failing
+# request is left out of its cycle without affecting the others.
+def poll_predictions(pool, agency_id, resttime, route_tags=None,
+                     stop_pairs=None, max_url_length=MAX_URL_LENGTH,
+                     reload_interval=3600, workers=1, timeout=None):
+    reload_at = monotonic()
+    next_poll = monotonic()
+    while True:
+        if monotonic() >= reload_at:
+            with connect.pooled(pool) as conn:
+                stops = load_stops(conn, agency_id, route_tags, stop_pairs)
+                agency.refresh_dimensions(conn, agency_id)
+            commands = pack_commands(agency_id, sorted(stops),
+                                     max_url_length)
+            reload_at = monotonic() + reload_interval
+        route_service_dicts = agency.DIMENSIONS[agency_id][
+            'route_service_dicts'
+        ]
+        cycle_start = monotonic()
+
+        def poll(command):
+            try:
+                return get_predictions(command, agency_id, stops,
+                                       route_service_dicts, timeout)
+            except Exception as e:
+                metrics.inc('failures_total', agency=agency_id,
+                            stage='get_predictions')
+                print("Getting predictions of agency " + agency_id
+                      + " failed: " + repr(e))
+                return []
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            prediction_rows = [
+                row for rows in executor.map(poll, commands) for row in rows
+            ]
+        if prediction_rows:
+            try:
+                with connect.pooled(pool) as conn:
+                    insert_predictions(conn, prediction_rows)
+                metrics.inc('prediction_rows_inserted_total',
+                            len(prediction_rows), agency=agency_id)
+            except Exception as e:
+                metrics.inc('failures_total', agency=agency_id,
+                            stage='insert_predictions')
+                print("Writing predictions of agency " + agency_id
+                      + " failed: " + repr(e))
+        metrics.observe('prediction_cycle_seconds',
+                        monotonic() - cycle_start, agency=agency_id)
+        # Rest until the next poll, skipping missed ones the same way
+        # as the vehicle polls.
+        [next_poll, skipped] = pipeline.next_deadline(next_poll, resttime)
+        if skipped:
+            metrics.inc('prediction_skipped_ticks_total', skipped,
+                        agency=agency_id)
+        sleep(max(0, next_poll - monotonic()))
+
+
+# Read a file of `route|stop` pairs of tags, one per line.
+def read_stop_pairs(path):
+    with open(path) as f:
+        return [
+            tuple(line.strip().split('|', 1)) for line in f
+            if '|' in line
+        ]
+
+
+if __name__ == '__main__':
+    sysargs = cli.getopts(sys.argv)
+    # Extract the polling options. See cli.py.
+    poll_options = cli.poll_options(sysargs)
+    cli.configure_retries(sysargs)
+    cli.configure_archive(sysargs)
+    cli.configure_metrics(sysargs)
+    pool = connect.pgpool(
+        pghost  = sysargs['-h'],
+        pgdb    = sysargs['-d'],
+        pguser  = sysargs['-U'],
+        maxconn = 1
+    )
+    route.resize_session(max(poll_options['workers'], 10))
+    poll_predictions(
+        pool,
+        sysargs['-a'],
+        float(sysargs['-r']),
+        route_tags = (
+            sysargs['-R'].split(',') if '-R' in sysargs else None
+        ),
+        stop_pairs = (
+            read_stop_pairs(sysargs['-F']) if '-F' in sysargs else None
+        ),
+        max_url_length = int(sysargs.get('-u', str(MAX_URL_LENGTH))),
+        reload_interval = float(sysargs.get('-i', '3600')),
+        workers = poll_options['workers'],
+        timeout = poll_options['timeout']
+    )
@@ -0,0 +1,118 @@
+"""Replay archived NextBus responses into the database:
+  1. Connect to the DB.
+  2. Read every record of the archive segments in the directory passed
+     as a sysarg (written by run.py or daemon.py with `-A`), oldest
+     first.
+  3. Parse each "vehicleLocations" response with the same code as the
+     live pipeline, and write the vehicle rows in large batches through
+     the same insert path.
+
+No network requests are made, so this runs as fast as the DB allows.
+It can backfill vehicle locations lost to DB downtime, or serve as a
+repeatable ingest workload for measuring throughput.
+
+The agencies' routes and services must already be in the DB. Reports
+already stored are skipped by the vehicle_location unique index. The
+vehicle_location partitions that each batch's rows fall in are created
+first if they're missing, by `-I` (`day`, the default, or `month`) as
+for the pollers.
+
+Usage:
+  python replay.py -h HOST -d DB -U USER -A ARCHIVE_DIR [-a AGENCY]
+                   [-n BATCH_ROWS] [-I INTERVAL]
+"""
+
+import io
+import sys
+import datetime
+import timeit
+import urllib.parse
+
+import cli
+import connect
+import agency
+import archive
+import ingest
+import partition
+import route
+
+
+# Write each agency's buffered vehicle rows, then empty the buffer.
+#
+# The rows may be older than the partitions the pollers create, so the
+# partitions covering their dates are created first.
+def flush(conn, agency_rows, interval='day'):
+    timestamps = [
+        row[4] for rows in agency_rows.values() for row in rows
+    ]
+    if timestamps:
+        partition.create_partitions(
+            conn, min(timestamps).date(), max(timestamps).date(), interval
+        )
+    for [agency_id, rows] in agency_rows.items():
+        ingest.write_vehicle_rows(conn, agency_id, rows)
+    agency_rows.clear()
+
+
+# Replay the vehicleLocations responses of the given archive segments,
+# optionally only those of the agency `only_agency`, writing rows in
+# batches of about `batch_rows` into vehicle_location partitions of
+# `interval`.
+#
+# Return a list with the number of (1) responses replayed and (2)
+# vehicle rows parsed.
+def replay(conn, paths, only_agency=None, batch_rows=50000,
+           interval='day'):
+    n_responses = 0
+    n_rows = 0
+    # Buffered rows, from (key) agency_id -> (value) list of rows.
+    agency_rows = dict()
+    buffered = 0
+    for [url, fetched_at, payload] in archive.iter_records(paths):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+        if query.get('command') != ['vehicleLocations']:
+            continue
+        agency_id = query['a'][0]
+        if only_agency is not None and agency_id != only_agency:
+            continue
+        route_tag = query['r'][0] if 'r' in query else None
+        dimensions = agency.get_dimensions(conn, agency_id)
+        [vehicle_rows, this_request] = route.parse_vehicle_locations(
+            vehicle_source=io.BytesIO(payload),
+            agency_id=agency_id,
+            service_dict=dimensions['service_dict'],
+            route_service_dicts=dimensions['route_service_dicts'],
+            route_tag=route_tag,
+            fetched_at=datetime.datetime.utcfromtimestamp(fetched_at)
+        )
+        n_responses += 1
+        n_rows += len(vehicle_rows)
+        agency_rows.setdefault(agency_id, []).extend(vehicle_rows)
+        buffered += len(vehicle_rows)
+        if buffered >= batch_rows:
+            flush(conn, agency_rows, interval)
+            buffered = 0
+    flush(conn, agency_rows, interval)
+    return [n_responses, n_rows]
+
+
+if __name__ == '__main__':
+    sysargs = cli.getopts(sys.argv)
+    conn = connect.pgconnect(
+        pghost = sysargs['-h'],
+        pgdb   = sysargs['-d'],
+        pguser = sysargs['-U']
+    )
+    start = timeit.default_timer()
+    [n_responses, n_rows] = replay(
+        conn,
+        archive.segment_paths(sysargs['-A']),
+        only_agency = sysargs.get('-a'),
+        batch_rows = int(sysargs.get('-n', '50000')),
+        interval = cli.partition_options(sysargs)['interval']
+    )
+    elapsed = timeit.default_timer() - start
+    print('Replayed {0} responses, {1} vehicle rows, in {2:.1f}s '
+          '({3:.0f} rows/s)'.format(
+              n_responses, n_rows, elapsed, n_rows / max(elapsed, 1e-9)
+          ))
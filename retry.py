@@ -0,0 +1,80 @@
+import time
+import random
+import threading
+
+
+# Find how long to wait before retry number `attempt` (counting from 0):
+# an exponential backoff from `base_delay` seconds, capped at
+# `max_delay`, with full jitter so that retries from many routes don't
+# line up.
+def backoff_delay(attempt, base_delay=0.5, max_delay=8.0):
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+# Call `func` with no arguments, retrying it up to `retries` times if it
+# raises one of the `retryable` exceptions, with a backoff_delay wait
+# before each retry. `on_retry`, if given, is called with the exception
+# before each retry.
+#
+# Return what `func` returns, or raise its last exception.
+def call_with_retries(func, retryable=(Exception,), retries=2,
+                      base_delay=0.5, max_delay=8.0, on_retry=None):
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except retryable as e:
+            if attempt >= retries:
+                raise
+            if on_retry is not None:
+                on_retry(e)
+            time.sleep(backoff_delay(attempt, base_delay, max_delay))
+            attempt += 1
+
+
+# A thread-safe circuit breaker over a set of keys, e.g. routes.
+#
+# After `threshold` consecutive failures, a key's circuit opens and the
+# key is skipped for `cooldown` seconds. Then a single call is let
+# through: if it succeeds the circuit closes, and if it fails the
+# circuit opens again for twice as long, up to `max_cooldown`.
+class CircuitBreaker(object):
+    def __init__(self, threshold=3, cooldown=60.0, max_cooldown=3600.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        # From (key) key -> (value) [consecutive failures, monotonic
+        # time until which the circuit is open, current cooldown].
+        self.states = dict()
+        self.lock = threading.Lock()
+
+    # Whether a call for `key` should be made now.
+    def allow(self, key):
+        with self.lock:
+            state = self.states.get(key)
+            return state is None or time.monotonic() >= state[1]
+
+    def record_success(self, key):
+        with self.lock:
+            self.states.pop(key, None)
+
+    # Record a failed call for `key`. Return True if it opened the
+    # circuit.
+    def record_failure(self, key):
+        with self.lock:
+            state = self.states.setdefault(key, [0, 0.0, self.cooldown])
+            state[0] += 1
+            if state[0] < self.threshold:
+                return False
+            # A failure after the circuit has already opened once
+            # doubles its cooldown.
+            if state[0] > self.threshold:
+                state[2] = min(self.max_cooldown, state[2] * 2)
+            state[1] = time.monotonic() + state[2]
+            return True
+
+    # Get the keys whose circuit is currently open.
+    def open_keys(self):
+        now = time.monotonic()
+        with self.lock:
+            return [k for [k, s] in self.states.items() if now < s[1]]
@@ -1,31 +1,206 @@
+import io
+import time
 import datetime
+import contextlib
+import urllib.parse
 
 import requests
+import requests.adapters
 import uuid
 import psycopg2
 from lxml import etree
 
+import metrics
+import retry
+
 # Set the base URL path of all NextBus API requests.
 BASE_URL = 'http://webservices.nextbus.com/service/publicXMLFeed?command='
 
+# Share one keep-alive HTTP session between all NextBus API requests, so
+# that connections are reused across routes and poll cycles.
+SESSION = requests.Session()
+
+
+# The namespace of the name-based (UUIDv5) route, service and stop UUIDs.
+UUID_NAMESPACE = uuid.UUID('6263c085-ca62-5c1c-ade4-48853583e219')
+
+
+# If set to an archive.FeedArchive, every raw NextBus response is
+# appended to it, with its request URL and fetch time.
+ARCHIVE = None
+
+
+# Get the metric labels of a NextBus API request from its `command`:
+# the endpoint, and the agency and route it was made for.
+def command_labels(command):
+    query = urllib.parse.parse_qs('command=' + command)
+    return {
+        'endpoint': query['command'][0],
+        'agency': query.get('a', [''])[0],
+        'route': query.get('r', [''])[0]
+    }
+
+
+# The NextBus request failures worth retrying: connection errors,
+# timeouts, and server errors (raised by get_response).
+RETRYABLE = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.HTTPError
+)
+
+# Retry a failed NextBus request up to this many times, waiting an
+# exponential backoff with jitter from RETRY_BASE_DELAY seconds up to
+# RETRY_MAX_DELAY seconds before each retry.
+RETRIES = 2
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+
+
+# If set to an adaptive.RateLimiter, every NextBus request (including
+# retries) waits for it, capping the process' request rate.
+LIMITER = None
 
-# Get a route's current services from the "routeConfig" API endpoint.
+
+# GET a NextBus API URL through the shared session, retrying it as set
+# by RETRIES if it fails.
 #
-# Return them as a list of tuples to be upserted to the database.
-def get_services(route):
-    route_id  = route[0]
+# Return the response. A server error is raised as an HTTPError.
+def get_response(command, timeout=None, stream=False):
+    def get():
+        if LIMITER is not None:
+            LIMITER.acquire()
+        response = SESSION.get(BASE_URL + command, timeout=timeout,
+                               stream=stream)
+        if response.status_code >= 500:
+            response.close()
+            response.raise_for_status()
+        return response
+
+    def on_retry(e):
+        if metrics.ENABLED:
+            metrics.inc('nextbus_http_retries_total', **command_labels(command))
+
+    try:
+        return retry.call_with_retries(
+            get, RETRYABLE, RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+            on_retry
+        )
+    except Exception:
+        if metrics.ENABLED:
+            metrics.inc('nextbus_http_failures_total', **command_labels(command))
+        raise
+
+
+# Hit a NextBus API endpoint with `command`, the command name followed
+# by its query string.
+#
+# Return the raw XML payload.
+def fetch(command, timeout=None):
+    url = BASE_URL + command
+    fetched_at = time.time()
+    payload = get_response(command, timeout).content
+    if metrics.ENABLED:
+        labels = command_labels(command)
+        metrics.observe('nextbus_http_seconds', time.time() - fetched_at,
+                        **labels)
+        metrics.observe('nextbus_http_bytes', len(payload), **labels)
+    if ARCHIVE is not None:
+        ARCHIVE.append(url, fetched_at, payload)
+    return payload
+
+
+# Hit a NextBus API endpoint with `command` for the duration of a `with`
+# block, streaming the response.
+#
+# Yield a file-like object over the decoded XML payload. If responses
+# are being archived, the payload is read in full first.
+#
+# Only the request itself is retried: once the body is being read, a
+# failure is raised to the caller.
+@contextlib.contextmanager
+def open_feed(command, timeout=None):
+    if ARCHIVE is not None:
+        yield io.BytesIO(fetch(command, timeout))
+        return
+    response = get_response(command, timeout, stream=True)
+    with response:
+        response.raw.decode_content = True
+        yield response.raw
+        # The body is read while it's parsed, so only the time to the
+        # response headers counts as HTTP latency.
+        if metrics.ENABLED:
+            labels = command_labels(command)
+            metrics.observe('nextbus_http_seconds',
+                            response.elapsed.total_seconds(), **labels)
+            metrics.observe('nextbus_http_bytes', response.raw.tell(),
+                            **labels)
+
+
+# Resize the shared session's connection pool so that it can hold at
+# least `pool_size` concurrent keep-alive connections.
+def resize_session(pool_size):
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    SESSION.mount('http://', adapter)
+    SESSION.mount('https://', adapter)
+
+
+# Derive the UUIDs of routes, services and stops from their natural
+# keys, so that the same row always gets the same UUID, and a refresh
+# that finds nothing new has nothing to write.
+#
+# A route is identified by its agency and tag.
+def route_uuid(agency_id, route_tag):
+    return uuid.uuid5(UUID_NAMESPACE, 'route/{0}/{1}'.format(
+        agency_id, route_tag
+    ))
+
+
+# A service is identified by its route and (possibly NULL) tag.
+def service_uuid(route_id, service_tag):
+    return uuid.uuid5(route_id, 'service/{0}'.format(
+        '' if service_tag is None else service_tag
+    ))
+
+
+# A stop is identified by its route, tag and (possibly NULL) lon/lat.
+def stop_uuid(route_id, stop_tag, lon, lat):
+    return uuid.uuid5(route_id, 'stop/{0}/{1}/{2}'.format(
+        stop_tag,
+        '' if lon is None else lon,
+        '' if lat is None else lat
+    ))
+
+
+# Get a route's current "routeConfig" from the nextbus API.
+#
+# Return the raw XML payload. It is fetched once per refresh and parsed
+# once, and the resulting etree is passed to each of the extractors
+# below.
+#
+# `timeout` (in seconds) bounds the request; None waits indefinitely.
+def get_route_config(route, timeout=None):
     agency_id = route[1]
     route_tag = route[2]
     # Hit the routeConfig endpoint.
-    route_config_xml = requests.get(
-        BASE_URL + 'routeConfig&a={0}&r={1}&verbose=true'.format(
-            agency_id, route_tag
-        )
-    ).content
-    route_config_etree = etree.fromstring(route_config_xml)
+    route_config_xml = fetch(
+        'routeConfig&a={0}&r={1}&verbose=true'.format(agency_id, route_tag),
+        timeout
+    )
+    return route_config_xml
+
+
+# Get a route's current services from its parsed "routeConfig".
+#
+# Return them as a list of tuples to be upserted to the database.
+def get_services(route, route_config_etree):
+    route_id  = route[0]
     # Format the route's services as a list of tuples for psycopg2.
     service_rows = [(
-        uuid.uuid4(),
+        service_uuid(route_id, i.get('tag')),
         route_id,
         i.get('tag'),
         i.get('title'),
@@ -34,35 +209,28 @@ def get_services(route):
     ) for i in route_config_etree.iter('direction')]
     # Include a NULL service tag, used for vehicles that are not
     # currently running a service.
-    service_rows.extend([(uuid.uuid4(), route_id, None, None, None, False)])
+    service_rows.extend([
+        (service_uuid(route_id, None), route_id, None, None, None, False)
+    ])
     # Return the list of service tuples.
     return service_rows
 
 
-# Get a route's current stops from the "routeConfig" API endpoint.
+# Get a route's current stops from its parsed "routeConfig".
 # - Also note which stops show up under the 'direction' headings, but
 #   not in the body of the XML. These stops are considered "missing",
 #   and are dealt with in a subsequent step.
 #
 # Return both lists of tuples: the stops in the body of the routeConfig
 # XML, and the "missing" stops.
-def get_stops(route):
+def get_stops(route, route_config_etree):
     route_id  = route[0]
-    agency_id = route[1]
-    route_tag = route[2]
-    # Hit the routeConfig endpoint.
-    route_config_xml = requests.get(
-        BASE_URL + 'routeConfig&a={0}&r={1}&verbose=true'.format(
-            agency_id, route_tag
-        )
-    ).content
-    route_config_etree = etree.fromstring(route_config_xml)
     # Format the route's stops as a list of tuples for psycopg2.
     #
     # These will be passed to the mogrify function so that postgis
     # commands can be wrapped around them.
     stop_rows = [(
-        uuid.uuid4(),
+        stop_uuid(route_id, i.get('tag'), i.get('lon'), i.get('lat')),
         route_id,
         i.get('tag'),
         i.get('title'),
@@ -74,30 +242,22 @@ def get_stops(route):
     #
     # Store them as a set to avoid duplicates.
     all_stops     = set(i.get('tag') for i in route_config_etree.iter('stop'))
-    missing_stops = set((route_id, s) for s in all_stops \
-        if s not in [sa[2] for sa in stop_rows])
+    body_stops    = set(sa[2] for sa in stop_rows)
+    missing_stops = set((route_id, s) for s in all_stops - body_stops)
     # Return a list with (1) the stop_rows list and (2) the
     # missing_stops set.
     return [stop_rows, missing_stops]
 
 
-# Get a route's current service stop orders from the "routeConfig" API
-# endpoint.
+# Get a route's current service stop orders from its parsed
+# "routeConfig".
+#
+# Each row is stamped with `now`, the UTC datetime of the refresh, which
+# is shared by all of the agency's routes.
 #
 # Return them as a list of tuples to be upserted to the database.
-def get_service_stop_orders(conn, route):
+def get_service_stop_orders(conn, route, route_config_etree, now):
     route_id  = route[0]
-    agency_id = route[1]
-    route_tag = route[2]
-    # Get the current UTC datetime.
-    now = datetime.datetime.utcnow()
-    # Hit the routeConfig endpoint.
-    route_config_xml = requests.get(
-        BASE_URL + 'routeConfig&a={0}&r={1}&verbose=true'.format(
-            agency_id, route_tag
-        )
-    ).content
-    route_config_etree = etree.fromstring(route_config_xml)
     # Get all services running on and stops lying on the current route.
     with conn.cursor() as cur:
         # Get services.
@@ -140,67 +300,155 @@ def get_service_stop_orders(conn, route):
 # Get a route's current vehicle locations from the "vehicleLocations"
 # API endpoint.
 #
-# Return as a list of tuples to be passed to the mogrify function before
-# being inserted to the database.
+# Return as a list of tuples to be streamed to the database, along with
+# the epoch time of the API request.
+#
+# `timeout` (in seconds) bounds the request; None waits indefinitely.
 def get_vehicle_locations(conn, route, service_dict,
-                          route_service_dict, previous_request):
-    route_id  = route[0]
+                          route_service_dict, previous_request,
+                          timeout=None):
     agency_id = route[1]
     route_tag = route[2]
     # Hit the vehicleLocations endpoint.
-    vehicle_xml = requests.get(
-        BASE_URL + 'vehicleLocations&a={0}&r={1}&t={2}'.format(
+    with open_feed(
+        'vehicleLocations&a={0}&r={1}&t={2}'.format(
             agency_id, route_tag, previous_request
+        ),
+        timeout=timeout
+    ) as vehicle_source:
+        # Every vehicle in the response runs on this route, so look its
+        # 'dirTag' up in this route's services.
+        return parse_vehicle_locations(
+            vehicle_source=vehicle_source,
+            agency_id=agency_id,
+            service_dict=service_dict,
+            route_service_dicts={route_tag: route_service_dict},
+            route_tag=route_tag
         )
-    ).content
-    vehicle_etree = etree.fromstring(vehicle_xml)
-    # Get the time (in epoch microseconds since 1970) of this API
-    # request.
-    #
-    # This will be returned along with the vehicle locations.
-    try:
-        this_request = vehicle_etree.find('lastTime').get('time')
-        # Convert to a UTC datetime representation. This will be used to
-        # populate the location_datetime field.
-        request_datetime = datetime.datetime.utcfromtimestamp(
-            round(float(this_request) / 1000)
-        )    
-    except:
-        this_request = '0'
-        request_datetime = datetime.datetime.utcnow().replace(microsecond=0)
-    # Initiate the list of tuples that will contain the route's vehicle
-    # locations.
-    vehicle_rows = []
-    # Loop through each vehicle to create its tuple of column values for
-    # postgres.
-    for i in vehicle_etree.iter('vehicle'):
+
+
+# Get all of an agency's current vehicle locations from a single
+# "vehicleLocations" API request, made without a route.
+#
+# route_service_dicts is an in-memory index from (key) route tag ->
+# (value) route-specific dict from service tag -> service UUID. Each
+# vehicle's 'routeTag' and 'dirTag' are matched to a service UUID
+# through it.
+#
+# Return as a list of tuples to be streamed to the database, along with
+# the epoch time of the API request.
+def get_agency_vehicle_locations(agency_id, service_dict,
+                                 route_service_dicts, previous_request,
+                                 timeout=None):
+    # Hit the vehicleLocations endpoint.
+    with open_feed(
+        'vehicleLocations&a={0}&t={1}'.format(agency_id, previous_request),
+        timeout=timeout
+    ) as vehicle_source:
+        return parse_vehicle_locations(
+            vehicle_source=vehicle_source,
+            agency_id=agency_id,
+            service_dict=service_dict,
+            route_service_dicts=route_service_dicts
+        )
+
+
+# Parse a "vehicleLocations" response, read from the file-like
+# `vehicle_source`, into vehicle rows.
+#
+# The XML is parsed incrementally as it arrives, and each vehicle
+# element is cleared as soon as it has been read, so memory use doesn't
+# grow with the size of the payload beyond the rows themselves.
+#
+# If `route_tag` is given, every vehicle is taken to run on that route;
+# otherwise each vehicle's own 'routeTag' is used.
+#
+# If the response has no request time, `fetched_at` (a UTC datetime,
+# e.g. of an archived response) is used instead, defaulting to now.
+#
+# Return as a list of tuples to be streamed to the database, along with
+# the epoch time of the API request.
+def parse_vehicle_locations(vehicle_source, agency_id, service_dict,
+                            route_service_dicts, route_tag=None,
+                            fetched_at=None):
+    # Initiate the list of tuples that will contain the vehicle
+    # locations, each with its 'secsSinceReport' in place of its
+    # location timestamp until the request time is known.
+    partial_rows = []
+    this_request = None
+    parse_start = time.time()
+    for [event, i] in etree.iterparse(
+        vehicle_source, events=('end',), tag=('vehicle', 'lastTime')
+    ):
+        if i.tag == 'lastTime':
+            this_request = i.get('time')
+            continue
         # Match 'dirTag's to service UUIDs as follows:
-        #   1. Try to find 'dirTag' in the route_service_dict.
+        #   1. Try to find 'dirTag' in the vehicle's route's
+        #      route_service_dict.
         #   2. If (1) doesn't work, try to find 'dirTag' in the
         #      agency-wide service_dict.
         #   3. If (2) doesn't work, skip to the next vehicle in the for
         #      loop.
+        dir_tag = i.get('dirTag')
         try:
-            service_id = route_service_dict[i.get('dirTag')]
+            route_service_dict = route_service_dicts[
+                route_tag if route_tag is not None else i.get('routeTag')
+            ]
+            service_id = route_service_dict[dir_tag]
         except:
             try:
-                service_id = service_dict[i.get('dirTag')]
+                service_id = service_dict[dir_tag]
             except:
                 print(
-                    i.get('dirTag')
+                    str(dir_tag)
                     + " is not a valid service tag for agency "
                     + agency_id
                 )
-                continue
-        # Extend the vehicle_rows list to include a tuple containing
-        # this vehicle's most recent location and other information.
-        vehicle_rows.extend([(
-            service_id,
-            i.get('id'),
-            i.get('lon'),
-            i.get('lat'),
-            request_datetime - datetime.timedelta(seconds=float(i.get('secsSinceReport'))),
-            i.get('predictable') == 'true'
-        )])
+                metrics.inc('nextbus_unknown_service_tags_total',
+                            agency=agency_id)
+                service_id = None
+        if service_id is not None:
+            partial_rows.append((
+                service_id,
+                i.get('id'),
+                i.get('lon'),
+                i.get('lat'),
+                i.get('secsSinceReport'),
+                i.get('predictable') == 'true'
+            ))
+        # Free the vehicle element, and any already-read siblings.
+        i.clear()
+        while i.getprevious() is not None:
+            del i.getparent()[0]
+    # Get the time (in epoch microseconds since 1970) of this API
+    # request. The lastTime element comes after the vehicles.
+    #
+    # This will be returned along with the vehicle locations.
+    try:
+        # Convert to a UTC datetime representation. This will be used to
+        # populate the location_datetime field.
+        request_datetime = datetime.datetime.utcfromtimestamp(
+            round(float(this_request) / 1000)
+        )
+    except:
+        this_request = '0'
+        if fetched_at is None:
+            fetched_at = datetime.datetime.utcnow()
+        request_datetime = fetched_at.replace(microsecond=0)
+    # Compute every row's location timestamp in one batch. Many vehicles
+    # share the same 'secsSinceReport', so each distinct value is only
+    # converted once.
+    location_timestamps = dict(
+        (secs, request_datetime - datetime.timedelta(seconds=float(secs)))
+        for secs in set(pr[4] for pr in partial_rows)
+    )
+    vehicle_rows = [
+        pr[:4] + (location_timestamps[pr[4]], pr[5]) for pr in partial_rows
+    ]
+    metrics.observe('nextbus_parse_seconds', time.time() - parse_start,
+                    agency=agency_id)
+    metrics.inc('nextbus_vehicle_rows_parsed_total', len(vehicle_rows),
+                agency=agency_id)
     # Return the vehicle rows, and the epoch time of the API request.
     return [vehicle_rows, this_request]
@@ -6,15 +6,20 @@
     b. Update the services (called "direction"s by nextbus).
     c. Update the stops.
     d. Update the order in which stops lie on route-services.
-    e. Update the most recent vehicle locations for each route.
+    e. Update the most recent vehicle locations for each route,
+       optionally polling several routes concurrently, or for the
+       whole agency with a single request. Vehicle rows can be
+       written inline, or queued for a separate writer thread.
 
-3e will loop indefinitely with a rest (passed as sysarg) between 
-iterations.
+3e will loop indefinitely, once every poll period (passed as sysarg).
+Polls fire on fixed deadlines; polls that overrun skip missed ticks.
 
 3a-d will repeat at the beginning of every day in the timezone passed
 as a sysarg.
 """
 
+# To poll several agencies from one process, see daemon.py.
+
 # PLEASE TAKE NOTE
 #
 # Since this script loops infinitely, it's up to the user to kill the
@@ -23,31 +28,17 @@ as a sysarg.
 
 import sys
 import pytz
-import datetime
-from time import sleep
 
+import cli
 import connect
 import agency
-
-
-# Create a dict from the sys args.
-# Credit goes entirely to https://gist.github.com/dideler/2395703.
-def getopts(argv):
-    # Empty dictionary to store key-value pairs.
-    opts = {}
-    # While there are arguments left to parse...
-    while argv:
-        # Found a "-name value" pair.
-        if argv[0][0] == '-':
-            # Add key and value to the dictionary.
-            opts[argv[0]] = argv[1]
-        # Reduce the argument list by copying it starting from index 1.
-        argv = argv[1:]
-    return opts
+import ingest
+import pipeline
+import route
 
 
 # Process the sysargs.
-sysargs = getopts(sys.argv)
+sysargs = cli.getopts(sys.argv)
 # Extract the individual opts from the sysargs.
 host      = sysargs['-h']
 db        = sysargs['-d']
@@ -55,6 +46,14 @@ user      = sysargs['-U']
 agency_id = sysargs['-a']
 tzone     = sysargs['-z']
 resttime  = sysargs['-r']
+# Extract the polling, partitioning and ingest queue options. See cli.py.
+poll_options = cli.poll_options(sysargs)
+poll_options['partition_options'] = cli.partition_options(sysargs)
+[ingest_queue, writer_options] = cli.ingest_options(sysargs)
+cli.configure_retries(sysargs)
+cli.configure_livestate(sysargs)
+cli.configure_archive(sysargs)
+cli.configure_metrics(sysargs)
 
 # Pass the 'timezone' string to pytz.timezone().
 user_tz = pytz.timezone(tzone)
@@ -62,60 +61,33 @@ user_tz = pytz.timezone(tzone)
 resttime = float(resttime)
 
 
-# Update an agency's routes, services, stops, and service-stop orders.
-# Allow to try a number of times, since sometimes some route's services
-#   or stops are not added on the first try.
-#   TODO: this is a temporary messy workaround.
-def update_agency_info(conn, agency_id, n_tries, current_try = 1):
-    if current_try <= n_tries:
-        try:
-            agency.update_routes(conn, agency_id)
-            agency.update_services(conn, agency_id)
-            agency.update_stops(conn, agency_id)
-            agency.update_service_stop_orders(conn, agency_id)
-        except:
-            update_agency_info(conn, agency_id, n_tries, current_try + 1)
-
 # Connect to the PG database.
 # host, db, and user should be passed through the sysargs using flags
 #   -h, -d, and -U, respectively.
 # Make sure you have a ~/.pgpass file that includes this db instance.
 #   This is where the port and password will be obtained.
-conn = connect.pgconnect(
-    pghost = host,
-    pgdb   = db,
-    pguser = user
+# A single agency only ever needs one connection at a time, plus one
+#   for the writer if rows are queued.
+pool = connect.pgpool(
+    pghost  = host,
+    pgdb    = db,
+    pguser  = user,
+    maxconn = 1 if ingest_queue is None else 2
 )
+# Make sure the shared HTTP session can keep a connection alive for
+#   every worker.
+route.resize_session(max(poll_options['workers'], 10))
+# If rows are queued, start the writer that drains the queue into the
+#   DB.
+if ingest_queue is not None:
+    ingest.start_writer(ingest_queue, pool, **writer_options)
 
 
 # Update the nextbus agency list.
-agency.update_agencies(conn)
-# Set `request_times` to an empty dict.
-#   This will be updated every time the "vehicleLocations" endpoint is
-#     hit.
-request_times = dict()
+with connect.pooled(pool) as conn:
+    agency.update_agencies(conn, timeout = poll_options['timeout'])
 # Begin the infinite loop.
-while True:
-    # Update the agency's info. Try up to 10 times before throwing an
-    #   error.
-    update_agency_info(conn, agency_id, n_tries = 10)
-    # Record the date in the timezone passed as a sysarg.
-    utc_now = datetime.datetime.utcnow().replace(tzinfo = pytz.utc)
-    latest_route_update = utc_now.astimezone(user_tz).date()
-    # Until midnight, keep updating the agency's vehicle locations.
-    latest_vehicle_update = latest_route_update
-    while latest_vehicle_update == latest_route_update:
-        # Record the date.
-        #   If midnight has passed, go update the other agency info.
-        utc_now = datetime.datetime.utcnow().replace(tzinfo = pytz.utc)
-        latest_vehicle_update = utc_now.astimezone(user_tz).date()
-        # Rest before continuing.
-        sleep(resttime)
-        # If vehicle update fails, wait and try again.
-        #   This is to catch potential API downtime.
-        try:
-            request_times = agency.update_vehicle_locations(
-                conn, agency_id, request_times
-            )
-        except:
-            continue
+pipeline.poll_agency(
+    pool, agency_id, user_tz, resttime,
+    ingest_queue = ingest_queue, **poll_options
+)
@@ -0,0 +1,235 @@
+"""Serve a synthetic NextBus agency over a local HTTP stand-in for the
+publicXMLFeed API.
+
+The commands used by nextbus2pg are supported: `agencyList`,
+`routeList`, `routeConfig` and `vehicleLocations` (with or without a
+route, and with `t=` returning only vehicles that reported after it).
+
+Each route runs along a straight line of stops, with two directions.
+Vehicles move back and forth along their route and report at a fixed
+interval, staggered between vehicles. A latency (plus random jitter)
+can be injected into every response.
+
+Usage:
+  python simulator.py [-p PORT] [-a AGENCY] [-R ROUTES] [-S STOPS]
+                      [-V VEHICLES] [-i REPORT_INTERVAL] [-l LATENCY_MS]
+
+Point route.BASE_URL at the printed URL to run the pipeline against it.
+"""
+
+import sys
+import math
+import time
+import random
+import threading
+import urllib.parse
+import http.server
+from xml.sax.saxutils import quoteattr
+
+import cli
+
+
+# A synthetic agency with `n_routes` routes of `n_stops` stops each,
+# and `n_vehicles` vehicles per route reporting every `report_interval`
+# seconds.
+class SyntheticAgency(object):
+    def __init__(self, agency_id='sim', n_routes=80, n_stops=40,
+                 n_vehicles=10, report_interval=30, seed=0):
+        rng = random.Random(seed)
+        self.agency_id = agency_id
+        self.report_interval = report_interval
+        # Each route, as (tag, start lon, start lat, lon step, lat step).
+        self.routes = []
+        for r in range(n_routes):
+            angle = rng.uniform(0, 2 * math.pi)
+            self.routes.append((
+                str(r),
+                -122.5 + rng.uniform(0, 0.1),
+                37.7 + rng.uniform(0, 0.1),
+                0.002 * math.cos(angle),
+                0.002 * math.sin(angle)
+            ))
+        self.n_stops = n_stops
+        # Each vehicle, as (id, route index, report offset, phase).
+        self.vehicles = [(
+            str(r * n_vehicles + v),
+            r,
+            rng.uniform(0, report_interval),
+            rng.uniform(0, 1)
+        ) for r in range(n_routes) for v in range(n_vehicles)]
+        self.route_index = dict(
+            (route[0], r) for [r, route] in enumerate(self.routes)
+        )
+
+    # Get the lon/lat of stop `s` of route `r`.
+    def stop_location(self, r, s):
+        [tag, lon, lat, dlon, dlat] = self.routes[r]
+        return (lon + s * dlon, lat + s * dlat)
+
+    def agency_list_xml(self):
+        return (
+            '<agency tag={0} title={0} regionTitle="Simulation"/>'.format(
+                quoteattr(self.agency_id)
+            )
+        )
+
+    def route_list_xml(self):
+        return ''.join(
+            '<route tag={0} title={0}/>'.format(quoteattr(route[0]))
+            for route in self.routes
+        )
+
+    def route_config_xml(self, route_tag):
+        r = self.route_index[route_tag]
+        stops = []
+        for s in range(self.n_stops):
+            [lon, lat] = self.stop_location(r, s)
+            stops.append(
+                '<stop tag="{0}_{1}" title="Stop {1}" lat="{2:.6f}" '
+                'lon="{3:.6f}" stopId="{4}"/>'.format(
+                    route_tag, s, lat, lon, r * 10000 + s
+                )
+            )
+        directions = []
+        for d in range(2):
+            order = range(self.n_stops) if d == 0 else \
+                reversed(range(self.n_stops))
+            directions.append(
+                '<direction tag="{0}_{1}" title="Direction {1}" '
+                'name="{2}" useForUI="true">{3}</direction>'.format(
+                    route_tag, d, 'Outbound' if d == 0 else 'Inbound',
+                    ''.join(
+                        '<stop tag="{0}_{1}"/>'.format(route_tag, s)
+                        for s in order
+                    )
+                )
+            )
+        return '<route tag="{0}" title="{0}">{1}{2}</route>'.format(
+            route_tag, ''.join(stops), ''.join(directions)
+        )
+
+    # Get the vehicles of a route (or all routes, if `route_tag` is
+    # None) that last reported after the epoch time `t` in ms, as of
+    # the epoch time `now` in seconds.
+    def vehicle_locations_xml(self, route_tag, t, now):
+        r_only = None if route_tag is None else self.route_index[route_tag]
+        lines = []
+        for [vehicle_id, r, offset, phase] in self.vehicles:
+            if r_only is not None and r != r_only:
+                continue
+            # The time of the vehicle's last report.
+            reported = (
+                math.floor((now - offset) / self.report_interval)
+                * self.report_interval + offset
+            )
+            if reported * 1000 <= t:
+                continue
+            # Move back and forth along the route, one way per hour.
+            progress = (reported / 3600.0 + phase) % 2
+            direction = 0 if progress < 1 else 1
+            along = (progress if direction == 0 else 2 - progress) * \
+                (self.n_stops - 1)
+            [lon, lat] = self.stop_location(r, along)
+            lines.append(
+                '<vehicle id="{0}" routeTag="{1}" dirTag="{1}_{2}" '
+                'lat="{3:.6f}" lon="{4:.6f}" secsSinceReport="{5}" '
+                'predictable="true" heading="0" speedKmHr="20"/>'.format(
+                    vehicle_id, self.routes[r][0], direction, lat, lon,
+                    int(now - reported)
+                )
+            )
+        lines.append('<lastTime time="{0}"/>'.format(int(now * 1000)))
+        return ''.join(lines)
+
+    # Answer a publicXMLFeed query string. Return the XML payload.
+    def respond(self, query):
+        query = urllib.parse.parse_qs(query)
+        command = query.get('command', [None])[0]
+        agency_id = query.get('a', [None])[0]
+        route_tag = query.get('r', [None])[0]
+        if command == 'agencyList':
+            body = self.agency_list_xml()
+        elif agency_id != self.agency_id:
+            body = '<Error shouldRetry="false">Agency parameter "a={0}" ' \
+                'is not valid.</Error>'.format(agency_id)
+        elif command == 'routeList':
+            body = self.route_list_xml()
+        elif command == 'routeConfig' and route_tag in self.route_index:
+            body = self.route_config_xml(route_tag)
+        elif command == 'vehicleLocations' and (
+                route_tag is None or route_tag in self.route_index):
+            body = self.vehicle_locations_xml(
+                route_tag, int(query.get('t', ['0'])[0]), time.time()
+            )
+        else:
+            body = '<Error shouldRetry="false">Invalid request.</Error>'
+        return (
+            '<?xml version="1.0" encoding="utf-8" ?>\n'
+            '<body copyright="Synthetic data">' + body + '</body>'
+        ).encode('utf-8')
+
+
+# Create an HTTP request handler class serving `agency`, with `latency`
+# seconds (plus up to `jitter` more) added to every response.
+def make_handler(agency, latency=0.0, jitter=0.0):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            if latency or jitter:
+                time.sleep(latency + random.uniform(0, jitter))
+            if url.path != '/service/publicXMLFeed':
+                self.send_error(404)
+                return
+            payload = agency.respond(url.query)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+# Start serving `agency` on localhost in a background thread.
+#
+# Return a list with (1) the server, to be shut down when done, and (2)
+# the base URL to assign to route.BASE_URL.
+def start_simulator(agency, port=0, latency=0.0, jitter=0.0):
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', port), make_handler(agency, latency, jitter)
+    )
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{0}/service/publicXMLFeed?command='.format(
+        server.server_address[1]
+    )
+    return [server, base_url]
+
+
+if __name__ == '__main__':
+    sysargs = cli.getopts(sys.argv)
+    agency = SyntheticAgency(
+        agency_id = sysargs.get('-a', 'sim'),
+        n_routes = int(sysargs.get('-R', '80')),
+        n_stops = int(sysargs.get('-S', '40')),
+        n_vehicles = int(sysargs.get('-V', '10')),
+        report_interval = float(sysargs.get('-i', '30'))
+    )
+    latency = float(sysargs.get('-l', '0')) / 1000
+    [server, base_url] = start_simulator(
+        agency,
+        port = int(sysargs.get('-p', '8080')),
+        latency = latency,
+        jitter = latency / 2
+    )
+    print('Serving agency ' + agency.agency_id + ' at ' + base_url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,15 @@
+/*
+Add the nextbus.export_watermark table, as created by create_tables.sql,
+to a database created before it existed.
+*/
+SET search_path = public, postgis, nextbus;
+
+CREATE TABLE IF NOT EXISTS nextbus.export_watermark (
+	agency_id        TEXT,
+	exported_through DATE,
+	CONSTRAINT export_watermark_pk
+		PRIMARY KEY (agency_id),
+	CONSTRAINT export_watermark_belongs_to_agency_fk
+		FOREIGN KEY (agency_id)
+		REFERENCES nextbus.agency (agency_id)
+);
@@ -0,0 +1,26 @@
+/*
+Add the nextbus.prediction table, as created by create_tables.sql, to a
+database created before it existed.
+*/
+SET search_path = public, postgis, nextbus;
+
+CREATE TABLE IF NOT EXISTS nextbus.prediction (
+	service_id          UUID,
+	stop_id             UUID,
+	vehicle_tag         TEXT,
+	predicted_timestamp TIMESTAMP,
+	is_departure        BOOLEAN,
+	trip_tag            TEXT,
+	block               TEXT,
+	affected_by_layover BOOLEAN,
+	request_timestamp   TIMESTAMP,
+	CONSTRAINT prediction_on_service_fk
+		FOREIGN KEY (service_id)
+		REFERENCES nextbus.service (service_id),
+	CONSTRAINT prediction_at_stop_fk
+		FOREIGN KEY (stop_id)
+		REFERENCES nextbus.stop (stop_id)
+);
+-- Predictions are written in request timestamp order.
+CREATE INDEX IF NOT EXISTS prediction_request_timestamp_brin_idx
+	ON nextbus.prediction USING BRIN (request_timestamp);
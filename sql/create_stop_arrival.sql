@@ -0,0 +1,36 @@
+/*
+Add the nextbus.stop_arrival and nextbus.arrival_watermark tables, as
+created by create_tables.sql, to a database created before they existed.
+*/
+SET search_path = public, postgis, nextbus;
+
+CREATE TABLE IF NOT EXISTS nextbus.stop_arrival (
+	service_id        UUID,
+	stop_id           UUID,
+	vehicle_tag       TEXT,
+	arrival_timestamp TIMESTAMP,
+	CONSTRAINT stop_arrival_on_service_fk
+		FOREIGN KEY (service_id)
+		REFERENCES nextbus.service (service_id),
+	CONSTRAINT stop_arrival_at_stop_fk
+		FOREIGN KEY (stop_id)
+		REFERENCES nextbus.stop (stop_id)
+);
+-- Arrivals are written in roughly timestamp order.
+CREATE INDEX IF NOT EXISTS stop_arrival_timestamp_brin_idx
+	ON nextbus.stop_arrival USING BRIN (arrival_timestamp);
+-- A vehicle arrives at a service's stop at most once at a given time.
+CREATE UNIQUE INDEX IF NOT EXISTS stop_arrival_defined_idx
+	ON nextbus.stop_arrival
+	(service_id, stop_id, vehicle_tag, arrival_timestamp);
+
+-- The time up to which each agency's arrivals have been inferred.
+CREATE TABLE IF NOT EXISTS nextbus.arrival_watermark (
+	agency_id TEXT,
+	watermark TIMESTAMP,
+	CONSTRAINT arrival_watermark_pk
+		PRIMARY KEY (agency_id),
+	CONSTRAINT arrival_watermark_belongs_to_agency_fk
+		FOREIGN KEY (agency_id)
+		REFERENCES nextbus.agency (agency_id)
+);
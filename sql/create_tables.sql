@@ -88,7 +88,9 @@ CREATE UNIQUE INDEX stop_defined_by_route_tag_location_idx
 /*
 Create service_stop_order table.
 This table shows the order in which stops lie on a route-service.
-In case this changes day-to-day, a timestamp is saved on every update.
+The ordering is versioned: a new version is only written when a
+service's ordering changes, valid from its `update_timestamp` until its
+`valid_until` (NULL for the version currently in effect).
 */
 -- A stop's order on a route-service must be positive.
 -- For a given update, a service can't have 2 stops with the same order.
@@ -97,6 +99,7 @@ CREATE TABLE IF NOT EXISTS nextbus.service_stop_order (
 	stop_id          UUID,
 	stop_order       INTEGER,
 	update_timestamp TIMESTAMP,
+	valid_until      TIMESTAMP,
 	CONSTRAINT service_stop_match_links_service_fk
 		FOREIGN KEY (service_id)
 		REFERENCES nextbus.service (service_id),
@@ -108,10 +111,21 @@ CREATE TABLE IF NOT EXISTS nextbus.service_stop_order (
 	CONSTRAINT service_has_valid_stop_order_unq
 		UNIQUE (service_id, stop_order, update_timestamp)
 );
+-- Find the ordering in effect at a time T with
+--   WHERE service_id = ... AND update_timestamp <= T
+--     AND (valid_until IS NULL OR valid_until > T)
+CREATE INDEX IF NOT EXISTS service_stop_order_validity_idx
+	ON nextbus.service_stop_order (service_id, update_timestamp, valid_until);
+-- Find the orderings currently in effect.
+CREATE INDEX IF NOT EXISTS service_stop_order_current_idx
+	ON nextbus.service_stop_order (service_id, stop_order)
+	WHERE valid_until IS NULL;
 
 /*
 Create vehicle_location table.
 This table shows every updated vehicle GPS location from nextbus.
+It is partitioned by day on `location_timestamp`. Partitions are created
+ahead of time, and dropped once past retention, by partition.py.
 */
 CREATE TABLE IF NOT EXISTS nextbus.vehicle_location (
 	service_id         UUID,
@@ -122,4 +136,131 @@ CREATE TABLE IF NOT EXISTS nextbus.vehicle_location (
 	CONSTRAINT vehicle_provides_service_fk
 		FOREIGN KEY (service_id)
 		REFERENCES nextbus.service (service_id)
+) PARTITION BY RANGE (location_timestamp);
+-- Rows arrive in roughly timestamp order, so a BRIN index stays tiny
+--   while still letting time-range queries skip most blocks.
+CREATE INDEX IF NOT EXISTS vehicle_location_timestamp_brin_idx
+	ON nextbus.vehicle_location USING BRIN (location_timestamp);
+-- A `service_id`, `vehicle_tag`, and `location_timestamp` uniquely define
+--   a vehicle report, so reports fetched twice are only stored once.
+CREATE UNIQUE INDEX IF NOT EXISTS vehicle_location_report_idx
+	ON nextbus.vehicle_location (service_id, vehicle_tag, location_timestamp);
+
+/*
+Create vehicle_request_cursor table.
+This table checkpoints the `lastTime` of the latest "vehicleLocations"
+request for each route, or for the whole agency when it is polled with a
+single request (NULL `route_id`). It is written in the same transaction
+as the vehicle rows fetched with it, so that a restarted poller resumes
+from there.
+*/
+CREATE TABLE IF NOT EXISTS nextbus.vehicle_request_cursor (
+	agency_id        TEXT,
+	route_id         UUID,
+	last_time        BIGINT,
+	update_timestamp TIMESTAMP,
+	CONSTRAINT vehicle_request_cursor_belongs_to_agency_fk
+		FOREIGN KEY (agency_id)
+		REFERENCES nextbus.agency (agency_id)
+);
+-- An `agency_id` and (possibly NULL) `route_id` uniquely define a cursor.
+CREATE UNIQUE INDEX IF NOT EXISTS vehicle_request_cursor_key_idx
+	ON nextbus.vehicle_request_cursor (agency_id, COALESCE(TEXT(route_id), ''));
+
+/*
+Create vehicle_latest table.
+This table holds only the latest report of each vehicle, upserted along
+with the vehicle_location rows when the pollers are run with `-W on`.
+*/
+CREATE TABLE IF NOT EXISTS nextbus.vehicle_latest (
+	agency_id          TEXT,
+	vehicle_tag        TEXT,
+	service_id         UUID,
+	vehicle_location   GEOMETRY(POINT, 4326),
+	location_timestamp TIMESTAMP,
+	is_predictable     BOOLEAN,
+	CONSTRAINT vehicle_latest_pk
+		PRIMARY KEY (agency_id, vehicle_tag),
+	CONSTRAINT vehicle_latest_belongs_to_agency_fk
+		FOREIGN KEY (agency_id)
+		REFERENCES nextbus.agency (agency_id)
+);
+CREATE INDEX IF NOT EXISTS vehicle_latest_location_idx
+	ON nextbus.vehicle_latest USING GIST (vehicle_location);
+
+/*
+Create stop_arrival table.
+This table shows the times at which vehicles passed each stop of their
+service, as inferred from vehicle_location by arrivals.py.
+*/
+CREATE TABLE IF NOT EXISTS nextbus.stop_arrival (
+	service_id        UUID,
+	stop_id           UUID,
+	vehicle_tag       TEXT,
+	arrival_timestamp TIMESTAMP,
+	CONSTRAINT stop_arrival_on_service_fk
+		FOREIGN KEY (service_id)
+		REFERENCES nextbus.service (service_id),
+	CONSTRAINT stop_arrival_at_stop_fk
+		FOREIGN KEY (stop_id)
+		REFERENCES nextbus.stop (stop_id)
+);
+-- Arrivals are written in roughly timestamp order.
+CREATE INDEX IF NOT EXISTS stop_arrival_timestamp_brin_idx
+	ON nextbus.stop_arrival USING BRIN (arrival_timestamp);
+-- A vehicle arrives at a service's stop at most once at a given time.
+CREATE UNIQUE INDEX IF NOT EXISTS stop_arrival_defined_idx
+	ON nextbus.stop_arrival
+	(service_id, stop_id, vehicle_tag, arrival_timestamp);
+
+-- The time up to which each agency's arrivals have been inferred.
+CREATE TABLE IF NOT EXISTS nextbus.arrival_watermark (
+	agency_id TEXT,
+	watermark TIMESTAMP,
+	CONSTRAINT arrival_watermark_pk
+		PRIMARY KEY (agency_id),
+	CONSTRAINT arrival_watermark_belongs_to_agency_fk
+		FOREIGN KEY (agency_id)
+		REFERENCES nextbus.agency (agency_id)
+);
+
+/*
+Create export_watermark table.
+This table shows the last UTC date through which each agency's vehicle
+locations have been exported to columnar files by export.py.
+*/
+CREATE TABLE IF NOT EXISTS nextbus.export_watermark (
+	agency_id        TEXT,
+	exported_through DATE,
+	CONSTRAINT export_watermark_pk
+		PRIMARY KEY (agency_id),
+	CONSTRAINT export_watermark_belongs_to_agency_fk
+		FOREIGN KEY (agency_id)
+		REFERENCES nextbus.agency (agency_id)
+);
+
+/*
+Create prediction table.
+This table shows the arrival and departure predictions of each stop, as
+polled by predictions.py, with the time they were requested at.
+*/
+CREATE TABLE IF NOT EXISTS nextbus.prediction (
+	service_id          UUID,
+	stop_id             UUID,
+	vehicle_tag         TEXT,
+	predicted_timestamp TIMESTAMP,
+	is_departure        BOOLEAN,
+	trip_tag            TEXT,
+	block               TEXT,
+	affected_by_layover BOOLEAN,
+	request_timestamp   TIMESTAMP,
+	CONSTRAINT prediction_on_service_fk
+		FOREIGN KEY (service_id)
+		REFERENCES nextbus.service (service_id),
+	CONSTRAINT prediction_at_stop_fk
+		FOREIGN KEY (stop_id)
+		REFERENCES nextbus.stop (stop_id)
 );
+-- Predictions are written in request timestamp order.
+CREATE INDEX IF NOT EXISTS prediction_request_timestamp_brin_idx
+	ON nextbus.prediction USING BRIN (request_timestamp);
@@ -0,0 +1,21 @@
+/*
+Add the nextbus.vehicle_latest table, as created by create_tables.sql,
+to a database created before it existed.
+*/
+SET search_path = public, postgis, nextbus;
+
+CREATE TABLE IF NOT EXISTS nextbus.vehicle_latest (
+	agency_id          TEXT,
+	vehicle_tag        TEXT,
+	service_id         UUID,
+	vehicle_location   GEOMETRY(POINT, 4326),
+	location_timestamp TIMESTAMP,
+	is_predictable     BOOLEAN,
+	CONSTRAINT vehicle_latest_pk
+		PRIMARY KEY (agency_id, vehicle_tag),
+	CONSTRAINT vehicle_latest_belongs_to_agency_fk
+		FOREIGN KEY (agency_id)
+		REFERENCES nextbus.agency (agency_id)
+);
+CREATE INDEX IF NOT EXISTS vehicle_latest_location_idx
+	ON nextbus.vehicle_latest USING GIST (vehicle_location);
@@ -0,0 +1,17 @@
+/*
+Add the nextbus.vehicle_request_cursor table, as created by
+create_tables.sql, to a database created before it existed.
+*/
+SET search_path = public, postgis, nextbus;
+
+CREATE TABLE IF NOT EXISTS nextbus.vehicle_request_cursor (
+	agency_id        TEXT,
+	route_id         UUID,
+	last_time        BIGINT,
+	update_timestamp TIMESTAMP,
+	CONSTRAINT vehicle_request_cursor_belongs_to_agency_fk
+		FOREIGN KEY (agency_id)
+		REFERENCES nextbus.agency (agency_id)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS vehicle_request_cursor_key_idx
+	ON nextbus.vehicle_request_cursor (agency_id, COALESCE(TEXT(route_id), ''));
@@ -0,0 +1,54 @@
+/*
+Convert an existing, unpartitioned nextbus.vehicle_location table into
+the partitioned table created by create_tables.sql.
+The existing rows are kept in a single partition covering everything
+before today (UTC). partition.py creates the daily partitions from there.
+*/
+SET search_path = public, postgis, nextbus;
+
+BEGIN;
+
+ALTER TABLE nextbus.vehicle_location
+	RENAME TO vehicle_location_history;
+ALTER TABLE nextbus.vehicle_location_history
+	RENAME CONSTRAINT vehicle_provides_service_fk
+	TO vehicle_location_history_provides_service_fk;
+
+CREATE TABLE nextbus.vehicle_location (
+	service_id         UUID,
+	vehicle_tag        TEXT,
+	vehicle_location   GEOMETRY(POINT, 4326),
+	location_timestamp TIMESTAMP,
+	is_predictable     BOOLEAN,
+	CONSTRAINT vehicle_provides_service_fk
+		FOREIGN KEY (service_id)
+		REFERENCES nextbus.service (service_id)
+) PARTITION BY RANGE (location_timestamp);
+CREATE INDEX vehicle_location_timestamp_brin_idx
+	ON nextbus.vehicle_location USING BRIN (location_timestamp);
+CREATE UNIQUE INDEX vehicle_location_report_idx
+	ON nextbus.vehicle_location (service_id, vehicle_tag, location_timestamp);
+
+-- The unique index above is built on the old rows as they're attached,
+--   so first delete any reports that were stored more than once.
+DELETE FROM nextbus.vehicle_location_history v
+	USING nextbus.vehicle_location_history d
+	WHERE v.service_id = d.service_id
+		AND v.vehicle_tag = d.vehicle_tag
+		AND v.location_timestamp = d.location_timestamp
+		AND v.ctid > d.ctid;
+
+-- Partition bounds must be literals, so build the statement with
+--   today's date.
+DO $$
+BEGIN
+	EXECUTE format(
+		'ALTER TABLE nextbus.vehicle_location '
+		'ATTACH PARTITION nextbus.vehicle_location_history '
+		'FOR VALUES FROM (MINVALUE) TO (%L)',
+		(now() AT TIME ZONE 'UTC')::DATE
+	);
+END
+$$;
+
+COMMIT;
@@ -0,0 +1,67 @@
+/*
+Convert an existing nextbus.service_stop_order table, holding one full
+snapshot of every service's ordering per daily update, to the versioned
+table created by create_tables.sql.
+Consecutive identical snapshots of a service are collapsed into one
+version, and each version is made valid until the next one.
+*/
+SET search_path = public, postgis, nextbus;
+
+BEGIN;
+
+ALTER TABLE nextbus.service_stop_order
+	ADD COLUMN IF NOT EXISTS valid_until TIMESTAMP;
+
+-- Describe each snapshot by its whole ordering, to compare it with the
+--   previous snapshot of the same service.
+CREATE TEMP TABLE snapshot ON COMMIT DROP AS
+	SELECT
+		service_id,
+		update_timestamp,
+		array_agg(stop_id ORDER BY stop_order) AS stop_ids
+	FROM nextbus.service_stop_order
+	GROUP BY service_id, update_timestamp;
+
+CREATE TEMP TABLE version ON COMMIT DROP AS
+	SELECT service_id, update_timestamp
+	FROM (
+		SELECT
+			service_id,
+			update_timestamp,
+			stop_ids IS DISTINCT FROM lag(stop_ids) OVER (
+				PARTITION BY service_id ORDER BY update_timestamp
+			) AS is_new
+		FROM snapshot
+	) s
+	WHERE is_new;
+
+-- Delete the snapshots that repeat the previous one.
+DELETE FROM nextbus.service_stop_order sso
+	WHERE NOT EXISTS (
+		SELECT 1 FROM version v
+		WHERE v.service_id = sso.service_id
+			AND v.update_timestamp = sso.update_timestamp
+	);
+
+-- Make each remaining version valid until the next one.
+UPDATE nextbus.service_stop_order sso
+	SET valid_until = v.valid_until
+	FROM (
+		SELECT
+			service_id,
+			update_timestamp,
+			lead(update_timestamp) OVER (
+				PARTITION BY service_id ORDER BY update_timestamp
+			) AS valid_until
+		FROM version
+	) v
+	WHERE v.service_id = sso.service_id
+		AND v.update_timestamp = sso.update_timestamp;
+
+CREATE INDEX IF NOT EXISTS service_stop_order_validity_idx
+	ON nextbus.service_stop_order (service_id, update_timestamp, valid_until);
+CREATE INDEX IF NOT EXISTS service_stop_order_current_idx
+	ON nextbus.service_stop_order (service_id, stop_order)
+	WHERE valid_until IS NULL;
+
+COMMIT;
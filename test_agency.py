@@ -0,0 +1,60 @@
+import uuid
+
+import agency
+import route
+
+
+ROUTE_A = uuid.UUID('00000000-0000-0000-0000-00000000000a')
+ROUTE_B = uuid.UUID('00000000-0000-0000-0000-00000000000b')
+ROUTE_C = uuid.UUID('00000000-0000-0000-0000-00000000000c')
+
+
+def stop_row(route_id, tag, name, lon, lat):
+    return (route.stop_uuid(route_id, tag, lon, lat), route_id, tag, name,
+            lon, lat)
+
+
+# A missing stop takes the name and location of the stop with its tag
+# that sorts first by (tag, lon, lat, name, route_id), whatever order
+# the routes' stops come in.
+def test_resolve_missing_stops_picks_first_matching_stop():
+    stop_rows = [
+        # Sorts after the others by lon, which is compared as the text
+        # of the routeConfig.
+        stop_row(ROUTE_A, '100', 'Main St', '-122.42', '37.70'),
+        # Ties with the next one on lon and lat; sorts first by name.
+        stop_row(ROUTE_B, '100', 'Market St', '-122.41', '37.70'),
+        stop_row(ROUTE_A, '100', 'Mission St', '-122.41', '37.70'),
+        # Ties with the one above on everything but route_id.
+        stop_row(ROUTE_B, '100', 'Mission St', '-122.41', '37.70'),
+        stop_row(ROUTE_A, '200', 'Castro St', '-122.43', '37.76'),
+    ]
+    missing_stops = {(ROUTE_C, '100'), (ROUTE_C, '200')}
+    for rows in [stop_rows, stop_rows[::-1]]:
+        resolved = sorted(
+            agency.resolve_missing_stops(rows, missing_stops),
+            key=lambda sr: sr[2]
+        )
+        assert resolved == [
+            stop_row(ROUTE_C, '100', 'Market St', '-122.41', '37.70'),
+            stop_row(ROUTE_C, '200', 'Castro St', '-122.43', '37.76'),
+        ]
+
+
+# Between stops that tie on everything but their route, the one on the
+# route whose UUID sorts first is used.
+def test_resolve_missing_stops_breaks_ties_by_route():
+    stop_rows = [
+        stop_row(ROUTE_B, '100', 'Main St', '-122.40', '37.70'),
+        stop_row(ROUTE_A, '100', 'Main St', '-122.40', '37.70'),
+    ]
+    [resolved] = agency.resolve_missing_stops(stop_rows, {(ROUTE_C, '100')})
+    assert resolved == stop_row(ROUTE_C, '100', 'Main St', '-122.40', '37.70')
+
+
+# A missing stop with no matching tag gets a NULL name and location.
+def test_resolve_missing_stops_without_match():
+    stop_rows = [stop_row(ROUTE_A, '100', 'Main St', '-122.40', '37.70')]
+    assert agency.resolve_missing_stops(stop_rows, {(ROUTE_B, '300')}) == [
+        stop_row(ROUTE_B, '300', None, None, None)
+    ]
@@ -0,0 +1,78 @@
+import datetime
+
+import ingest
+
+
+# While batches are spilled, new batches are spilled after them, so
+# that the writer gets every batch in the order it was queued.
+def test_ingest_queue_keeps_fifo_order_with_spill(tmp_path):
+    ingest_queue = ingest.IngestQueue(2, policy='spill',
+                                      spill_dir=str(tmp_path))
+    ingest_queue.put('a', [1, 2], {'a': '1000'})
+    # The queue is full, so this batch is spilled...
+    ingest_queue.put('a', [3, 4], {'a': '2000'})
+    # ...and so is this one, although it would fit in memory.
+    ingest_queue.put('a', [5], {'a': '3000'})
+    assert ingest_queue.depth()['spilled_batches'] == 2
+    taken = []
+    for i in range(3):
+        batches = ingest_queue.get_batches(10, 0)
+        ingest_queue.remove_spilled(batches)
+        taken.extend(b[2]['a'] for b in batches)
+    assert taken == ['1000', '2000', '3000']
+    assert list(tmp_path.iterdir()) == []
+
+
+# A spilled batch's file is kept until the batch has been written, and
+# a new queue on the same spill directory reads it back first.
+def test_ingest_queue_resumes_spilled_batches(tmp_path):
+    ingest_queue = ingest.IngestQueue(1, policy='spill',
+                                      spill_dir=str(tmp_path))
+    ingest_queue.put('a', [1], {'a': '1000'})
+    ingest_queue.put('a', [2], {'a': '2000'})
+    ingest_queue.get_batches(10, 0)
+    [(agency_id, rows, cursors, path)] = ingest_queue.get_batches(10, 0)
+    assert path is not None
+    # The process stops before the batch is written.
+    ingest_queue = ingest.IngestQueue(1, policy='spill',
+                                      spill_dir=str(tmp_path))
+    ingest_queue.put('a', [3], {'a': '3000'})
+    batches = ingest_queue.get_batches(10, 0)
+    assert [b[1] for b in batches] == [[2]]
+    ingest_queue.remove_spilled(batches)
+    assert [b[1] for b in ingest_queue.get_batches(10, 0)] == [[3]]
+
+
+T = datetime.datetime(2026, 10, 17, 12, 0, 0)
+
+
+def report(vehicle_tag, seconds):
+    return (None, vehicle_tag, '-122.4', '37.7',
+            T + datetime.timedelta(seconds=seconds), True)
+
+
+# A report no newer than the vehicle's last written one, give or take
+# the tolerance, is dropped, including a repeat within the same batch.
+def test_report_cache_drops_reports_within_tolerance():
+    cache = ingest.ReportCache(tolerance=datetime.timedelta(seconds=1))
+    [fresh_rows, pending] = cache.filter('a', [report('1', 0)])
+    cache.remember(pending)
+    [fresh_rows, pending] = cache.filter('a', [
+        report('1', 1), report('1', 5), report('1', 5.5), report('2', 0)
+    ])
+    assert fresh_rows == [report('1', 5), report('2', 0)]
+    # Until they're remembered, the reports don't affect other batches.
+    assert cache.filter('a', [report('1', 5)])[0] == [report('1', 5)]
+    # Reports are kept per agency.
+    assert cache.filter('b', [report('1', 0)])[0] == [report('1', 0)]
+
+
+# The least recently written vehicles are evicted once the cache is
+# full.
+def test_report_cache_evicts_least_recently_used():
+    cache = ingest.ReportCache(max_size=2)
+    cache.remember({('a', '1'): T, ('a', '2'): T})
+    cache.remember({('a', '1'): T, ('a', '3'): T})
+    assert list(cache.reports) == [('a', '1'), ('a', '3')]
+    assert cache.filter('a', [report('2', 0)])[0] == [report('2', 0)]
+    assert cache.filter('a', [report('1', 0)])[0] == []
@@ -0,0 +1,54 @@
+import datetime
+
+import partition
+
+
+D = datetime.date
+
+
+# The history partition attached by sql/partition_vehicle_location.sql
+# covers everything before the day the migration ran.
+HISTORY = [None, D(2026, 10, 17)]
+
+
+def test_uncovered_range_skips_covered_day():
+    assert partition.uncovered_range(
+        D(2026, 10, 16), D(2026, 10, 17), [HISTORY]
+    ) is None
+
+
+def test_uncovered_range_keeps_uncovered_day():
+    assert partition.uncovered_range(
+        D(2026, 10, 17), D(2026, 10, 18), [HISTORY]
+    ) == [D(2026, 10, 17), D(2026, 10, 18)]
+
+
+# A month partially covered by the history partition starts where the
+# history partition ends.
+def test_uncovered_range_clips_start_of_month():
+    assert partition.uncovered_range(
+        D(2026, 10, 1), D(2026, 11, 1), [HISTORY]
+    ) == [D(2026, 10, 17), D(2026, 11, 1)]
+
+
+# A range overlapping a partition that starts within it stops where that
+# partition starts.
+def test_uncovered_range_clips_end_before_later_partition():
+    assert partition.uncovered_range(
+        D(2026, 10, 1), D(2026, 11, 1), [[D(2026, 10, 20), D(2026, 10, 21)]]
+    ) == [D(2026, 10, 1), D(2026, 10, 20)]
+
+
+# Adjacent partitions covering the start are skipped over in turn,
+# whatever order they're listed in.
+def test_uncovered_range_skips_adjacent_partitions():
+    assert partition.uncovered_range(
+        D(2026, 10, 1), D(2026, 11, 1),
+        [[D(2026, 10, 2), D(2026, 10, 3)], [D(2026, 10, 1), D(2026, 10, 2)]]
+    ) == [D(2026, 10, 3), D(2026, 11, 1)]
+
+
+def test_uncovered_range_under_unbounded_partition():
+    assert partition.uncovered_range(
+        D(2026, 10, 1), D(2026, 11, 1), [[D(2026, 9, 1), None]]
+    ) is None